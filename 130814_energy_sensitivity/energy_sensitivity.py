@@ -6,17 +6,23 @@ required number of stations.
 
 For each point on the map a bisection (of shower energies) will be performed
 which will calculate the detection probability using Poisson probability. It
-will try to approach the requested detection_probability.
+will try to approach the requested detection_probability. All points are
+bisected simultaneously, the densities for all points and detectors are
+calculated at once.
 
-Each combination is considered when determining the probability.
+The map is first determined on a coarse grid, which is then refined only
+near the edge of the acceptance, elsewhere the energies are interpolated.
+
+The probability that at least a number of detectors or stations is hit is
+determined from the distribution of the number of hits (Poisson binomial),
+which is built one detector or station at a time.
 
 """
 
 import os
 
 from functools import partial
-from itertools import combinations, product
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -32,7 +38,13 @@ from sapphire.utils import pbar
 
 
 def multi_find_min_energy(cls, xy):
-    return cls.find_min_energy(xy[0], xy[1])
+    return cls.find_min_energy(*xy)
+
+
+def grid_indexes(n, step):
+    """Indexes of every step-th position, including the last position"""
+
+    return np.union1d(np.arange(0, n, step), [n - 1])
 
 
 class EnergySensitivity:
@@ -55,16 +67,21 @@ class EnergySensitivity:
         self.start_energy = 1e17
         self.bisections = 11
 
+        # Grid refinement, set refine_tolerance to None to evaluate all points
+        self.coarse_step = 8
+        self.refine_tolerance = 0.05  # decades
+
         # Throw showers in a regular grid around center mass of the station
         xc, yc, _ = self.cluster.calc_center_of_mass_coordinates()
-        self.xx = np.linspace(-self.max_radius + xc, self.max_radius + xc, np.sqrt(self.grid_points))
-        self.yy = np.linspace(-self.max_radius + yc, self.max_radius + yc, np.sqrt(self.grid_points))
+        self.xx = np.linspace(-self.max_radius + xc, self.max_radius + xc, int(np.sqrt(self.grid_points)))
+        self.yy = np.linspace(-self.max_radius + yc, self.max_radius + yc, int(np.sqrt(self.grid_points)))
 
     def main(self):
         # Cache detector positions
-        for station in self.cluster.stations:
-            for detector in station.detectors:
-                detector.xy_coordinates = detector.get_xy_coordinates()
+        self.detector_xy = np.array(
+            [detector.get_xy_coordinates() for station in self.cluster.stations for detector in station.detectors]
+        )
+        self.station_splits = np.cumsum([len(station.detectors) for station in self.cluster.stations])[:-1]
         # Results
         self.results = self.get_min_energy_per_bin()
 
@@ -82,33 +99,105 @@ class EnergySensitivity:
         return area
 
     def get_min_energy_per_bin(self):
+        """Determine the minimum energy for each point of the grid
+
+        First the energies are determined on a coarse grid, using every
+        coarse_step-th point. Then the step is halved until all points
+        are done. New points are only evaluated if the energies at the
+        corners of the surrounding cell of the previous grid differ by more
+        than refine_tolerance, otherwise they are interpolated (in log
+        energy) from those corners.
 
+        :return: array of energies, with shape (len(yy), len(xx)).
+
+        """
+        results = np.full((len(self.yy), len(self.xx)), np.nan)
+
+        step = self.coarse_step
+        x_idx = grid_indexes(len(self.xx), step)
+        y_idx = grid_indexes(len(self.yy), step)
+        jj, ii = (idx.ravel() for idx in np.meshgrid(y_idx, x_idx, indexing='ij'))
+        results[jj, ii] = self.find_min_energies(self.xx[ii], self.yy[jj])
+
+        while step > 1:
+            step //= 2
+            new_x_idx = grid_indexes(len(self.xx), step)
+            new_y_idx = grid_indexes(len(self.yy), step)
+            jj, ii = (idx.ravel() for idx in np.meshgrid(new_y_idx, new_x_idx, indexing='ij'))
+            new = np.isnan(results[jj, ii])
+            jj = jj[new]
+            ii = ii[new]
+
+            # Corners of the surrounding cell, equal if on a line of the grid
+            i0 = x_idx[np.searchsorted(x_idx, ii, 'right') - 1]
+            i1 = x_idx[np.searchsorted(x_idx, ii, 'left')]
+            j0 = y_idx[np.searchsorted(y_idx, jj, 'right') - 1]
+            j1 = y_idx[np.searchsorted(y_idx, jj, 'left')]
+            corners = np.log10([results[j0, i0], results[j0, i1], results[j1, i0], results[j1, i1]])
+
+            if self.refine_tolerance is None:
+                refine = np.ones(len(ii), dtype=bool)
+            else:
+                refine = corners.max(axis=0) - corners.min(axis=0) > self.refine_tolerance
+            results[jj[refine], ii[refine]] = self.find_min_energies(self.xx[ii[refine]], self.yy[jj[refine]])
+
+            wi = np.where(i1 > i0, (ii - i0) / np.maximum(i1 - i0, 1), 0.0)
+            wj = np.where(j1 > j0, (jj - j0) / np.maximum(j1 - j0, 1), 0.0)
+            log_energies = (1 - wj) * ((1 - wi) * corners[0] + wi * corners[1]) + wj * (
+                (1 - wi) * corners[2] + wi * corners[3]
+            )
+            results[jj[~refine], ii[~refine]] = 10 ** log_energies[~refine]
+
+            x_idx = new_x_idx
+            y_idx = new_y_idx
+
+        return results
+
+    def find_min_energies(self, x, y):
+        """Find the minimum energies for many shower core positions
+
+        The positions are divided in a chunk for each worker, so the
+        cluster is only sent once to each worker.
+
+        :param x,y: arrays of shower core positions.
+        :return: array with the minimum energy for each position.
+
+        """
+        if not len(x):
+            return np.array([])
+        n_chunks = min(cpu_count(), len(x))
+        chunks = zip(np.array_split(x, n_chunks), np.array_split(y, n_chunks))
         worker_pool = Pool()
         temp_multi_find_min_energy = partial(multi_find_min_energy, self)
-        results = worker_pool.map(temp_multi_find_min_energy, product(self.xx, self.yy))
+        results = worker_pool.map(temp_multi_find_min_energy, chunks)
         worker_pool.close()
         worker_pool.join()
-        #         results = [temp_multi_find_min_energy(xy) for xy in product(self.xx, self.yy)]
-        results = np.array(results).reshape((len(self.xx), len(self.yy))).T
+        #         results = [temp_multi_find_min_energy(xy) for xy in chunks]
 
-        return results
+        return np.concatenate(results)
 
     def find_min_energy(self, xc, yc):
-        # Use bisection to quickly get the final energy
-        energy = self.start_energy
-        lo = self.min_energy
-        hi = self.max_energy
+        """Use bisection to quickly get the final energy
+
+        All shower core positions are bisected simultaneously.
+
+        :param xc,yc: arrays of shower core positions.
+        :return: array with the minimum energy for each position.
+
+        """
+        xc, yc = np.broadcast_arrays(np.asarray(xc, dtype=float), np.asarray(yc, dtype=float))
+        energy = np.full(xc.shape, self.start_energy)
+        lo = np.full(xc.shape, self.min_energy)
+        hi = np.full(xc.shape, self.max_energy)
+        todo = np.ones(xc.shape, dtype=bool)
         for _ in range(self.bisections):
             n_electrons = 10 ** (np.log10(energy) - 15 + 4.8)
             station_densities = self.calculate_densities_for_cluster(xc, yc, n_electrons)
             p_cluster = self.detection_probability_for_cluster(station_densities)
-            if p_cluster == self.detection_probability:
-                break
-            elif p_cluster < self.detection_probability:
-                lo = energy
-            else:
-                hi = energy
-            energy = 10 ** ((np.log10(lo) + np.log10(hi)) / 2.0)
+            todo &= p_cluster != self.detection_probability
+            lo = np.where(todo & (p_cluster < self.detection_probability), energy, lo)
+            hi = np.where(todo & (p_cluster > self.detection_probability), energy, hi)
+            energy = np.where(todo, 10 ** ((np.log10(lo) + np.log10(hi)) / 2.0), energy)
 
         return energy
 
@@ -120,19 +209,21 @@ class EnergySensitivity:
         is determined. Then it looks for the probability that at least a given
         number of stations detects the shower.
 
-        :param station_densities: list of densities at each detectors in
-                                  each of the stations.
+        :param station_densities: list with an array of densities at the
+                                  detectors for each station, the detectors
+                                  are along the last axis.
         :return: probability of a coicidence.
 
         """
         if len(station_densities) < self.min_stations:
             # To few stations
-            return 0
+            return np.zeros(station_densities[0].shape[:-1])
 
-        p_stations = [
-            self.detection_probability_for_station(detector_densities) for detector_densities in station_densities
-        ]
-        p0_stations = [1.0 - p for p in p_stations]
+        p_stations = np.stack(
+            [self.detection_probability_for_station(detector_densities) for detector_densities in station_densities],
+            axis=-1,
+        )
+        p0_stations = 1.0 - p_stations
         p_cluster = self.calculate_p(p_stations, p0_stations, self.min_stations)
 
         return p_cluster
@@ -145,36 +236,50 @@ class EnergySensitivity:
         one particle. At least `min_detectors` need to be hit to count towards
         the probability of a good detection.
 
-        :param detector_densities: list of densities at each detectors in
-                                  the station.
-        :return: list of probabilities for each station.
+        :param detector_densities: array of densities at each detector in
+                                   the station, along the last axis.
+        :return: probability of a good detection.
 
         """
-        if len(detector_densities) < self.min_detectors:
+        if detector_densities.shape[-1] < self.min_detectors:
             # To few detectors
-            return 0
+            return np.zeros(detector_densities.shape[:-1])
 
-        p0_detectors = [self.p0(density) for density in detector_densities]
-        p_detectors = [1.0 - p0 for p0 in p0_detectors]
+        p0_detectors = self.p0(detector_densities)
+        p_detectors = 1.0 - p0_detectors
         p_station = self.calculate_p(p_detectors, p0_detectors, self.min_detectors)
         return p_station
 
     def calculate_p(self, p, p0, min_n):
-        n_p = len(p)
-        p_total = 0
-        for n in range(min_n, n_p + 1):
-            for i in combinations(list(range(n_p)), n):
-                p_combination = 1.0
-                for j in range(n_p):
-                    if j in i:
-                        # Probability of trigger
-                        p_combination *= p[j]
-                    else:
-                        # Probability of no trigger
-                        p_combination *= p0[j]
-                p_total += p_combination
-
-        return p_total
+        """Probability that at least min_n of independent events occur
+
+        The distribution of the number of occurred events is updated for
+        each event, instead of summing over all combinations of events.
+
+        :param p,p0: arrays with the probability that each event does and
+                     does not occur, the events are along the last axis.
+        :param min_n: minimum number of events.
+        :return: array of probabilities.
+
+        """
+        n_p = p.shape[-1]
+        if min_n <= 0:
+            return np.ones(p.shape[:-1])
+        elif min_n > n_p:
+            return np.zeros(p.shape[:-1])
+        # Probability of exactly n events, for n up to min_n (the last
+        # element accumulates min_n or more events)
+        n_events = np.zeros(p.shape[:-1] + (min_n + 1,))
+        n_events[..., 0] = 1.0
+        for j in range(n_p):
+            p_j = p[..., j, np.newaxis]
+            p0_j = p0[..., j, np.newaxis]
+            at_least = n_events[..., -1:] + n_events[..., -2:-1] * p_j
+            n_events[..., 1:] = n_events[..., 1:] * p0_j + n_events[..., :-1] * p_j
+            n_events[..., :1] *= p0_j
+            n_events[..., -1:] = at_least
+
+        return n_events[..., min_n]
 
     def p(self, detector_density):
         """Chance of at least one particle in detector"""
@@ -187,28 +292,22 @@ class EnergySensitivity:
         return np.exp(-detector_density / 2.0)
 
     def calculate_densities_for_cluster(self, x, y, n_electrons):
-        densities = [
-            self.calculate_densities_for_station(station, x, y, n_electrons) for station in self.cluster.stations
-        ]
-
-        return densities
-
-    def calculate_densities_for_station(self, station, x, y, n_electrons):
-        densities = [
-            self.calculate_densities_for_detector(detector, x, y, n_electrons) for detector in station.detectors
-        ]
+        """Calculate the densities at all detectors for shower cores at x, y
 
-        return densities
+        :param x,y,n_electrons: arrays with the shower core positions and
+                                number of electrons of each shower.
+        :return: list with for each station an array of the densities at
+                 its detectors, with shape (n_showers, n_detectors).
 
-    def calculate_densities_for_detector(self, detector, x, y, n_electrons):
-        r = self.calculate_detector_core_distance(detector, x, y)
-        density = self.ldf.calculate_ldf_value(r, n_electrons)
+        """
+        r = self.calculate_detector_core_distances(x, y)
+        densities = self.ldf.calculate_ldf_value(r, np.asarray(n_electrons)[..., np.newaxis])
 
-        return density
+        return np.split(densities, self.station_splits, axis=-1)
 
-    def calculate_detector_core_distance(self, detector, x, y):
-        x0, y0 = detector.xy_coordinates
-        r = np.sqrt((x - x0) ** 2 + (y - y0) ** 2)
+    def calculate_detector_core_distances(self, x, y):
+        x0, y0 = self.detector_xy.T
+        r = np.sqrt((np.asarray(x)[..., np.newaxis] - x0) ** 2 + (np.asarray(y)[..., np.newaxis] - y0) ** 2)
 
         return r
 
@@ -373,20 +472,8 @@ class StationPairAreaEnergySensitivity(StationPairEnergySensitivity):
     def get_min_energy_per_bin(self):
         """Only calculate along x, y axes with center between stations"""
 
-        temp_multi_find_min_energy = partial(multi_find_min_energy, self)
-        worker_pool = Pool()
-        x_results = np.array(
-            worker_pool.map(temp_multi_find_min_energy, [(x, self.yy[0]) for x in self.xx], chunksize=10)
-        )
-        y_results = np.array(
-            worker_pool.map(temp_multi_find_min_energy, [(self.xx[0], y) for y in self.yy], chunksize=10)
-        )
-        worker_pool.close()
-        worker_pool.join()
-        #         x_results = np.array([temp_multi_find_min_energy(xy) for xy in
-        #                               [(x, self.yy[0]) for x in self.xx]])
-        #         y_results = np.array([temp_multi_find_min_energy(xy) for xy in
-        #                               [(self.xx[0], y) for y in self.yy]])
+        x_results = self.find_min_energies(self.xx, np.full_like(self.xx, self.yy[0]))
+        y_results = self.find_min_energies(np.full_like(self.yy, self.xx[0]), self.yy)
 
         return (x_results, y_results)
 
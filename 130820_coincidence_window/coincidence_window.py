@@ -3,18 +3,22 @@
 This script gets the number of found coincidences as a function of the
 coincidence window.
 
-TODO: Fix coincidences that are subsets. The number of coincidences
-should not keep increasing, because at some point one coincidence might
-contain another coincidences. e.g. 1, 3, 2 also includes 3, 2. This
-should perhaps be counted as only 1 coincidence.
-
-Ideas for faster coincidence finding
-
-- Use numpy array
-- Find where difference between subsequent elements is less than window
-- Then find where difference between those that passed previous check
-  also have less difference than window between next (idx+2) element
-- ...
+Coincidences that are subsets of the previous coincidence are not
+counted, e.g. 1, 3, 2 also includes 3, 2, this is counted as only 1
+coincidence. This is the same as the coincidences found by SAPPHiRE,
+except that coincidences which only contain events of a single station
+are not counted. Those are bursts of events in one station, which are
+not described by the background of station pairs.
+
+Faster coincidence finding
+
+- Sort the timestamps of all stations once, as numpy array
+- For each event find the first event outside the window (searchsorted),
+  the events in between form the coincidence starting at that event
+- A coincidence is a subset of the previous one if it ends at the same
+  event, because the ends never decrease
+- The number of station changes up to each event in the sorted events
+  shows if a coincidence contains more than one station
 
 Notes
 
@@ -35,6 +39,7 @@ from artist import MultiPlot
 from sapphire import Coincidences, Network, Station
 
 ESD_PATH = '/Users/arne/Datastore/esd'
+MAX_N = 10
 
 
 def coincidences_all_stations():
@@ -80,9 +85,9 @@ def coincidences_stations(station_numbers, group_name='Specific stations', date=
     filepath = os.path.join(ESD_PATH, date.strftime('%Y/%-m/%Y_%-m_%-d.h5'))
     with tables.open_file(filepath, 'r') as data:
         coinc, event_tables = get_event_tables(data, cluster_groups, stations_with_data)
-        windows, counts, n_events = find_n_coincidences(coinc, event_tables)
+        windows, counts, n_events = find_n_coincidences(event_tables)
         n_stations = len(stations_with_data)
-        plot_coinc_window(windows, counts, group_name, n_events, n_stations, date)
+        plot_coinc_window(windows, counts[:, 0], group_name, n_events, n_stations, date)
     return windows, counts
 
 
@@ -101,29 +106,85 @@ def get_event_tables(data, cluster_groups, station_numbers):
     return coinc, event_tables
 
 
-def find_n_coincidences(coinc, event_tables):
-    timestamps = coinc._retrieve_timestamps(event_tables)
-    ts_arr = numpy.array(timestamps, dtype='3u8')
-    n_events = len(timestamps)
+def find_n_coincidences(event_tables, max_n=MAX_N):
+    """Count coincidences for a range of coincidence windows
 
-    del timestamps
+    :param event_tables: event tables of the stations.
+    :param max_n: highest multiplicity for which to count coincidences.
+    :return: coincidence windows, number of coincidences with at least
+             n events (columns for n = 2 to max_n) for each window, and
+             total number of events.
 
-    ts_diff = ts_arr[1:, 0] - ts_arr[:-1, 0]
-    not_same_station = ts_arr[1:, 1] != ts_arr[:-1, 1]
-    ts_diff = ts_diff[not_same_station]
-
-    del ts_arr
+    """
+    timestamps, stations = sorted_timestamps(event_tables)
+    n_events = len(timestamps)
 
     # 10^14 ns = 1.1 day
     windows = 10 ** numpy.arange(0, 14, 0.2)
-    counts = [len(numpy.where(ts_diff < window)[0]) for window in windows]
+    counts = count_coincidences(timestamps, stations, windows, max_n)
 
-    if sum(counts) == 0:
+    if counts.sum() == 0:
         return
     else:
         return windows, counts, n_events
 
 
+def sorted_timestamps(event_tables):
+    """Get the sorted extended timestamps of the events of all stations
+
+    :return: sorted extended timestamps and the index of the event table
+             of each event.
+
+    """
+    timestamps = numpy.concatenate([event_table.col('ext_timestamp') for event_table in event_tables])
+    stations = numpy.concatenate(
+        [numpy.full(event_table.nrows, i, dtype=numpy.uint16) for i, event_table in enumerate(event_tables)]
+    )
+    order = timestamps.argsort(kind='stable')
+    return timestamps[order], stations[order]
+
+
+def count_coincidences(timestamps, stations, windows, max_n=MAX_N):
+    """Count the coincidences in sorted timestamps for each window
+
+    For each window this gives the same coincidences as the search in
+    SAPPHiRE (Coincidences._do_search_coincidences). The coincidence
+    starting at an event contains all events up to the first event which
+    is not within the window from that event. These ends never decrease,
+    so a coincidence is a subset of the previous one if it has the same
+    end. Those are not counted, neither are coincidences with events of
+    only one station.
+
+    :param timestamps: sorted extended timestamps, in ns.
+    :param stations: station index of each event.
+    :param windows: coincidence windows, in ns.
+    :param max_n: highest multiplicity for which to count coincidences.
+    :return: array with the number of coincidences with at least n
+             events, with a row for each window and columns for n = 2 to
+             max_n.
+
+    """
+    indexes = numpy.arange(len(timestamps))
+    new_end = numpy.ones(len(timestamps), dtype=bool)
+    # Number of station changes before each event
+    changes = numpy.zeros(len(timestamps), dtype=int)
+    changes[1:] = numpy.cumsum(stations[1:] != stations[:-1])
+    counts = numpy.zeros((len(windows), max_n + 1), dtype=int)
+
+    for i, window in enumerate(windows):
+        # Time differences are integer, so t < t0 + window <=> t < t0 + ceil(window)
+        stop = timestamps + numpy.uint64(numpy.ceil(window))
+        ends = numpy.searchsorted(timestamps, stop, side='left')
+        new_end[1:] = ends[1:] != ends[:-1]
+        sizes = (ends - indexes)[new_end]
+        multiple_stations = changes[ends[new_end] - 1] > changes[new_end]
+        sizes = sizes[multiple_stations]
+        counts[i] = numpy.bincount(numpy.minimum(sizes, max_n), minlength=max_n + 1)
+
+    at_least_n = counts[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return at_least_n[:, 2:]
+
+
 def plot_background_v_window(plot, windows, n_stations):
     low_rate = 0.3
     high_rate = 0.8
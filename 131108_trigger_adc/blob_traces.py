@@ -0,0 +1,122 @@
+"""Decode traces from the blobs of an events table
+
+The traces of events are stored as zlib compressed comma separated ADC
+values in the ``blobs`` VLArray next to the ``events`` table, the
+``traces`` column of the events contains the indexes into the blobs.
+
+:func:`iter_traces` reads the compressed blobs in batches of events and
+decompresses them in a pool of worker processes. Each batch is returned
+as a contiguous integer array with shape (n_events, n_detectors,
+n_samples). At most a few batches are in memory at the same time.
+
+"""
+import multiprocessing
+import zlib
+
+from collections import deque
+
+from numpy import fromstring, full, int16
+
+BATCH_SIZE = 500
+MISSING = -1
+
+
+def decode_blob(blob):
+    """Decompress a single trace blob
+
+    Some blobs are wrapped in an extra byte at either end, these are
+    stripped if the blob can not be decompressed directly.
+
+    :param blob: zlib compressed comma separated ADC values.
+    :return: array of pulseheight values.
+
+    """
+    try:
+        trace = zlib.decompress(blob)
+    except zlib.error:
+        trace = zlib.decompress(blob[1:-1])
+    return fromstring(trace.decode(), dtype=int16, sep=',')
+
+
+def decode_traces(trace_idx, blobs):
+    """Decode the traces of a batch of events into a single array
+
+    Missing traces, and samples beyond the end of shorter traces, are
+    set to MISSING.
+
+    :param trace_idx: array with the blob indexes of the events, the
+                      ``traces`` column of the events.
+    :param blobs: dictionary of compressed blobs by blob index.
+    :return: array with shape (n_events, n_detectors, n_samples).
+
+    """
+    decoded = {idx: decode_blob(blob) for idx, blob in blobs.items()}
+    n_samples = max((len(trace) for trace in decoded.values()), default=0)
+
+    traces = full(trace_idx.shape + (n_samples,), MISSING, dtype=int16)
+    for i, j in zip(*(trace_idx != MISSING).nonzero()):
+        trace = decoded[trace_idx[i, j]]
+        traces[i, j, : len(trace)] = trace
+    return traces
+
+
+def read_blobs(blobs, trace_idx):
+    """Read the compressed blobs for a batch of events
+
+    If the blob indexes are mostly contiguous they are read in a single
+    slice, otherwise row by row.
+
+    :param blobs: the blobs VLArray.
+    :param trace_idx: array with the blob indexes of the events.
+    :return: dictionary of compressed blobs by blob index.
+
+    """
+    indexes = set(trace_idx[trace_idx != MISSING].tolist())
+    if not indexes:
+        return {}
+    first = min(indexes)
+    last = max(indexes)
+    if last - first < 2 * len(indexes):
+        rows = blobs.read(first, last + 1)
+        return {idx: rows[idx - first] for idx in indexes}
+    else:
+        return {idx: blobs[idx] for idx in indexes}
+
+
+def iter_traces(events, blobs, batch_size=BATCH_SIZE, start=0, stop=None, processes=None):
+    """Generator for batches of decoded traces
+
+    The blobs are read in the main process, decompression is done by a
+    pool of worker processes. The number of batches being decoded is
+    limited to twice the number of workers, to bound the memory use.
+
+    :param events: the events table.
+    :param blobs: the blobs VLArray belonging to the events.
+    :param batch_size: number of events per batch.
+    :param start,stop: range of event rows to decode.
+    :param processes: number of worker processes, defaults to the number
+                      of cpus.
+    :return: generator yielding the first event row of each batch and an
+             array of the traces, see :func:`decode_traces`.
+
+    """
+    if stop is None:
+        stop = events.nrows
+    processes = processes or multiprocessing.cpu_count()
+
+    worker_pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for batch_start in range(start, stop, batch_size):
+            trace_idx = events.read(batch_start, min(batch_start + batch_size, stop), field='traces')
+            job = worker_pool.apply_async(decode_traces, (trace_idx, read_blobs(blobs, trace_idx)))
+            pending.append((batch_start, job))
+            if len(pending) >= 2 * processes:
+                batch_start, job = pending.popleft()
+                yield batch_start, job.get()
+        while pending:
+            batch_start, job = pending.popleft()
+            yield batch_start, job.get()
+    finally:
+        worker_pool.terminate()
+        worker_pool.join()
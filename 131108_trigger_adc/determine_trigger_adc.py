@@ -1,8 +1,7 @@
-import zlib
-
-import numpy as np
 import tables
 
+from .blob_traces import decode_blob, iter_traces
+
 
 def get_trace(blobs, idx):
     """Returns a trace given an index into the blobs array.
@@ -13,11 +12,25 @@ def get_trace(blobs, idx):
     :returns: array of pulseheight values
 
     """
-    trace = zlib.decompress(blobs[idx]).split(',')
-    if trace[-1] == '':
-        del trace[-1]
-    trace = np.array([int(x) for x in trace])
-    return trace
+    return decode_blob(blobs[idx])
+
+
+def lowest_maximum(events, blobs, lowest_max=253):
+    """Find the lowest maximum pulseheight of all traces of the events
+
+    :param events: the events table.
+    :param blobs: the blobs VLArray belonging to the events.
+    :param lowest_max: initial value for the lowest maximum.
+    :returns: lowest maximum of the traces.
+
+    """
+    for _, traces in iter_traces(events, blobs):
+        maximums = traces.max(axis=-1)
+        # Missing traces have a maximum of -1
+        maximums = maximums[maximums >= 0]
+        if len(maximums):
+            lowest_max = min(maximums.min(), lowest_max)
+    return lowest_max
 
 
 if __name__ == '__main__':
@@ -26,13 +39,6 @@ if __name__ == '__main__':
         lowest_maximums = []
         for node in data.walk_nodes('/hisparc/cluster_aarhus'):
             if node._v_name == 'events':
-                lowest_max = 253
-                for event in node:
-                    for trace_idx in event['traces']:
-                        if trace_idx != -1:
-                            trace = get_trace(node._v_parent.blobs, trace_idx)
-                            if max(trace) < lowest_max:
-                                lowest_max = min(max(trace), lowest_max)
-                                raise Exception
+                lowest_max = lowest_maximum(node, node._v_parent.blobs)
                 lowest_maximums.append([node._v_parent._v_name, lowest_max])
                 print(lowest_maximums[-1])
@@ -5,25 +5,26 @@ import tables
 
 from matplotlib.colors import LogNorm
 
+from .groundparticles_index import GroundParticlesIndex
+
 SEED_NUMBERS = '231360773_763934896'
 DATA_PATH = '/Users/arne/Datastore/CORSIKA'
 DATA_FILE = os.path.join(DATA_PATH, SEED_NUMBERS, 'corsika.h5')
 
-QUERY_DETECTABLE = '((particle_id == 2) | (particle_id == 3) | ' ' (particle_id == 5) | (particle_id == 6))'
-QUERY_TIMESLICE = '(t >= %s) & (t < %s)'
+DETECTABLE = [2, 3, 5, 6]
 
 
-def plot_time_slices(data):
+def plot_time_slices(data, index):
     groundparticles = data.get_node('/', 'groundparticles')
-    filtered_particles = groundparticles.get_where_list(QUERY_DETECTABLE + ' & (r < 4000)')
-    times = groundparticles.read_coordinates(filtered_particles, field='t')
+    # Read the detectable particles in the plotted area once
+    particles = index.box(-4000, 4000, -4000, 4000, particle_ids=DETECTABLE)
+    times = particles['t'][particles['r'] < 4000]
     header = groundparticles._v_attrs.event_header
     step = 2000
-    for t in range(times.min(), times.max(), step):
-        query = QUERY_DETECTABLE + ' & ' + QUERY_TIMESLICE % (t, t + step)
-        filtered_particles = groundparticles.get_where_list(query)
-        detectable_x = groundparticles.read_coordinates(filtered_particles, field='x')
-        detectable_y = groundparticles.read_coordinates(filtered_particles, field='y')
+    for t in range(int(times.min()), int(times.max()), step):
+        in_slice = (particles['t'] >= t) & (particles['t'] < t + step)
+        detectable_x = particles['x'][in_slice]
+        detectable_y = particles['y'][in_slice]
         plt.figure()
         plt.title('Energy: {:g} eV, Zenith: {:.1f}'.format(header.energy, header.theta_max))
         plt.xlabel('x (m)')
@@ -44,5 +45,5 @@ def plot_time_slices(data):
 
 
 if __name__ == '__main__':
-    with tables.open_file(DATA_FILE, 'r') as data:
-        plot_time_slices(data)
+    with tables.open_file(DATA_FILE, 'r') as data, GroundParticlesIndex(DATA_FILE) as index:
+        plot_time_slices(data, index)
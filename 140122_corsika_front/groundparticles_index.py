@@ -0,0 +1,307 @@
+"""Spatial and temporal index of CORSIKA ground particles
+
+Selecting particles from the groundparticles table with a condition
+requires a scan over all particles, which is repeated for each
+selection. This index stores a copy of the particles sorted by the cells
+of a polar (r, phi) grid, and by arrival time within each cell, in a
+file next to the corsika.h5 file. The first row of each cell and the
+range of arrival times in each cell are stored with it, as well as the
+arrival time of every TIME_STEP-th row of the sorted particles.
+
+Selections of an annulus or a box only read the rows of the cells which
+overlap the selection. For a time range only the rows of those cells
+between the stored arrival times around the range are read, cells
+without particles in the requested time range are skipped. The particles
+that are read are then filtered exactly. The index is created the first time it is used for a shower.
+
+Example::
+
+    with GroundParticlesIndex(path) as index:
+        t = index.box(x - 1, x + 1, -1, 1, particle_ids=[3, 4])['t']
+
+"""
+import os
+
+import tables
+
+from numpy import (
+    arange,
+    arctan2,
+    argsort,
+    bincount,
+    concatenate,
+    cumsum,
+    empty,
+    floor,
+    full,
+    hypot,
+    inf,
+    isin,
+    lexsort,
+    logspace,
+    maximum,
+    minimum,
+    pi,
+    unique,
+    where,
+    zeros,
+)
+
+INDEX_FILE = 'groundparticles_index.h5'
+R_EDGES = concatenate(([0.0], logspace(-1, 5, 241)))  # m, 40 bins per decade
+N_PHI = 32
+CHUNK_SIZE = 1_000_000
+TIME_STEP = 100  # rows between the stored arrival times
+
+
+def get_index_path(path):
+    """Path of the index belonging to a corsika.h5 file"""
+
+    return os.path.join(os.path.dirname(path), INDEX_FILE)
+
+
+def get_cells(r, x, y):
+    """Get the cell of the polar grid for particle positions"""
+
+    r_bins = (R_EDGES.searchsorted(r, 'right') - 1).clip(0, len(R_EDGES) - 2)
+    phi_bins = ((arctan2(y, x) + pi) * N_PHI / (2 * pi)).astype(int).clip(0, N_PHI - 1)
+    return r_bins * N_PHI + phi_bins
+
+
+def create_index(path, index_path=None):
+    """Store the ground particles sorted by cell, with the cell offsets
+
+    The particles are sorted in bounded memory. The first pass over the
+    table counts the particles in each cell, consecutive cells are then
+    grouped into partitions of about CHUNK_SIZE particles. The second pass
+    appends the particles of each block of the table to a temporary table
+    per partition. Finally each partition is sorted by cell and arrival
+    time and appended to the index. The groundparticles table is only
+    read in contiguous blocks.
+
+    :param path: path to the corsika.h5 file.
+    :param index_path: path to store the index, by default next to the
+                       corsika.h5 file.
+
+    """
+    if index_path is None:
+        index_path = get_index_path(path)
+    n_cells = (len(R_EDGES) - 1) * N_PHI
+    filters = tables.Filters(complevel=1, complib='blosc')
+
+    with tables.open_file(path, 'r') as data:
+        groundparticles = data.root.groundparticles
+        blocks = range(0, groundparticles.nrows, CHUNK_SIZE)
+
+        counts = zeros(n_cells, dtype='i8')
+        for start in blocks:
+            particles = groundparticles.read(start, start + CHUNK_SIZE)
+            counts += bincount(get_cells(particles['r'], particles['x'], particles['y']), minlength=n_cells)
+        offsets = concatenate(([0], cumsum(counts)))
+        cell_partitions = offsets[:-1] // CHUNK_SIZE
+
+        tmp_path = index_path + '.tmp'
+        partitions_path = index_path + '.partitions.tmp'
+        with tables.open_file(partitions_path, 'w') as partitions:
+            for start in blocks:
+                particles = groundparticles.read(start, start + CHUNK_SIZE)
+                particle_partitions = cell_partitions[get_cells(particles['r'], particles['x'], particles['y'])]
+                order = argsort(particle_partitions, kind='stable')
+                particles = particles[order]
+                numbers, firsts = unique(particle_partitions[order], return_index=True)
+                for number, first, last in zip(numbers, firsts, concatenate((firsts[1:], [len(particles)]))):
+                    name = 'p%d' % number
+                    if name not in partitions.root:
+                        partitions.create_table('/', name, groundparticles.dtype, filters=filters)
+                    partitions.get_node('/', name).append(particles[first:last])
+
+            t_min = full(n_cells, inf)
+            t_max = full(n_cells, -inf)
+            t_samples = []
+            with tables.open_file(tmp_path, 'w') as index:
+                sorted_particles = index.create_table(
+                    '/', 'groundparticles', groundparticles.dtype, expectedrows=groundparticles.nrows, filters=filters
+                )
+                for number in unique(cell_partitions):
+                    name = 'p%d' % number
+                    if name not in partitions.root:
+                        continue
+                    particles = partitions.get_node('/', name).read()
+                    cells = get_cells(particles['r'], particles['x'], particles['y'])
+                    order = lexsort((particles['t'], cells))
+                    particles = particles[order]
+                    cells = cells[order]
+                    filled, firsts = unique(cells, return_index=True)
+                    lasts = concatenate((firsts[1:], [len(cells)])) - 1
+                    t_min[filled] = particles['t'][firsts]
+                    t_max[filled] = particles['t'][lasts]
+                    # Arrival times of the rows which are a multiple of TIME_STEP
+                    first_sample = -sorted_particles.nrows % TIME_STEP
+                    t_samples.append(particles['t'][first_sample::TIME_STEP])
+                    sorted_particles.append(particles)
+                index.create_array('/', 'r_edges', R_EDGES)
+                index.create_array('/', 'offsets', offsets)
+                index.create_array('/', 't_min', t_min)
+                index.create_array('/', 't_max', t_max)
+                index.create_array(
+                    '/', 't_samples', concatenate([empty(0, dtype=groundparticles.coldtypes['t'])] + t_samples)
+                )
+                index.set_node_attr('/', 'n_phi', N_PHI)
+                index.set_node_attr('/', 'time_step', TIME_STEP)
+        os.remove(partitions_path)
+    os.replace(tmp_path, index_path)
+
+
+class GroundParticlesIndex:
+
+    """Select ground particles by position and arrival time
+
+    :param path: path to the corsika.h5 file.
+    :param index_path: path of the index, by default next to the
+                       corsika.h5 file. The index is created if it does
+                       not exist.
+
+    """
+
+    def __init__(self, path, index_path=None):
+        if index_path is None:
+            index_path = get_index_path(path)
+        if not os.path.exists(index_path):
+            create_index(path, index_path)
+
+        self.data = tables.open_file(index_path, 'r')
+        self.groundparticles = self.data.root.groundparticles
+        self.r_edges = self.data.root.r_edges.read()
+        self.offsets = self.data.root.offsets.read()
+        self.t_min = self.data.root.t_min.read()
+        self.t_max = self.data.root.t_max.read()
+        self.n_phi = self.data.get_node_attr('/', 'n_phi')
+        if 't_samples' in self.data.root:
+            self.t_samples = self.data.root.t_samples.read()
+            self.time_step = self.data.get_node_attr('/', 'time_step')
+        else:
+            # Index created without arrival time samples, read entire cells
+            self.t_samples = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def annulus(self, r_min, r_max, t_min=None, t_max=None, particle_ids=None):
+        """Select particles with a core distance in [r_min, r_max)
+
+        :param r_min,r_max: range of core distances.
+        :param t_min,t_max: optional range of arrival times, [t_min, t_max).
+        :param particle_ids: optional list of particle ids to select.
+        :return: array of the selected particles.
+
+        """
+        cells = (self.r_bins(r_min, r_max)[:, None] * self.n_phi + arange(self.n_phi)).ravel()
+        particles = self.read_cells(cells, t_min, t_max)
+        selection = (particles['r'] >= r_min) & (particles['r'] < r_max)
+        return self.select(particles, selection, t_min, t_max, particle_ids)
+
+    def box(self, x_min, x_max, y_min, y_max, t_min=None, t_max=None, particle_ids=None):
+        """Select particles with x in [x_min, x_max] and y in [y_min, y_max]
+
+        :param x_min,x_max,y_min,y_max: bounds of the box.
+        :param t_min,t_max: optional range of arrival times, [t_min, t_max).
+        :param particle_ids: optional list of particle ids to select.
+        :return: array of the selected particles.
+
+        """
+        corners_x = [x_min, x_max, x_min, x_max]
+        corners_y = [y_min, y_min, y_max, y_max]
+        r_min = hypot(max(x_min, -x_max, 0), max(y_min, -y_max, 0))
+        r_max = hypot(corners_x, corners_y).max()
+
+        if r_min == 0:
+            phi_bins = arange(self.n_phi)
+        else:
+            # A box which does not contain the core spans less than pi,
+            # move the angles to [0, 2 pi) if it crosses the negative x axis
+            phi = arctan2(corners_y, corners_x)
+            if x_max < 0 and y_min <= 0 <= y_max:
+                phi = where(phi < 0, phi + 2 * pi, phi)
+            first, last = floor((phi[[phi.argmin(), phi.argmax()]] + pi) * self.n_phi / (2 * pi)).astype(int)
+            phi_bins = arange(first - 1, last + 2) % self.n_phi
+        cells = (self.r_bins(r_min, r_max)[:, None] * self.n_phi + phi_bins).ravel()
+
+        particles = self.read_cells(cells, t_min, t_max)
+        selection = (particles['x'] >= x_min) & (particles['x'] <= x_max)
+        selection &= (particles['y'] >= y_min) & (particles['y'] <= y_max)
+        return self.select(particles, selection, t_min, t_max, particle_ids)
+
+    def time_slice(self, t_min, t_max, r_max=inf, particle_ids=None):
+        """Select particles with an arrival time in [t_min, t_max)"""
+
+        return self.annulus(0, r_max, t_min, t_max, particle_ids)
+
+    def r_bins(self, r_min, r_max):
+        """Get the core distance bins overlapping a range, with a bin margin"""
+
+        n_r = len(self.r_edges) - 1
+        first = max(self.r_edges.searchsorted(r_min, 'right') - 2, 0)
+        last = min(self.r_edges.searchsorted(r_max, 'right'), n_r - 1)
+        return arange(first, last + 1)
+
+    def read_cells(self, cells, t_min=None, t_max=None):
+        """Read the particles in cells, skipping rows outside the time range
+
+        The particles in a cell are sorted by arrival time. The stored
+        arrival times of every time_step-th row limit the rows of each
+        cell to those around the time range. Consecutive ranges of rows
+        are read with a single read.
+
+        """
+        cells = unique(cells)
+        keep = self.offsets[cells + 1] > self.offsets[cells]
+        if t_min is not None:
+            keep &= self.t_max[cells] >= t_min
+        if t_max is not None:
+            keep &= self.t_min[cells] < t_max
+        cells = cells[keep]
+
+        starts = self.offsets[cells]
+        stops = self.offsets[cells + 1]
+        if self.t_samples is not None and (t_min is not None or t_max is not None):
+            # Samples of the rows in each cell are k_first <= k < k_last
+            k_first = -(-starts // self.time_step)
+            k_last = -(-stops // self.time_step)
+            if t_min is not None:
+                # The first n_below samples of a cell, and all rows up to them, are before t_min
+                below = concatenate(([0], cumsum(self.t_samples < t_min)))
+                n_below = below[k_last] - below[k_first]
+                starts = where(n_below > 0, maximum(starts, (k_first + n_below - 1) * self.time_step + 1), starts)
+            if t_max is not None:
+                # Rows from the first sample at or after t_max are not needed
+                below = concatenate(([0], cumsum(self.t_samples < t_max)))
+                n_below = below[k_last] - below[k_first]
+                stops = where(k_first + n_below < k_last, minimum(stops, (k_first + n_below) * self.time_step), stops)
+            keep = stops > starts
+            starts = starts[keep]
+            stops = stops[keep]
+        particles = [empty(0, dtype=self.groundparticles.dtype)]
+        if not len(starts):
+            return particles[0]
+        new_range = concatenate(([True], starts[1:] != stops[:-1]))
+        end_range = concatenate((new_range[1:], [True]))
+        for start, stop in zip(starts[new_range], stops[end_range]):
+            particles.append(self.groundparticles.read(start, stop))
+        return concatenate(particles)
+
+    def select(self, particles, selection, t_min=None, t_max=None, particle_ids=None):
+        """Apply the time range and particle ids to a selection"""
+
+        if t_min is not None:
+            selection &= particles['t'] >= t_min
+        if t_max is not None:
+            selection &= particles['t'] < t_max
+        if particle_ids is not None:
+            selection &= isin(particles['particle_id'], list(particle_ids))
+        return particles[selection]
@@ -4,6 +4,8 @@ from numpy import histogram, linspace
 
 from artist import Plot
 
+from .coincidence_mask import get_coincidence_mask
+
 STATIONS = [501, 510]
 EVENTDATA_PATH = '/Users/arne/Datastore/501_510/e_501_510_141101_150201.h5'
 
@@ -22,11 +24,10 @@ def anti_coincidences(data):
     colors = ['red', 'blue']
     linestyles = ['solid', 'dashed']
     for s_id, s_path in enumerate(data.root.coincidences.s_index):
-        events = data.get_node(s_path, 'events')
+        s_path = s_path.decode('utf-8')
+        all_events = data.get_node(s_path, 'events').read()
         # Get all events which are in a coincidence
-        ceids = [e_idx for c_idx in data.root.coincidences.c_index for s_idx, e_idx in c_idx if s_idx == s_id]
-        coin_events = events.read_coordinates(ceids)
-        all_events = events.read()
+        coin_events = all_events[get_coincidence_mask(data, s_path)]
 
         bins = linspace(0.01, 40, 300)
         # Should filter -999 values, but there are only ~60 of those.
@@ -60,5 +61,5 @@ def anti_coincidences(data):
 
 
 if __name__ == '__main__':
-    with tables.open_file(EVENTDATA_PATH, 'r') as data:
+    with tables.open_file(EVENTDATA_PATH, 'a') as data:
         anti_coincidences(data)
@@ -0,0 +1,84 @@
+"""Masks of the events of each station which are part of a coincidence
+
+The c_index of the coincidences refers to events by station and event
+index. Finding the events of a station which are (not) in a coincidence
+requires going through all coincidences. This module does that once and
+stores a boolean array with an element for each event, next to the
+events table of each station.
+
+The stored mask is rebuilt when the number of coincidences or events has
+changed. If the data file is opened read-only the mask is only built in
+memory.
+
+Example::
+
+    mask = get_coincidence_mask(data, '/s501')
+    coincident_events = events.read()[mask]
+    anti_coincident_events = events.read()[~mask]
+
+"""
+from numpy import concatenate, empty, uint32, zeros
+
+MASK = 'in_coincidence'
+
+
+def build_coincidence_masks(data, coincidences='/coincidences'):
+    """Build the masks of all stations in the s_index
+
+    :param data: the PyTables data file.
+    :param coincidences: path to the coincidences group.
+    :return: dictionary with the mask for each station path.
+
+    """
+    group = data.get_node(coincidences)
+    c_index = concatenate([empty((0, 2), dtype=uint32)] + group.c_index.read())
+    masks = {}
+    for s_idx, s_path in enumerate(group.s_index):
+        s_path = s_path.decode('utf-8')
+        mask = zeros(data.get_node(s_path, 'events').nrows, dtype=bool)
+        mask[c_index[c_index[:, 0] == s_idx, 1]] = True
+        masks[s_path] = mask
+    return masks
+
+
+def is_up_to_date(data, s_path, coincidences='/coincidences'):
+    """Check if the stored mask matches the current coincidences and events"""
+
+    if MASK not in data.get_node(s_path):
+        return False
+    mask = data.get_node(s_path, MASK)
+    n_coincidences = data.get_node(coincidences, 'c_index').nrows
+    return mask.attrs.n_coincidences == n_coincidences and mask.nrows == data.get_node(s_path, 'events').nrows
+
+
+def store_coincidence_masks(data, coincidences='/coincidences'):
+    """Build and store the masks of all stations in the s_index"""
+
+    n_coincidences = data.get_node(coincidences, 'c_index').nrows
+    masks = build_coincidence_masks(data, coincidences)
+    for s_path, mask in masks.items():
+        if MASK in data.get_node(s_path):
+            data.remove_node(s_path, MASK)
+        stored_mask = data.create_array(s_path, MASK, mask)
+        stored_mask.attrs.n_coincidences = n_coincidences
+    data.flush()
+    return masks
+
+
+def get_coincidence_mask(data, s_path, coincidences='/coincidences'):
+    """Get the mask of events in coincidence for a station
+
+    The stored mask is used if it is up to date, otherwise the masks of
+    all stations are built and stored if the file is writable.
+
+    :param data: the PyTables data file.
+    :param s_path: path to the station group, as in the s_index.
+    :param coincidences: path to the coincidences group.
+    :return: boolean array with an element for each event.
+
+    """
+    if is_up_to_date(data, s_path, coincidences):
+        return data.get_node(s_path, MASK).read()
+    if data.mode == 'r':
+        return build_coincidence_masks(data, coincidences)[s_path]
+    return store_coincidence_masks(data, coincidences)[s_path]
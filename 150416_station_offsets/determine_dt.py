@@ -7,17 +7,30 @@ For various combinations of stations in compact clusters
 
 """
 import multiprocessing
-import os
 
 from datetime import datetime
 
 import tables
 
-from numpy import isnan
+from numpy import (
+    array,
+    bincount,
+    column_stack,
+    concatenate,
+    empty,
+    fmin,
+    isin,
+    isnan,
+    minimum,
+    nan,
+    ones,
+    repeat,
+    zeros,
+)
 
 from sapphire import CoincidenceQuery, Station
-from sapphire.analysis.event_utils import station_arrival_time
 from sapphire.transformations.clock import datetime_to_gps
+from sapphire.utils import ERR
 
 from .station_distances import close_pairs_in_network
 
@@ -41,83 +54,181 @@ class DeltaVal(tables.IsDescription):
     delta = tables.FloatCol(pos=3)
 
 
-def determine_time_differences(coin_events, ref_station, station, ref_d_off, d_off):
+def coincidence_events(cq, stations, start=None, stop=None):
+    """Get the events of a pair of stations in their coincidences
+
+    The coincidence indexes are read in one go and the events of each
+    station are read with a single read_coordinates. Coincidences with
+    more than one event from a station are skipped.
+
+    :param cq: CoincidenceQuery for the pair data.
+    :param stations: tuple of reference station number and station number.
+    :param start,stop: timestamps between which to get coincidences.
+    :return: arrays of the reference station events and the station events,
+             aligned per coincidence.
+
+    """
+    ref_s_idx, s_idx = (cq.s_numbers.index(station) for station in stations)
+    ref_events = cq.s_nodes[ref_s_idx].events
+    events = cq.s_nodes[s_idx].events
+
+    coincidence_ids = cq.all(stations, start=start, stop=stop)['id']
+    if not len(coincidence_ids):
+        return ref_events[:0], events[:0]
+    first_id = coincidence_ids.min()
+    c_index = cq.c_index.read(first_id, coincidence_ids.max() + 1)
+    c_index = [c_index[c_id - first_id] for c_id in coincidence_ids]
+
+    # Flat (s_idx, e_idx) pairs with the number of the coincidence they belong to
+    indexes = concatenate(c_index)
+    coincidence = repeat(range(len(c_index)), [len(c_idx) for c_idx in c_index])
+
+    event_idx = []
+    single = ones(len(c_index), dtype=bool)
+    for station_idx in (ref_s_idx, s_idx):
+        is_station = indexes[:, 0] == station_idx
+        single &= bincount(coincidence[is_station], minlength=len(c_index)) == 1
+        e_idx = zeros(len(c_index), dtype=int)
+        e_idx[coincidence[is_station]] = indexes[is_station, 1]
+        event_idx.append(e_idx)
+
+    return ref_events.read_coordinates(event_idx[0][single]), events.read_coordinates(event_idx[1][single])
+
+
+def station_arrival_times(events, reference_ext_timestamps, offsets):
+    """Get the station arrival times for an array of events
+
+    Vectorized version of ``station_arrival_time`` from SAPPHiRE, using
+    all four detectors. Detectors without arrival time are ignored.
+
+    :param events: array of events of a station.
+    :param reference_ext_timestamps: reference extended timestamps (in ns)
+        for each event. The returned arrival times are relative to these.
+    :param offsets: detector timing offsets sorted by timestamp, with the
+        columns timestamp and offset1 through offset4.
+    :return: station arrival times relative to the reference timestamps,
+             NaN where no arrival time could be determined.
+
+    """
+    # Same offset index as get_active_index
+    offset_idx = offsets['timestamp'].searchsorted(reference_ext_timestamps / 1_000_000_000, side='right') - 1
+    offset_idx = offset_idx.clip(0)
+
+    detector_times = column_stack([events['t%d' % id] for id in range(1, 5)]).astype(float)
+    detector_times[isin(detector_times, ERR)] = nan
+    detector_times -= column_stack([offsets['offset%d' % id][offset_idx] for id in range(1, 5)])
+    t_first = fmin.reduce(detector_times, axis=1)
+
+    ext_timestamp_diff = events['ext_timestamp'].astype('i8') - reference_ext_timestamps.astype('i8')
+    t = ext_timestamp_diff - events['t_trigger'] + t_first
+    t[isin(events['t_trigger'], ERR)] = nan
+    return t
+
+
+def determine_time_differences(ref_events, events, ref_offsets, offsets):
     """Determine the arrival time differences between two stations.
 
-    :param coin_events: coincidence events.
-    :param ref_station,station: station numbers.
-    :param ref_d_off,d_off: `detector_timing_offset` methods of Station objects
-        for the two stations, to retrieve applicable offsets.
-    :return: extended timestamp of the first event and time difference,
-             t - t_ref. Not corrected for altitude differences.
+    :param ref_events,events: arrays of events of the reference station
+        and of the other station, aligned per coincidence.
+    :param ref_offsets,offsets: detector timing offsets of the two stations,
+        sorted by timestamp.
+    :return: extended timestamp of the first event, arrival times t and
+             t_ref relative to that timestamp, and the time difference
+             t - t_ref. Not corrected for altitude differences. Values
+             which could not be determined are NaN.
+
+    """
+    ets = minimum(ref_events['ext_timestamp'], events['ext_timestamp'])
+    ref_t = station_arrival_times(ref_events, ets, ref_offsets)
+    t = station_arrival_times(events, ets, offsets)
+    return ets, t, ref_t, t - ref_t
+
+
+def store_dt(table, ext_timestamps, deltats, processed_until):
+    """Store determined dt values
+
+    The values are appended to the table in one go, after which the end of
+    the processed period is recorded in the table attributes.
+
+    :param table: table in which to store the dt values.
+    :param ext_timestamps,deltats: the dt values and their timestamps.
+    :param processed_until: extended timestamp up to which the
+                            coincidences have been processed.
+
+    """
+    ext_timestamps = array(ext_timestamps, dtype='u8')
+    delta_rows = empty(len(ext_timestamps), dtype=table.dtype)
+    delta_rows['ext_timestamp'] = ext_timestamps
+    delta_rows['timestamp'], delta_rows['nanoseconds'] = divmod(ext_timestamps, 1_000_000_000)
+    delta_rows['delta'] = deltats
+    table.append(delta_rows)
+    table.attrs.processed_until = processed_until
+    table.flush()
+
+
+def get_dt_table(data, station):
+    """Get the dt table, prepared to continue processing
+
+    Rows stored after the recorded end of the processed period, from an
+    interrupted run, are removed. For tables without a recorded end the
+    last stored timestamp is used.
+
+    :param data: open dt data file.
+    :param station: station number of the non-reference station.
+    :return: the table and the extended timestamp up to which the
+             coincidences have been processed.
 
     """
-    dt = []
-    ets = []
-    for events in coin_events:
-        ref_ets = events[0][1]['ext_timestamp']
-        ref_ts = ref_ets / 1_000_000_000
-        # Filter for possibility of same station twice in coincidence
-        if len(events) != 2:
-            continue
-        if events[0][0] == ref_station:
-            ref_id = 0
-            id = 1
-        else:
-            ref_id = 1
-            id = 0
-        ref_t = station_arrival_time(events[ref_id][1], ref_ets, [0, 1, 2, 3], ref_d_off(ref_ts))
-        t = station_arrival_time(events[id][1], ref_ets, [0, 1, 2, 3], d_off(ref_ts))
-        if isnan(t) or isnan(ref_t):
-            continue
-        dt.append(t - ref_t)
-        ets.append(ref_ets)
-    return ets, dt
-
-
-def store_dt(ref_station, station, ext_timestamps, deltats):
-    """Store determined dt values"""
-    path = DATA_PATH + 'dt_ref%d_%d.h5' % (ref_station, station)
-    with tables.open_file(path, 'a') as data:
-        try:
-            table = data.get_node('/s%d' % station)
-        except tables.NoSuchNodeError:
-            table = data.create_table('/', 's%d' % station, DeltaVal, createparents=True)
-        for ets, deltat in zip(ext_timestamps, deltats):
-            delta_row = table.row
-            delta_row['ext_timestamp'] = ets
-            delta_row['timestamp'] = int(ets) / 1_000_000_000
-            delta_row['nanoseconds'] = int(ets) - ((int(ets) / 1_000_000_000) * 1_000_000_000)
-            delta_row['delta'] = deltat
-            delta_row.append()
-        table.flush()
-
-
-def determine_dt_for_pair(stations):
+    try:
+        table = data.get_node('/s%d' % station)
+    except tables.NoSuchNodeError:
+        table = data.create_table('/', 's%d' % station, DeltaVal, createparents=True)
+
+    if 'processed_until' in table.attrs:
+        processed_until = int(table.attrs.processed_until)
+        unprocessed = (table.col('ext_timestamp') >= processed_until).nonzero()[0]
+        if len(unprocessed):
+            table.remove_rows(unprocessed[0])
+    elif table.nrows:
+        processed_until = int(table.col('ext_timestamp').max()) + 1
+    else:
+        processed_until = 0
+    return table, processed_until
+
+
+def determine_dt_for_pair(stations, end=None):
     """Determine and store dt for a pair of stations
 
-    :param ref_station: reference station number to use as refernece
-    :param station: station number to determine the dt for
+    Only months after the previously processed period are processed, so
+    rerunning this updates the dt with the newly available months.
+
+    :param stations: tuple of the reference station number, to use as
+                     reference, and the station number to determine the
+                     dt for.
+    :param end: year, month tuple of the month up to which to process,
+                defaults to the current month.
 
     """
-    path = DATA_PATH + 'dt_ref%d_%d.h5' % stations
-    if os.path.exists(path):
-        print('dt data already exists for %d-%d' % stations)
-        return
+    if end is None:
+        today = datetime.utcnow()
+        end = (today.year, today.month)
 
+    pair_path = PAIR_DATAPATH % tuple(sorted(stations))
+    path = DATA_PATH + 'dt_ref%d_%d.h5' % stations
     ref_station, station = stations
     try:
-        with tables.open_file(PAIR_DATAPATH % tuple(sorted(stations)), 'r') as data:
+        with tables.open_file(pair_path, 'r') as data, tables.open_file(path, 'a') as dt_data:
+            table, processed_until = get_dt_table(dt_data, station)
             cq = CoincidenceQuery(data)
-            ref_detector_offsets = Station(ref_station).detector_timing_offset
-            detector_offsets = Station(station).detector_timing_offset
-            for dt0, dt1 in monthrange((2004, 1), (2015, 9)):
-                coins = cq.all(stations, start=dt0, stop=dt1, iterator=True)
-                coin_events = cq.events_from_stations(coins, stations)
-                ets, dt = determine_time_differences(
-                    coin_events, ref_station, station, ref_detector_offsets, detector_offsets
-                )
-                store_dt(ref_station, station, ets, dt)
+            ref_detector_offsets = Station(ref_station).detector_timing_offsets
+            detector_offsets = Station(station).detector_timing_offsets
+            for dt0, dt1 in monthrange((2004, 1), end):
+                if dt0 * 1_000_000_000 < processed_until:
+                    continue
+                ref_events, events = coincidence_events(cq, stations, start=dt0, stop=dt1)
+                ets, _, _, dt = determine_time_differences(ref_events, events, ref_detector_offsets, detector_offsets)
+                valid = ~isnan(dt)
+                store_dt(table, ets[valid], dt[valid], dt1 * 1_000_000_000)
     except Exception as e:
         print('Failed for %d, %d' % stations)
         print(e)
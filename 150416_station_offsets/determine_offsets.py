@@ -5,17 +5,23 @@ For various combinations of stations in compact clusters
 - First determine dt for each station pair coincidence once
 - Use detector offsets from API
 
+The dt of a station pair are read once, the windows for each step are
+found with searchsorted on the timestamps, so overlapping windows use
+the same data. The station geometry is only evaluated once for each
+period in which the station and detector positions are constant.
+
+The offsets of all pairs are stored in a table per pair in OFFSETS_PATH.
+
 """
-import csv
 import multiprocessing
 import re
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from glob import glob
 
 import tables
 
-from numpy import nan
+from numpy import arange, argsort, array, concatenate, empty, maximum, nan, unique
 
 from sapphire import HiSPARCNetwork, HiSPARCStations
 from sapphire.analysis.calibration import determine_station_timing_offset
@@ -29,14 +35,24 @@ Reference stations
 
 SPA_STAT = [501, 502, 503, 504, 505, 506, 508, 509, 510]
 CLUSTER = HiSPARCStations(SPA_STAT)
-DATA_PATH = '/Users/arne/Datastore/station_offsets/offsets_ref%d_s%d.tsv'
+OFFSETS_PATH = '/Users/arne/Datastore/station_offsets/offsets.h5'
+OFFSETS_TABLE = 'offsets_ref%d_s%d'
 DAYS = 10
+STEP = 10 * 86400
+START = datetime(2010, 1, 1)
+END = datetime(2015, 4, 1)
 
 DT_DATAPATH_GLOB = '/Users/arne/Datastore/station_offsets/dt_ref*_*.h5'
 DT_DATAPATH = '/Users/arne/Datastore/station_offsets/dt_ref%d_%d.h5'
 CLUSTER = HiSPARCNetwork()
 
 
+class StationOffset(tables.IsDescription):
+    timestamp = tables.UInt32Col(pos=0)
+    offset = tables.FloatCol(pos=1)
+    error = tables.FloatCol(pos=2)
+
+
 def get_available_station_pairs():
     paths = glob(DT_DATAPATH_GLOB)
     pairs = [(int(s1), int(s2)) for s1, s2 in [re.findall(r'\d+', path[:-3]) for path in paths]]
@@ -44,43 +60,89 @@ def get_available_station_pairs():
 
 
 def determine_offsets():
+    """Determine the offsets of all pairs and store them in one file"""
+
     args = get_available_station_pairs()
     worker_pool = multiprocessing.Pool()
-    worker_pool.map(determine_offsets_for_pair, args)
+    with tables.open_file(OFFSETS_PATH, 'a') as data:
+        for ref_station, station, offsets in worker_pool.imap_unordered(determine_offsets_for_pair, args):
+            write_offsets(data, station, ref_station, offsets)
     worker_pool.close()
     worker_pool.join()
 
 
+def pair_geometry(ref_station, station, timestamps):
+    """Get the distance and height difference of a station pair over time
+
+    The positions of the stations and detectors only change at a few
+    timestamps, the geometry is calculated once for each of those.
+
+    :param ref_station,station: station numbers.
+    :param timestamps: timestamps at which to get the geometry.
+    :return: distance r and height difference dz (z - z_ref) at each
+             timestamp.
+
+    """
+    stations = [CLUSTER.get_station(ref_station), CLUSTER.get_station(station)]
+    changes = unique(
+        concatenate([s.timestamps for s in stations] + [d.timestamps for s in stations for d in s.detectors])
+    )
+    periods = (changes.searchsorted(timestamps, 'right') - 1).clip(min=0)
+
+    r = empty(len(timestamps))
+    dz = empty(len(timestamps))
+    for period in unique(periods):
+        CLUSTER.set_timestamp(changes[period])
+        selection = periods == period
+        r[selection], _, dz[selection] = CLUSTER.calc_rphiz_for_stations(stations[0].station_id, stations[1].station_id)
+    return r, dz
+
+
 def determine_offsets_for_pair(stations):
+    """Determine the station offsets in sliding windows over the dt
+
+    :param stations: tuple of the reference station number and the
+                     station number.
+    :return: the station numbers and array of the timestamps, offsets
+             and errors of the offsets.
+
+    """
     ref_station, station = stations
     path = DT_DATAPATH % (ref_station, station)
     with tables.open_file(path, 'r') as data:
         table = data.get_node('/s%d' % station)
-        offsets = []
-        start = datetime(2010, 1, 1)
-        end = datetime(2015, 4, 1)
-        for dt0 in (start + timedelta(days=x) for x in range(0, (end - start).days, 10)):
-            ts0 = datetime_to_gps(dt0)
-            CLUSTER.set_timestamp(ts0)
-            # dz is z - z_ref
-            r, _, dz = CLUSTER.calc_rphiz_for_stations(
-                CLUSTER.get_station(ref_station).station_id, CLUSTER.get_station(station).station_id
-            )
-            ts1 = datetime_to_gps(dt0 + timedelta(days=max(int(r**1.12 / DAYS), 7)))
-            dt = table.read_where('(timestamp >= ts0) & (timestamp < ts1)', field='delta')
-            if len(dt) < 100:
-                s_off = nan
-            else:
-                s_off = determine_station_timing_offset(dt, dz)
-            offsets.append((ts0, s_off))
-        write_offets(station, ref_station, offsets)
-
-
-def write_offets(station, ref_station, offsets):
-    path = DATA_PATH % (ref_station, station)
-    with open(path, 'wb') as output:
-        csvwriter = csv.writer(output, delimiter='\t')
-        csvwriter.writerows((ts, offset) for ts, offset in offsets)
+        timestamps = table.col('timestamp')
+        dt = table.col('delta')
+    if (timestamps[1:] < timestamps[:-1]).any():
+        order = argsort(timestamps, kind='stable')
+        timestamps = timestamps[order]
+        dt = dt[order]
+
+    ts0 = arange(datetime_to_gps(START), datetime_to_gps(END), STEP)
+    r, dz = pair_geometry(ref_station, station, ts0)
+    ts1 = ts0 + maximum((r**1.12 / DAYS).astype(int), 7) * 86400
+    starts = timestamps.searchsorted(ts0)
+    stops = timestamps.searchsorted(ts1)
+
+    offsets = empty(len(ts0), dtype=[('timestamp', 'u4'), ('offset', 'f8'), ('error', 'f8')])
+    offsets['timestamp'] = ts0
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        if stop - start < 100:
+            offsets[['offset', 'error']][i] = (nan, nan)
+        else:
+            offsets[['offset', 'error']][i] = determine_station_timing_offset(dt[start:stop], dz[i])
+    return ref_station, station, offsets
+
+
+def write_offsets(data, station, ref_station, offsets):
+    """Store the offsets of a pair, replacing previous offsets"""
+
+    name = OFFSETS_TABLE % (ref_station, station)
+    if name in data.root:
+        data.remove_node('/', name)
+    table = data.create_table('/', name, StationOffset, expectedrows=len(offsets))
+    table.append(array(offsets, dtype=table.dtype))
+    table.flush()
 
 
 if __name__ == '__main__':
@@ -1,25 +1,26 @@
 """Show overall offset distribution
 """
 
-from glob import glob
+import tables
 
-from numpy import arange, genfromtxt, histogram, isnan
+from numpy import arange, histogram, isnan
 from scipy.optimize import curve_fit
 
 from artist import Plot
 
 from sapphire.utils import gauss
 
-OFF_DATAPATH_GLOB = '/Users/arne/Datastore/station_offsets/offsets_ref*_s*.tsv'
+OFFSETS_PATH = '/Users/arne/Datastore/station_offsets/offsets.h5'
 
 
 def plot_distribution():
     offsets = []
-    for path in glob(OFF_DATAPATH_GLOB):
-        data = genfromtxt(path)
-        fdata = data[~isnan(data[:, 1]), 1]
-        if len(fdata):
-            offsets.append(fdata[-1])
+    with tables.open_file(OFFSETS_PATH, 'r') as data:
+        for table in data.list_nodes('/'):
+            offset = table.col('offset')
+            fdata = offset[~isnan(offset)]
+            if len(fdata):
+                offsets.append(fdata[-1])
     mindt = -200
     maxdt = 200
     plot = Plot()
@@ -18,9 +18,8 @@ Causes for changing offsets at some points:
 import re
 
 from datetime import date
-from glob import glob
 
-from numpy import genfromtxt
+import tables
 
 from artist import Plot
 
@@ -28,18 +27,20 @@ from sapphire.api import Station
 from sapphire.transformations.clock import datetime_to_gps
 
 STATIONS = [501, 502, 503, 504, 505, 506, 508, 509, 510]
-OFF_DATAPATH_GLOB = '/Users/arne/Datastore/station_offsets/offsets_ref*_s*.tsv'
-DATA_PATH = '/Users/arne/Datastore/station_offsets/offsets_ref%d_s%d.tsv'
+OFFSETS_PATH = '/Users/arne/Datastore/station_offsets/offsets.h5'
+OFFSETS_TABLE = 'offsets_ref%d_s%d'
 
 
 def get_available_station_pairs():
-    paths = glob(OFF_DATAPATH_GLOB)
-    pairs = [(int(s1), int(s2)) for s1, s2 in [re.findall(r'\d+', path) for path in paths]]
+    with tables.open_file(OFFSETS_PATH, 'r') as data:
+        names = [table._v_name for table in data.list_nodes('/')]
+    pairs = [(int(s1), int(s2)) for s1, s2 in [re.findall(r'\d+', name) for name in names]]
     return pairs
 
 
 def get_station_offsets(ref_station, station):
-    offsets = genfromtxt(DATA_PATH % (ref_station, station), delimiter='\t', names=('timestamp', 'offset'))
+    with tables.open_file(OFFSETS_PATH, 'r') as data:
+        offsets = data.get_node('/', OFFSETS_TABLE % (ref_station, station)).read()
     return offsets
 
 
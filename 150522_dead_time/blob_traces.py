@@ -0,0 +1 @@
+../131108_trigger_adc/blob_traces.py
\ No newline at end of file
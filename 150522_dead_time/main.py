@@ -1,5 +1,3 @@
-import zlib
-
 from datetime import datetime
 
 import numpy as np
@@ -9,6 +7,8 @@ from artist import Plot
 
 from sapphire.publicdb import download_data
 
+from .blob_traces import decode_blob
+
 DATA = '/Users/arne/Datastore/dead_time.h5'
 STATION = 99
 TESTS = (
@@ -63,13 +63,7 @@ def plot_traces():
             for e_idx in [0, 1]:
                 t_idx = events[e_idx]['traces'][1]
                 extts = events[e_idx]['ext_timestamp']
-                try:
-                    trace = zlib.decompress(blobs[t_idx]).split(',')
-                except zlib.error:
-                    trace = zlib.decompress(blobs[t_idx][1:-1]).split(',')
-                if trace[-1] == '':
-                    del trace[-1]
-                trace = [int(x) for x in trace]
+                trace = decode_blob(blobs[t_idx])
                 plot = Plot()
                 plot.plot(list(range(len(trace))), trace, mark=None)
                 plot.set_label('%d' % extts)
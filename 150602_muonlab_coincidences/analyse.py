@@ -3,7 +3,7 @@ import tables
 
 from artist import Plot
 
-from sapphire import CoincidenceQuery
+from .coincidence_mask import get_coincidence_mask
 
 EVENTDATA_PATHS = [
     '/Users/arne/Datastore/muonlab_test.h5',
@@ -15,13 +15,10 @@ EVENTDATA_PATHS = [
 def analyse(data, id):
     event_node = data.get_node('/station_99/events')
     print('Total number of events: %d' % event_node.nrows)
-    cq = CoincidenceQuery(data)
-    coincidences = cq.all(stations=[99])
-    coincident_events = cq.events_from_stations(coincidences, [99], n=1)
-    coincident_event_ids = [e[0][1]['event_id'] for e in coincident_events]
-    event_ids = [i for i in range(event_node.nrows) if i not in coincident_event_ids]
-    events = event_node.read_coordinates(event_ids)
-    coincident_events = event_node.read_coordinates(coincident_event_ids)
+    in_coincidence = get_coincidence_mask(data, '/station_99')
+    all_events = event_node.read()
+    events = all_events[~in_coincidence]
+    coincident_events = all_events[in_coincidence]
     print('Total number of events not in coincidence: %d' % len(events))
     print('Total number of events in coincidence: %d' % len(coincident_events))
 
@@ -55,5 +52,5 @@ def analyse(data, id):
 
 if __name__ == '__main__':
     for id, data_path in enumerate(EVENTDATA_PATHS):
-        with tables.open_file(data_path, 'r') as data:
+        with tables.open_file(data_path, 'a') as data:
             analyse(data, id)
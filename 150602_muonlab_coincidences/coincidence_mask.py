@@ -0,0 +1 @@
+../150224_501_510/coincidence_mask.py
\ No newline at end of file
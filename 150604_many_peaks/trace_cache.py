@@ -0,0 +1 @@
+../151206_event_overlap/trace_cache.py
\ No newline at end of file
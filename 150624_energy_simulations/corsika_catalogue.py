@@ -0,0 +1,116 @@
+"""Lookups of simulations in the CORSIKA overview
+
+The simulations table of the overview is read once, simulations are then
+selected by energy, zenith and primary particle with array comparisons
+and looked up by seed in a dictionary. Many seeds can be looked up at
+once, instead of querying the overview for each seed.
+
+The catalogue does not need column indexes. Run this module to add
+column indexes for the selection columns to the overview, which speeds
+up queries on the overview by other scripts.
+
+Example::
+
+    catalogue = get_catalogue(OVERVIEW)
+    seeds = catalogue.seeds(catalogue.select(log_energy=16, zenith=0.0, particle_id=14))
+    simulations = catalogue.lookup(seeds)
+
+"""
+import os
+
+from functools import lru_cache
+
+import tables
+
+from numpy import log10, ones
+
+OVERVIEW = '/data/hisparc/corsika/corsika_overview.h5'
+INDEXED_COLUMNS = ['energy', 'zenith', 'particle_id', 'seed1', 'seed2']
+
+
+def create_indexes(path, columns=INDEXED_COLUMNS):
+    """Create column indexes for the simulations table, if possible
+
+    :return: boolean indicating if the columns are indexed.
+
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        with tables.open_file(path, 'r+') as overview:
+            sims = overview.get_node('/simulations')
+            for column in columns:
+                if not sims.colinstances[column].is_indexed:
+                    sims.colinstances[column].create_index()
+    except (OSError, tables.HDF5ExtError, tables.NoSuchNodeError):
+        return False
+    return True
+
+
+@lru_cache()
+def get_catalogue(path=OVERVIEW):
+    """Get the catalogue for an overview, it is only read once"""
+
+    return CorsikaCatalogue(path)
+
+
+class CorsikaCatalogue:
+
+    """Simulations in a CORSIKA overview
+
+    :param path: path to the CORSIKA overview.
+
+    """
+
+    def __init__(self, path=OVERVIEW):
+        with tables.open_file(path, 'r') as overview:
+            self.simulations = overview.get_node('/simulations').read()
+        self.rows = {seed: row for row, seed in enumerate(self.seeds(self.simulations))}
+
+    def __contains__(self, seed):
+        return seed in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def seeds(self, simulations):
+        """Get combined seeds for a set of simulations"""
+
+        return ['%d_%d' % (seed1, seed2) for seed1, seed2 in zip(simulations['seed1'], simulations['seed2'])]
+
+    def get(self, seed):
+        """Get the simulation for a combined seed"""
+
+        return self.simulations[self.rows[seed]]
+
+    def lookup(self, seeds):
+        """Get the simulations for many combined seeds at once
+
+        :param seeds: list of combined seeds.
+        :return: array of the simulations, in the order of the seeds.
+
+        """
+        return self.simulations[[self.rows[seed] for seed in seeds]]
+
+    def select(self, log_energy=None, zenith=None, particle_id=None):
+        """Select simulations by energy, zenith and primary particle
+
+        :param log_energy: log10 of the energy in eV.
+        :param zenith: zenith angle in radians.
+        :param particle_id: id of the primary particle.
+        :return: array of the matching simulations.
+
+        """
+        selection = ones(len(self.simulations), dtype=bool)
+        if log_energy is not None:
+            selection &= log10(self.simulations['energy']) == log_energy
+        if zenith is not None:
+            selection &= self.simulations['zenith'] == zenith
+        if particle_id is not None:
+            selection &= self.simulations['particle_id'] == particle_id
+        return self.simulations[selection]
+
+
+if __name__ == "__main__":
+    if not create_indexes(OVERVIEW):
+        print('Could not index the overview', OVERVIEW)
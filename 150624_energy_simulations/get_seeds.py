@@ -3,10 +3,10 @@ import os
 
 from random import sample
 
-import tables
-
 from numpy import log10
 
+from .corsika_catalogue import get_catalogue
+
 OVERVIEW = '/data/hisparc/corsika/corsika_overview.h5'
 DATADIR = '/data/hisparc/corsika/data'
 
@@ -22,17 +22,15 @@ def seeds_processed():
 if __name__ == "__main__":
     available_seeds = seeds_processed()
     seeds = []
-    with tables.open_file(OVERVIEW) as overview:
-        sims = overview.get_node('/simulations')
-        for e in set(log10(sims.col('energy'))):
-            for z in set(sims.read_where('log10(energy) == e')['zenith']):
-                selection = sims.read_where('(log10(energy) == e) & ' '(zenith == z) & ' '(particle_id == 14)')
-                selected_seeds = ['%d_%d' % (row['seed1'], row['seed2']) for row in selection]
-                possible_seeds = available_seeds.intersection(selected_seeds)
-                if len(possible_seeds):
-                    seeds.append(sample(possible_seeds, 1)[0])
-                else:
-                    print('no suitable shower for E={}, z={:.2f}'.format(e, z))
+    catalogue = get_catalogue(OVERVIEW)
+    for e in set(log10(catalogue.simulations['energy'])):
+        for z in set(catalogue.select(log_energy=e)['zenith']):
+            selection = catalogue.select(log_energy=e, zenith=z, particle_id=14)
+            possible_seeds = available_seeds.intersection(catalogue.seeds(selection))
+            if len(possible_seeds):
+                seeds.append(sample(sorted(possible_seeds), 1)[0])
+            else:
+                print('no suitable shower for E={}, z={:.2f}'.format(e, z))
 
     with open('seed_list.txt', 'w') as seed_list:
         for seed in seeds:
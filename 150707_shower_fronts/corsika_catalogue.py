@@ -0,0 +1 @@
+../150624_energy_simulations/corsika_catalogue.py
\ No newline at end of file
@@ -6,40 +6,47 @@ from numpy import arange, isnan, load, mean, median, nan, save, std
 
 from artist import Plot
 
+from .corsika_catalogue import get_catalogue
+from .groundparticles_index import GroundParticlesIndex
+
 OVERVIEW = '/data/hisparc/corsika/corsika_overview.h5'
 LOCAL_STORE = '/data/hisparc/corsika/data/{seed}/corsika.h5'
+PARTICLE_IDS = [2, 3, 4, 5, 6]
 CORE_DISTANCES = [3, 5, 7, 10, 20, 30, 50, 70, 100, 200, 300, 400, 500]
 ENERGIES = arange(15, 18, 1)
 
 
 def select_showers(e):
-    with tables.open_file(OVERVIEW, 'r') as overview:
-        sims = overview.get_node('/simulations')
-        selection = sims.read_where('(log10(energy) == e) & ' '(zenith == 0.) & ' '(particle_id == 14)')
-        for shower in selection:
-            yield '%d_%d' % (shower['seed1'], shower['seed2'])
+    catalogue = get_catalogue(OVERVIEW)
+    selection = catalogue.select(log_energy=e, zenith=0.0, particle_id=14)
+    yield from catalogue.seeds(selection)
 
 
 def get_first_median_particles(seed, x):
     path = LOCAL_STORE.format(seed=seed)
     detector_boundary = 2
-    query = '(x >= %f) & (x <= %f) & (y >= %f) & (y <= %f)' ' & (particle_id >= 2) & (particle_id <= 6)' % (
-        x - detector_boundary,
-        x + detector_boundary,
-        -detector_boundary,
-        detector_boundary,
-    )
     try:
         with tables.open_file(path, 'r') as data:
             header = data.get_node_attr('/', 'event_header')
             time_first_interaction = (header.first_interaction_altitude - header.observation_heights[0]) / 0.2998
-            t = data.root.groundparticles.read_where(query, field='t')
-            if not len(t):
-                return nan, nan
-            else:
-                return t.min() - time_first_interaction, median(t) - time_first_interaction
-    except:
+            # Check that the shower has ground particles before indexing them
+            data.get_node('/groundparticles')
+    except (OSError, AttributeError, tables.NoSuchNodeError):
+        return nan, nan
+
+    # Errors while creating the index are not caught
+    with GroundParticlesIndex(path) as index:
+        t = index.box(
+            x - detector_boundary,
+            x + detector_boundary,
+            -detector_boundary,
+            detector_boundary,
+            particle_ids=PARTICLE_IDS,
+        )['t']
+    if not len(t):
         return nan, nan
+    else:
+        return t.min() - time_first_interaction, median(t) - time_first_interaction
 
 
 def get_times():
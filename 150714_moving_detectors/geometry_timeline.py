@@ -0,0 +1 @@
+../150930_coincidences_distance/geometry_timeline.py
\ No newline at end of file
@@ -2,24 +2,24 @@ from artist import Plot
 
 from sapphire import HiSPARCStations
 
+from .geometry_timeline import GeometryTimeline
+
 COLORS = ['black', 'red', 'green', 'blue']
 
 
 def plot_detectors(cluster):
     station = cluster.stations[0]
-    detectors = station.detectors
-    timestamps = set(station.timestamps).union(detectors[0].timestamps)
+    timeline = GeometryTimeline(cluster)
+    timestamps = timeline.change_timestamps([station.number])
 
     plot = Plot()
 
-    for timestamp in sorted(timestamps):
-        cluster.set_timestamp(timestamp)
-        for i in range(4):
-            x, y = detectors[i].get_xy_coordinates()
-            plot.scatter([x], [y], mark='*', markstyle=COLORS[i])
-        x, y = station.get_xy_coordinates()
-        plot.scatter([x], [y], markstyle='purple')
-        # print timestamp, gps_to_datetime(timestamp), x, y
+    detectors = timeline.detector_coordinates(station.number, timestamps)
+    for i in range(detectors.shape[1]):
+        plot.scatter(detectors[:, i, 0], detectors[:, i, 1], mark='*', markstyle=COLORS[i])
+    coordinates = timeline.station_coordinates(station.number, timestamps)
+    plot.scatter(coordinates[:, 0], coordinates[:, 1], markstyle='purple')
+    # print timestamps, coordinates
 
     plot.set_xlabel(r'Easting [\si{\meter}]')
     plot.set_ylabel(r'Northing [\si{\meter}]')
@@ -0,0 +1 @@
+../151013_cluster_efficiency/aggregate_results.py
\ No newline at end of file
@@ -5,13 +5,15 @@ from itertools import combinations
 
 import tables
 
-from numpy import degrees, histogram, linspace, log10, sqrt
+from numpy import array, degrees, histogram, linspace, log10, sqrt
 
 from artist import Plot
 
 from sapphire import CorsikaQuery
 from sapphire.utils import vector_length
 
+from .aggregate_results import HistogramAccumulator, collect_histograms
+
 DATA = '/Users/arne/Datastore/efficiency/'
 PATHS = '/Users/arne/Datastore/efficienc*/*_*.h5'
 OVERVIEW = '/Users/arne/Datastore/efficiency/corsika-overview.h5'
@@ -51,44 +53,30 @@ def detection_efficiency(path):
         return counts, all_counts
 
 
+def detection_histograms(path):
+    """Get the detected and all core distance histograms for a simulation"""
+
+    seeds = os.path.basename(path)[:-3]
+    return [(seeds, array(detection_efficiency(path)))]
+
+
 def collect_efficiencies():
     """Reconstruct shower (direction) for eligible events"""
-    counts = {}
-    all_counts = {}
-    n = {}
+    histograms = collect_histograms(detection_histograms, glob.glob(PATHS))
+
+    # Combine the simulations with the same energy and zenith
+    shower_histograms = HistogramAccumulator()
     cq = CorsikaQuery(OVERVIEW)
-    for path in glob.glob(PATHS):
-        seeds = os.path.basename(path)[:-3]
+    for seeds, counts in histograms.items():
         sim = cq.get_info(seeds)
-        energy = log10(sim['energy'])
-        zenith = degrees(sim['zenith'])
-        count, all_count = detection_efficiency(path)
-
-        # Check if its the first of this energy
-        try:
-            counts[energy]
-            all_counts[energy]
-        except KeyError:
-            counts[energy] = {}
-            all_counts[energy] = {}
-
-        # Check if its the first of this energy and zenith
-        try:
-            counts[energy][zenith] += count
-            all_counts[energy][zenith] += all_count
-        except KeyError:
-            counts[energy][zenith] = count
-            all_counts[energy][zenith] = all_count
+        shower_histograms.add((log10(sim['energy']), degrees(sim['zenith'])), counts)
     cq.finish()
 
     efficiencies = {}
     errors = {}
-    for e in list(counts.keys()):
-        efficiencies[e] = {}
-        errors[e] = {}
-        for z in list(counts[e].keys()):
-            efficiencies[e][z] = counts[e][z] / all_counts[e][z]
-            errors[e][z] = sqrt(counts[e][z] + 1) / all_counts[e][z]
+    for (e, z), (counts, all_counts) in shower_histograms.items():
+        efficiencies.setdefault(e, {})[z] = counts / all_counts
+        errors.setdefault(e, {})[z] = sqrt(counts + 1) / all_counts
 
     return efficiencies, errors
 
@@ -1,44 +1,25 @@
-import os
-
 from datetime import date
-from glob import glob
 
-from numpy import arange, argmax, genfromtxt, histogram, uint32, zeros
+from numpy import arange, argmax, histogram
 
 from artist import Plot
 
+from sapphire import Network
 from sapphire.transformations.clock import datetime_to_gps
 
-PATH = '/Users/arne/Datastore/publicdb_csv/eventtime/*.tsv'
-
-
-def read_eventtime(path):
-    return genfromtxt(path, delimiter='\t', dtype=uint32, names=['timestamp', 'counts'])
-
-
-def get_data():
-    return {int(os.path.basename(path)[:-4]): read_eventtime(path) for path in glob(PATH)}
-
-
-def get_aligned():
-    data = get_data()
+from .rate_cube import RateCube
 
-    first = min(values['timestamp'][0] for values in list(data.values()))
-    last = max(values['timestamp'][-1] for values in list(data.values()))
 
-    timestamps = arange(first, last + 1, 3600)
-    extended_data = zeros((len(list(data.keys())), (last - first) / 3600 + 1))
+def get_n_active():
+    """Get the number of active stations in the network for each hour"""
 
-    for i, sn in enumerate(data.keys()):
-        start = (data[sn]['timestamp'][0] - first) / 3600
-        end = start + len(data[sn])
-        extended_data[i, start:end] = (data[sn]['counts'] > 500) & (data[sn]['counts'] < 5000)
-    return timestamps, extended_data
+    cube = RateCube()
+    cube.ensure(Network(force_stale=True).station_numbers())
+    return cube.n_active()
 
 
 if __name__ == "__main__":
-    timestamps, eventtime = get_aligned()
-    summed_data = eventtime.sum(axis=0)
+    timestamps, summed_data = get_n_active()
     plot = Plot()
 
     counts, bins = histogram(summed_data, bins=arange(-0.5, 100.5, 1))
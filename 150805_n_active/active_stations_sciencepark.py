@@ -1,45 +1,26 @@
-import os
-
 from datetime import date
-from glob import glob
 
-from numpy import arange, argmax, genfromtxt, histogram, uint32, zeros
+from numpy import arange, argmax, histogram
 
 from artist import Plot
 
 from sapphire.transformations.clock import datetime_to_gps
 
-PATH = '/Users/arne/Datastore/publicdb_csv/eventtime/5*.tsv'
-STATIONS = [501, 502, 503, 504, 505, 506, 508, 509, 510, 511]
-
-
-def read_eventtime(path):
-    return genfromtxt(path, delimiter='\t', dtype=uint32, names=['timestamp', 'counts'])
+from .rate_cube import RateCube
 
+STATIONS = [501, 502, 503, 504, 505, 506, 508, 509, 510, 511]
 
-def get_data():
-    return {int(os.path.basename(path)[:-4]): read_eventtime(path) for path in glob(PATH)}
-
-
-def get_aligned():
-    data = get_data()
-
-    first = min(data[sn]['timestamp'][0] for sn in STATIONS)
-    last = max(data[sn]['timestamp'][-1] for sn in STATIONS)
 
-    timestamps = arange(first, last + 1, 3600)
-    extended_data = zeros((len(STATIONS), (last - first) / 3600 + 1))
+def get_n_active():
+    """Get the number of active Science Park stations for each hour"""
 
-    for i, sn in enumerate(STATIONS):
-        start = (data[sn]['timestamp'][0] - first) / 3600
-        end = start + len(data[sn])
-        extended_data[i, start:end] = (data[sn]['counts'] > 500) & (data[sn]['counts'] < 5000)
-    return timestamps, extended_data
+    cube = RateCube()
+    cube.ensure(STATIONS)
+    return cube.n_active(STATIONS)
 
 
 if __name__ == "__main__":
-    timestamps, eventtime = get_aligned()
-    summed_data = eventtime.sum(axis=0)
+    timestamps, summed_data = get_n_active()
     plot = Plot()
     bins = arange(-0.5, len(STATIONS) + 1.5)
 
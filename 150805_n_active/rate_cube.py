@@ -0,0 +1 @@
+../151020_hisparc_luminosity/rate_cube.py
\ No newline at end of file
@@ -1,18 +1,34 @@
 from itertools import chain
 
-from numpy import arange, around, mean, nan, nanmax, nanmin, sign
+from numpy import (
+    absolute,
+    arange,
+    around,
+    asarray,
+    concatenate,
+    cumsum,
+    empty,
+    int64,
+    mean,
+    nan,
+    nanmax,
+    nanmin,
+    sign,
+    where,
+    zeros,
+)
 
 from artist import Plot
 
-from sapphire import Station
+from .trace_cache import TraceCache
 
 COLORS = ['black', 'red', 'green', 'blue']
 FILTER_THRESHOLD = 25
 
 
 def get_traces():
-    station = Station(502)
-    raw_traces = station.event_trace(1385942677, 963603990, raw=True)
+    with TraceCache() as cache:
+        raw_traces = cache.get(502, 1385942677_963603990)
     return raw_traces
 
 
@@ -96,6 +112,94 @@ def mean_filter_without_threshold(trace):
     return filtered_trace
 
 
+def filter_trace_block(raw_traces, use_threshold=True, threshold=FILTER_THRESHOLD):
+    """Apply the mean filter to a block of traces at once
+
+    Vectorized equivalent of :func:`filter_trace`, the filter is applied
+    along the last axis. Typically the block has the shape
+    (n_events, 4, n_samples), for example the decoded traces of a day.
+    The even and odd ADC traces are filtered as strided views of the raw
+    traces and recombined into a preallocated array.
+
+    Gives the same output as :func:`filter_trace`, apart from the
+    threshold actually being passed on when ``use_threshold`` is True.
+
+    :param raw_traces: array of raw traces, samples along the last axis.
+    :param use_threshold: choose between the filter with or without threshold.
+    :param threshold: threshold for the filter, in ADC counts.
+    :return: array with the filtered traces.
+
+    """
+    raw_traces = asarray(raw_traces, dtype=int64)
+    n_pairs = raw_traces.shape[-1] // 2
+
+    recombined_traces = empty(raw_traces.shape[:-1] + (2 * n_pairs,), dtype=int64)
+    filtered_even = mean_filter_block(raw_traces[..., ::2], use_threshold, threshold)
+    filtered_odd = mean_filter_block(raw_traces[..., 1::2], use_threshold, threshold)
+    recombined_traces[..., ::2] = filtered_even[..., :n_pairs]
+    recombined_traces[..., 1::2] = filtered_odd[..., :n_pairs]
+
+    return mean_filter_block(recombined_traces, use_threshold, threshold)
+
+
+def mean_filter_block(traces, use_threshold=True, threshold=FILTER_THRESHOLD):
+    """Apply either the vectorized filter with or without the threshold"""
+
+    if use_threshold:
+        return mean_filter_block_with_threshold(traces, threshold)
+    else:
+        return mean_filter_block_without_threshold(traces)
+
+
+def mean_filter_block_with_threshold(traces, threshold=FILTER_THRESHOLD):
+    """Vectorized :func:`mean_filter_with_threshold` along the last axis
+
+    The local mean is only determined from the first four samples, so each
+    sample can be compared to its predecessor in the raw trace at once.
+
+    """
+    traces = asarray(traces, dtype=int64)
+    local_mean = mean(traces[..., :4], axis=-1, keepdims=True)
+    rounded_mean = around(local_mean).astype(int64)
+    filtered_traces = empty(traces.shape, dtype=int64)
+
+    head = traces[..., :4]
+    flat_head = (absolute(head - local_mean) <= threshold).all(axis=-1, keepdims=True)
+    filtered_traces[..., :4] = where(flat_head, rounded_mean, head)
+
+    current = traces[..., 4:]
+    previous = traces[..., 3:-1]
+    keep = absolute(current - previous) > 2 * threshold
+    # Both values on same side of the local_mean
+    keep |= sign(current - local_mean) == sign(previous - local_mean)
+    keep |= absolute(current - local_mean) > threshold
+    filtered_traces[..., 4:] = where(keep, current, rounded_mean)
+
+    return filtered_traces
+
+
+def mean_filter_block_without_threshold(traces):
+    """Vectorized :func:`mean_filter_without_threshold` along the last axis
+
+    The running mean of the four preceding raw samples is taken from the
+    cumulative sum of the traces, which is exact for integer traces.
+
+    """
+    traces = asarray(traces, dtype=int64)
+    filtered_traces = empty(traces.shape, dtype=int64)
+    filtered_traces[..., :4] = around(mean(traces[..., :4], axis=-1, keepdims=True))
+
+    summed = concatenate((zeros(traces.shape[:-1] + (1,), dtype=int64), cumsum(traces, axis=-1)), axis=-1)
+    local_mean = (summed[..., 4:-1] - summed[..., :-5]) / 4.0
+    current = traces[..., 4:]
+    previous = traces[..., 3:-1]
+    # Both values on same side of the local_mean
+    keep = sign(current - local_mean) == sign(previous - local_mean)
+    filtered_traces[..., 4:] = where(keep, current, around(local_mean).astype(int64))
+
+    return filtered_traces
+
+
 def plot_raw(raw_traces):
     length = 2.5 * len(raw_traces[0])
     plot = Plot()
@@ -9,72 +9,295 @@ the number of found coincidences. Additionally a coincidence rate is
 determined based on the time between coincidences. This is then plotted
 against the distance between the stations.
 
-"""
+The downloads for all pairs run concurrently, with at most CONNECTIONS
+simultaneous requests. Timestamp ranges separated by short gaps are
+combined into one request, coincidences in the gaps are removed after
+loading each request. After each request the number of completed requests and the
+number of rows of each table is stored in the file. An interrupted
+download continues from there, after removing rows of incomplete
+requests. Failed requests are retried.
+
+Set the PUBLICDB_BASE environment variable to use the server in
+recorded_api.py instead of the public data server.
 
+"""
 
+import asyncio
 import datetime
-import multiprocessing
 import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from urllib.parse import urlencode
+from urllib.request import urlopen
 
 import tables
 
-from sapphire import download_coincidences
+from numpy import arange, cumsum, zeros
+
+from sapphire.esd import get_coincidences_url, load_coincidences
 from sapphire.transformations.clock import gps_to_datetime
 
 from .eventtime_ranges import get_timestamp_ranges, get_total_exposure
+from .intervals import coalesce, contains
 from .rate_from_intervals import determine_rate
 from .station_distances import close_pairs_in_network, distance_between_stations
 
 DATAPATH = '/Users/arne/Datastore/pairs/%d_%d.h5'
+CONNECTIONS = 4
+RETRIES = 5
+MAX_GAP = 6 * 3600
+MAX_LENGTH = 30 * 24 * 3600
 
 
-def download_coincidences_pairs_multi(close_pairs):
-    """Like download_coincidences_pairs, but multithreaded"""
+def download_coincidences_pairs_multi(close_pairs, connections=CONNECTIONS):
+    """Like download_coincidences_pairs, but with concurrent downloads"""
 
-    worker_pool = multiprocessing.Pool(4)
-    worker_pool.map(download_coincidences_pair, close_pairs)
-    worker_pool.close()
-    worker_pool.join()
+    asyncio.run(download_pairs(close_pairs, connections))
 
 
 def download_coincidences_pairs(close_pairs):
     """Download coincidences for the given pairs"""
 
-    for close_pair in close_pairs:
-        download_coincidences_pair(close_pair)
+    download_coincidences_pairs_multi(close_pairs, connections=1)
 
 
 def download_coincidences_pair(pair):
+    download_coincidences_pairs_multi([pair], connections=1)
+
+
+async def download_pairs(pairs, connections):
+    """Download the pairs, limiting the number of simultaneous requests
+
+    :param pairs: list of station pairs.
+    :param connections: maximum number of simultaneous requests, also
+                        the maximum number of pairs in progress.
+
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(connections))
+    requests = asyncio.Semaphore(connections)
+    open_pairs = asyncio.Semaphore(connections)
+
+    async def download_pair_limited(pair):
+        async with open_pairs:
+            try:
+                await download_pair(pair, requests)
+            except Exception as e:
+                print('Failed for', pair)
+                print(e)
+
+    await asyncio.gather(*[download_pair_limited(pair) for pair in pairs])
+
+
+async def download_pair(pair, requests):
+    """Download the coincidences of a pair, continuing a previous attempt
+
+    :param pair: tuple of two station numbers.
+    :param requests: semaphore limiting the simultaneous requests.
+
+    """
     path = DATAPATH % tuple(pair)
     tmp_path = path + '_tmp'
     if os.path.exists(path):
         print('Skipping', pair)
         return
     print('Starting', pair, datetime.datetime.now())
-    distance = distance_between_stations(*pair)
-    timestamp_ranges = get_timestamp_ranges(pair)
-    total_exposure = get_total_exposure(timestamp_ranges)
-    with tables.open_file(tmp_path, 'w') as data:
-        data.set_node_attr('/', 'total_exposure', total_exposure)
-        data.set_node_attr('/', 'distance', distance)
-        for ts_start, ts_end in timestamp_ranges:
-            download_coincidences(
-                data, stations=list(pair), start=gps_to_datetime(ts_start), end=gps_to_datetime(ts_end), progress=False
-            )
+    with tables.open_file(tmp_path, 'a') as data:
+        if 'download_ranges' not in data.root._v_attrs:
+            start_download(data, pair)
+        else:
+            restore_checkpoint(data)
+        timestamp_ranges = data.get_node_attr('/', 'timestamp_ranges')
+        download_ranges = data.get_node_attr('/', 'download_ranges')
+        n_downloaded = data.get_node_attr('/', 'n_downloaded')
+
+        tsv_path = tmp_path + '_%d.tsv'
+        downloads = [
+            asyncio.ensure_future(download_range(pair, start, end, tsv_path % i, requests))
+            for i, (start, end) in enumerate(download_ranges)
+            if i >= n_downloaded
+        ]
+        try:
+            # Store in order of the ranges, to keep the coincidences sorted
+            for i, download in enumerate(downloads, n_downloaded):
+                await download
+                load_coincidences(data, tsv_path % i)
+                remove_outside_ranges(data, timestamp_ranges, data.get_node_attr('/', 'checkpoint_rows'))
+                os.remove(tsv_path % i)
+                store_checkpoint(data, i + 1)
+        finally:
+            for download in downloads:
+                download.cancel()
+            await asyncio.gather(*downloads, return_exceptions=True)
+
         try:
             coin = data.get_node('/coincidences')
         except tables.NoSuchNodeError:
             print('No coincidences for', pair)
             os.rename(tmp_path, path)
             return
-        rate = coin.coincidences.nrows / total_exposure
+        n_coincidences = coin.coincidences.nrows
+        rate = n_coincidences / data.get_node_attr('/', 'total_exposure')
         data.set_node_attr('/', 'n_rate', rate)
-        data.set_node_attr('/', 'n_coincidences', coin.coincidences.nrows)
+        data.set_node_attr('/', 'n_coincidences', n_coincidences)
     os.rename(tmp_path, path)
     determine_rate(path)
     print('Finished', pair, datetime.datetime.now())
 
 
+def start_download(data, pair):
+    """Store the ranges to download and the exposure in a new file"""
+
+    timestamp_ranges = get_timestamp_ranges(pair)
+    data.set_node_attr('/', 'total_exposure', get_total_exposure(timestamp_ranges))
+    data.set_node_attr('/', 'distance', distance_between_stations(*pair))
+    data.set_node_attr('/', 'timestamp_ranges', timestamp_ranges)
+    data.set_node_attr('/', 'download_ranges', coalesce(timestamp_ranges, MAX_GAP, MAX_LENGTH))
+    data.set_node_attr('/', 'n_downloaded', 0)
+    data.set_node_attr('/', 'checkpoint_rows', {})
+    data.flush()
+
+
+def store_checkpoint(data, n_downloaded):
+    """Store the number of completed requests and the number of rows"""
+
+    data.flush()
+    rows = {leaf._v_pathname: leaf.nrows for leaf in data.walk_nodes('/', 'Leaf')}
+    data.set_node_attr('/', 'checkpoint_rows', rows)
+    data.set_node_attr('/', 'n_downloaded', n_downloaded)
+    data.flush()
+
+
+def restore_checkpoint(data):
+    """Remove the data stored after the last checkpoint"""
+
+    rows = data.get_node_attr('/', 'checkpoint_rows')
+    if not rows:
+        for node in list(data.root):
+            data.remove_node(node, recursive=True)
+    else:
+        for leaf in list(data.walk_nodes('/', 'Leaf')):
+            if leaf._v_pathname not in rows:
+                data.remove_node(leaf)
+            elif leaf.nrows == rows[leaf._v_pathname]:
+                continue
+            elif isinstance(leaf, tables.VLArray):
+                truncate_vlarray(data, leaf, rows[leaf._v_pathname])
+            else:
+                leaf.truncate(rows[leaf._v_pathname])
+    data.flush()
+
+
+def remove_outside_ranges(data, timestamp_ranges, rows):
+    """Remove the new coincidences which are outside the timestamp ranges
+
+    The coalesced download ranges include the gaps between the timestamp
+    ranges, in which at least one of the stations did not have good
+    data. The coincidences stored after the last checkpoint which are in
+    those gaps are removed, with their events.
+
+    :param timestamp_ranges: ranges in which both stations have data.
+    :param rows: number of rows of each leaf at the last checkpoint.
+
+    """
+    try:
+        coincidences = data.get_node('/coincidences/coincidences')
+    except tables.NoSuchNodeError:
+        return
+    first = rows.get(coincidences._v_pathname, 0)
+    new_coincidences = coincidences.read(first)
+    keep = contains(timestamp_ranges, new_coincidences['timestamp'])
+    if keep.all():
+        return
+    c_index = data.get_node('/coincidences/c_index')
+    new_c_index = [c_idx for c_idx, kept in zip(c_index.read(first), keep) if kept]
+
+    for s_idx, s_path in enumerate(data.get_node('/coincidences/s_index')):
+        events_path = s_path.decode('utf-8') + '/events'
+        if events_path not in data:
+            continue
+        events = data.get_node(events_path)
+        e_first = rows.get(events_path, 0)
+        new_events = events.read(e_first)
+        kept_events = zeros(len(new_events), dtype=bool)
+        for c_idx in new_c_index:
+            kept_events[c_idx[c_idx[:, 0] == s_idx, 1] - e_first] = True
+        # New index of the kept events
+        e_idx = e_first + cumsum(kept_events) - 1
+        for c_idx in new_c_index:
+            station_events = c_idx[:, 0] == s_idx
+            c_idx[station_events, 1] = e_idx[c_idx[station_events, 1] - e_first]
+        events.truncate(e_first)
+        events.append(new_events[kept_events])
+
+    new_coincidences = new_coincidences[keep]
+    new_coincidences['id'] = arange(first, first + len(new_coincidences))
+    coincidences.truncate(first)
+    coincidences.append(new_coincidences)
+    truncate_vlarray(data, c_index, first)
+    c_index = data.get_node('/coincidences/c_index')
+    for c_idx in new_c_index:
+        c_index.append(c_idx)
+    data.flush()
+
+
+def truncate_vlarray(data, vlarray, nrows):
+    """Replace a VLArray by a copy of its first rows
+
+    Appending to a truncated VLArray does not work correctly.
+
+    """
+    parent = vlarray._v_parent
+    name = vlarray._v_name
+    copy = data.create_vlarray(parent, name + '_tmp', vlarray.atom, filters=vlarray.filters)
+    for row in vlarray.read(0, nrows):
+        copy.append(row)
+    data.remove_node(vlarray)
+    copy.rename(name)
+
+
+async def download_range(pair, start, end, tsv_path, requests):
+    """Download the coincidences of a pair in a timestamp range to a file
+
+    Incomplete or failed downloads are retried.
+
+    :param pair: tuple of two station numbers.
+    :param start,end: timestamps of the range.
+    :param tsv_path: path to store the downloaded tsv.
+    :param requests: semaphore limiting the simultaneous requests.
+
+    """
+    query = urlencode(
+        {'cluster': None, 'stations': list(pair), 'start': gps_to_datetime(start), 'end': gps_to_datetime(end), 'n': 2}
+    )
+    url = get_coincidences_url().format(query=query)
+    loop = asyncio.get_running_loop()
+    for attempt in range(RETRIES):
+        async with requests:
+            try:
+                if await loop.run_in_executor(None, download_tsv, url, tsv_path):
+                    return
+            except (OSError, HTTPException) as e:
+                print('Retrying', pair, gps_to_datetime(start), e)
+        await asyncio.sleep(2**attempt)
+    raise RuntimeError('Failed to download %s' % url)
+
+
+def download_tsv(url, tsv_path):
+    """Download a tsv to a file
+
+    :return: boolean indicating if the download is complete, i.e. the
+             last line is a non-empty comment.
+
+    """
+    with urlopen(url, timeout=1800) as response, open(tsv_path, 'wb') as output:
+        shutil.copyfileobj(response, output)
+    with open(tsv_path, 'rb') as tsv:
+        lines = tsv.read().splitlines()
+    return bool(lines) and lines[-1].startswith(b'#') and len(lines[-1].strip()) > 1
+
+
 if __name__ == "__main__":
     close_pairs = close_pairs_in_network(min=0, max=15e3)
     todo_pairs = [pair for pair in close_pairs if not os.path.exists(DATAPATH % tuple(pair))]
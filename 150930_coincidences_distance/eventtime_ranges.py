@@ -1,22 +1,28 @@
-from numpy import arange, array, zeros
+from numpy import array, float32, unique, zeros
 
-from sapphire import Station
+from .intervals import at_least, from_flags, total_length
+from .rate_cube import HOUR, RateCube
 
-
-def get_data(station_numbers):
-    """Read the eventtime csv files for the given station numbers"""
-
-    return {number: Station(number, force_stale=True).event_time() for number in station_numbers}
+CHUNK_SIZE = 24 * 365
 
 
 def get_total_exposure(timestamp_ranges):
     """Get total exposure time of the timestamp ranges"""
 
-    if not len(timestamp_ranges):
-        return 0.0
-    timestamp_ranges = array(timestamp_ranges)
-    total_exposure = (timestamp_ranges[:, 1] - timestamp_ranges[:, 0]).sum()
-    return total_exposure
+    return total_length(timestamp_ranges)
+
+
+def get_station_ranges(station_numbers):
+    """Get the timestamp ranges in which each of the stations has data
+
+    :param station_numbers: list of station numbers.
+    :return: list with a set of intervals for each station.
+
+    """
+    cube = RateCube()
+    cube.ensure(station_numbers)
+    timestamps, active = cube.active(station_numbers)
+    return [get_ranges(timestamps, flags) for flags in active]
 
 
 def get_timestamp_ranges(station_numbers, min_n=None):
@@ -25,56 +31,54 @@ def get_timestamp_ranges(station_numbers, min_n=None):
     :param station_numbers: list of station numbers that should be considered.
     :param min_n: if given at least this number of stations should have data,
                   for a date to be included.
-    :return: list of timestamp range, using the following format:
+    :return: array of timestamp ranges, using the following format:
              `[(start, end), (start, end), (start, end), ...]`
 
     """
     if min_n is None:
         min_n = len(station_numbers)
-    data = get_data(station_numbers)
+    return at_least(get_station_ranges(station_numbers), min_n)
+
 
-    first = min(values['timestamp'][0] for values in list(data.values()))
-    last = max(values['timestamp'][-1] for values in list(data.values()))
+def get_pair_exposures(pairs):
+    """Get the total exposure of many station pairs at once
 
-    timestamps = arange(first, last + 1, 3600)
-    extended_data = zeros((len(list(data.keys())), (last - first) / 3600 + 1))
+    The hours in which both stations of a pair have data are counted for
+    all combinations of stations by a single matrix product of the
+    active hours of the stations.
 
-    for i, sn in enumerate(data.keys()):
-        start = (data[sn]['timestamp'][0] - first) / 3600
-        end = start + len(data[sn])
-        extended_data[i, start:end] = (data[sn]['counts'] > 500) & (data[sn]['counts'] < 5000)
+    :param pairs: list of station number pairs.
+    :return: array with the exposure of each pair, in seconds.
 
-    flags = extended_data.sum(axis=0) >= min_n
-    timestamp_ranges = get_ranges(timestamps, flags)
-    return timestamp_ranges
+    """
+    pairs = array(pairs)
+    station_numbers = unique(pairs).tolist()
+    cube = RateCube()
+    cube.ensure(station_numbers)
+    _, active = cube.active(station_numbers)
+    n_hours = zeros((len(station_numbers), len(station_numbers)))
+    for start in range(0, active.shape[1], CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        chunk = active[:, start:stop].astype(float32)
+        n_hours += chunk.dot(chunk.T)
+
+    rows = {station: row for row, station in enumerate(station_numbers)}
+    idx = [rows[station] for station in pairs[:, 0]], [rows[station] for station in pairs[:, 1]]
+    return n_hours[idx].round().astype('i8') * HOUR
 
 
 def get_ranges(timestamps, flags):
     """Make timestamp ranges from timestamps list
 
+    The ranges are found using run-length encoding of the flags, see
+    :func:`intervals.from_flags`.
+
     :param timestamps: list of timestamps.
     :param flags: list of flags (booleans) which indicate if all of the
                   requested stations have data during that timestamp..
 
-    Inspired by http://stackoverflow.com/a/16315498/1033535
-
     """
-    timestamp_ranges = []
-    prev_flag = False
-    for timestamp, flag in zip(timestamps, flags):
-        if flag:
-            # All stations have data
-            if not timestamp_ranges or len(timestamp_ranges[-1]) == 2:
-                # Start new range
-                timestamp_ranges.append([timestamp])
-        if prev_flag and not flag:
-            # End of a range
-            timestamp_ranges[-1].append(timestamp)
-        prev_flag = flag
-    if timestamp_ranges and len(timestamp_ranges[-1]) == 1:
-        timestamp_ranges[-1].append(timestamps[-1] + 3600)
-
-    return timestamp_ranges
+    return from_flags(timestamps, flags, HOUR)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+"""Positions of stations and detectors over time
+
+The positions of stations (GPS) and detectors (layouts) in a cluster
+change at specific timestamps. Normally the cluster is set to a
+timestamp before getting coordinates, one timestamp and one station at a
+time. This module calculates the coordinates for all configurations of
+each station at once, from the position history stored in the cluster.
+The coordinates, distances and directions can then be looked up for
+arrays of timestamps.
+
+Example::
+
+    timeline = GeometryTimeline(HiSPARCStations([501, 502]))
+    timestamps = timeline.change_timestamps()
+    distances = timeline.distance(501, 502, timestamps)
+
+"""
+from numpy import arctan2, array, atleast_1d, cos, nanmean, sin, sqrt, stack, unique
+
+
+def active_indexes(change_timestamps, timestamps):
+    """Get the index of the configuration active at each timestamp
+
+    Same as sapphire.utils.get_active_index, timestamps before the
+    first change use the first configuration.
+
+    """
+    return (array(change_timestamps).searchsorted(timestamps, 'right') - 1).clip(min=0)
+
+
+class GeometryTimeline:
+
+    """Station and detector coordinates for all configurations
+
+    :param cluster: cluster object with the position history of the
+                    stations, i.e. HiSPARCStations.
+
+    """
+
+    def __init__(self, cluster):
+        self.timestamps = {}
+        self.stations = {}
+        self.detectors = {}
+        x_cluster, y_cluster, z_cluster, alpha_cluster = cluster.get_coordinates()
+
+        for station in cluster.stations:
+            timestamps = unique(
+                array(list(station.timestamps) + [t for detector in station.detectors for t in detector.timestamps])
+            )
+            idx = active_indexes(station.timestamps, timestamps)
+            sx = array(station.x)[idx]
+            sy = array(station.y)[idx]
+            x = x_cluster + sx * cos(alpha_cluster) - sy * sin(alpha_cluster)
+            y = y_cluster + sx * sin(alpha_cluster) + sy * cos(alpha_cluster)
+            z = z_cluster + array(station.z)[idx]
+            alpha = alpha_cluster + array(station.angle)[idx]
+
+            detectors = []
+            for detector in station.detectors:
+                idx = active_indexes(detector.timestamps, timestamps)
+                dx = array(detector.x)[idx]
+                dy = array(detector.y)[idx]
+                detectors.append(
+                    (
+                        x + dx * cos(alpha) - dy * sin(alpha),
+                        y + dx * sin(alpha) + dy * cos(alpha),
+                        z + array(detector.z)[idx],
+                    )
+                )
+
+            self.timestamps[station.number] = timestamps
+            self.stations[station.number] = stack((x, y, z, alpha), axis=-1)
+            # Shape (configurations, detectors, 3)
+            self.detectors[station.number] = array(detectors).transpose(2, 0, 1)
+
+    def change_timestamps(self, station_numbers=None):
+        """Get the timestamps at which any of the stations changed"""
+
+        if station_numbers is None:
+            station_numbers = self.timestamps.keys()
+        return unique(array([t for number in station_numbers for t in self.timestamps[number]]))
+
+    def configurations(self, station, timestamps):
+        """Get the configuration indexes of a station for the timestamps"""
+
+        return active_indexes(self.timestamps[station], atleast_1d(timestamps))
+
+    def station_coordinates(self, station, timestamps):
+        """Get the x, y, z, alpha of the station position
+
+        :param station: station number.
+        :param timestamps: array of timestamps.
+        :return: array with shape (len(timestamps), 4).
+
+        """
+        return self.stations[station][self.configurations(station, timestamps)]
+
+    def detector_coordinates(self, station, timestamps):
+        """Get the x, y, z of the detectors of a station
+
+        :return: array with shape (len(timestamps), detectors, 3).
+
+        """
+        return self.detectors[station][self.configurations(station, timestamps)]
+
+    def center_of_mass_coordinates(self, station, timestamps):
+        """Get the x, y, z of the center of mass of the detectors
+
+        :return: array with shape (len(timestamps), 3).
+
+        """
+        return nanmean(self.detector_coordinates(station, timestamps), axis=1)
+
+    def distance(self, s1, s2, timestamps):
+        """Get the distance between the centers of mass of two stations"""
+
+        xyz1 = self.center_of_mass_coordinates(s1, timestamps)
+        xyz2 = self.center_of_mass_coordinates(s2, timestamps)
+        return sqrt(((xyz2 - xyz1) ** 2).sum(axis=1))
+
+    def rphiz(self, s1, s2, timestamps):
+        """Get the horizontal distance, direction and height difference
+
+        Same as calc_rphiz_for_stations of sapphire clusters.
+
+        :return: arrays of r, phi and z (z2 - z1) for the timestamps.
+
+        """
+        x1, y1, z1 = self.center_of_mass_coordinates(s1, timestamps).T
+        x2, y2, z2 = self.center_of_mass_coordinates(s2, timestamps).T
+        return sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2), arctan2(y2 - y1, x2 - x1), z2 - z1
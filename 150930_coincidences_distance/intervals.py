@@ -0,0 +1,133 @@
+"""Operations on sets of time intervals
+
+A set of intervals is an array with shape (n, 2) of [start, end)
+timestamps, sorted by start and without overlapping intervals. These
+are made from boolean flags of regular time bins using run-length
+encoding, and combined without looping over the time bins.
+
+Example::
+
+    ranges = intersection(from_flags(timestamps, active[0]),
+                          from_flags(timestamps, active[1]))
+    exposure = total_length(ranges)
+
+"""
+from numpy import append, array, bincount, column_stack, concatenate, diff, empty, flatnonzero, int8, unique, zeros
+
+HOUR = 3600
+
+
+def runs(flags):
+    """Find the runs of consecutive set flags
+
+    :param flags: array of booleans.
+    :return: indexes of the start and end (exclusive) of the runs.
+
+    """
+    changes = flatnonzero(diff(concatenate(([0], array(flags, dtype=int8), [0]))))
+    return changes[::2], changes[1::2]
+
+
+def from_flags(timestamps, flags, step=HOUR):
+    """Get the intervals in which the flags are set
+
+    :param timestamps: start timestamps of consecutive time bins.
+    :param flags: booleans for each time bin.
+    :param step: width of the time bins.
+    :return: set of intervals.
+
+    """
+    if not len(timestamps):
+        return empty((0, 2), dtype='i8')
+    edges = append(timestamps, timestamps[-1] + step)
+    starts, ends = runs(flags)
+    return column_stack((edges[starts], edges[ends]))
+
+
+def at_least(interval_sets, min_n):
+    """Get the intervals in which at least min_n of the sets are active
+
+    The starts and ends of all intervals are combined into one sorted
+    array of times, the number of active sets between consecutive times
+    follows from the cumulative sum of the starts minus the ends.
+
+    :param interval_sets: list of sets of intervals.
+    :param min_n: minimum number of active sets.
+    :return: set of intervals.
+
+    """
+    intervals = concatenate([empty((0, 2), dtype='i8')] + [array(i, dtype='i8').reshape(-1, 2) for i in interval_sets])
+    if not len(intervals):
+        return intervals
+    times, inverse = unique(intervals.ravel(), return_inverse=True)
+    inverse = inverse.reshape(-1, 2)
+    n_times = len(times)
+    n_active = (bincount(inverse[:, 0], minlength=n_times) - bincount(inverse[:, 1], minlength=n_times)).cumsum()
+    starts, ends = runs(n_active[:-1] >= min_n)
+    return column_stack((times[starts], times[ends]))
+
+
+def intersection(*interval_sets):
+    """Get the intervals in which all sets are active"""
+
+    return at_least(interval_sets, len(interval_sets))
+
+
+def union(*interval_sets):
+    """Get the intervals in which any of the sets is active"""
+
+    return at_least(interval_sets, 1)
+
+
+def clip(intervals, start=None, end=None):
+    """Limit the intervals to the range between start and end"""
+
+    intervals = array(intervals, dtype='i8').reshape(-1, 2).copy()
+    if start is not None:
+        intervals[:, 0] = intervals[:, 0].clip(min=start)
+    if end is not None:
+        intervals[:, 1] = intervals[:, 1].clip(max=end)
+    return intervals[intervals[:, 1] > intervals[:, 0]]
+
+
+def coalesce(intervals, max_gap=0, max_length=None):
+    """Combine intervals which are separated by small gaps
+
+    The combined intervals include the gaps. Intervals are only combined
+    up to max_length, longer intervals are split into parts.
+
+    :param intervals: set of intervals.
+    :param max_gap: maximum gap between intervals to combine them.
+    :param max_length: maximum length of the combined intervals.
+    :return: set of combined intervals.
+
+    """
+    combined = []
+    for start, end in array(intervals, dtype='i8').reshape(-1, 2).tolist():
+        step = end - start if max_length is None else max_length
+        for part_start in range(start, end, max(step, 1)):
+            part_end = min(part_start + step, end)
+            if combined and part_start - combined[-1][1] <= max_gap:
+                if max_length is None or part_end - combined[-1][0] <= max_length:
+                    combined[-1][1] = part_end
+                    continue
+            combined.append([part_start, part_end])
+    return array(combined, dtype='i8').reshape(-1, 2)
+
+
+def contains(intervals, timestamps):
+    """Check which timestamps are within one of the intervals"""
+
+    intervals = array(intervals, dtype='i8').reshape(-1, 2)
+    timestamps = array(timestamps)
+    if not len(intervals):
+        return zeros(timestamps.shape, dtype=bool)
+    idx = intervals[:, 0].searchsorted(timestamps, 'right') - 1
+    return (idx >= 0) & (timestamps < intervals[idx.clip(min=0), 1])
+
+
+def total_length(intervals):
+    """Get the total length of the intervals"""
+
+    intervals = array(intervals, dtype='i8').reshape(-1, 2)
+    return int((intervals[:, 1] - intervals[:, 0]).sum())
@@ -27,6 +27,7 @@ from sapphire import HiSPARCNetwork
 from sapphire.utils import pbar
 
 from .energy_sensitivity import get_pair_distance_energy_array
+from .eventtime_ranges import get_pair_exposures
 from .station_distances import close_pairs_in_network
 from .variable_distance import min_max_distance_pair
 
@@ -130,6 +131,9 @@ NO_LAYOUT = [
 
 def get_coincidence_count(close_pairs):
     network = HiSPARCNetwork(force_stale=True)
+    # Current exposure of all pairs at once, to find pairs with data newer than their download
+    exposures = dict(zip(map(tuple, close_pairs), get_pair_exposures(close_pairs)))
+    outdated_pairs = []
     distances = {4: [], 6: [], 8: []}
     distance_errors = {4: [], 6: [], 8: []}
     coincidence_rates = {4: [], 6: [], 8: []}
@@ -147,6 +151,7 @@ def get_coincidence_count(close_pairs):
 
         with tables.open_file(path, 'r') as data:
             try:
+                # The exposure during which the coincidences were downloaded
                 total_exposure = data.get_node_attr('/', 'total_exposure')
                 distance = network.calc_distance_between_stations(*pair)
                 n_rate = data.get_node_attr('/', 'n_rate')
@@ -160,6 +165,8 @@ def get_coincidence_count(close_pairs):
         if n_coincidences < 5:
             # Exclude pairs with very few coincidences
             continue
+        if exposures[tuple(pair)] != total_exposure:
+            outdated_pairs.append(pair)
         n = len(network.get_station(pair[0]).detectors) + len(network.get_station(pair[1]).detectors)
         distances[n].append(distance)
         # Distance error due to unknown detector locations or moving stations
@@ -184,6 +191,9 @@ def get_coincidence_count(close_pairs):
         coincidence_rate_errors[n].append(err)
         pairs[n].append(pair)
 
+    if outdated_pairs:
+        print('Exposure changed since the download of %d pairs:' % len(outdated_pairs), outdated_pairs)
+
     return (distances, coincidence_rates, interval_rates, distance_errors, coincidence_rate_errors, pairs)
 
 
@@ -0,0 +1,113 @@
+"""Local stand-in for the HiSPARC public data server
+
+Serves previously recorded responses of the public data server, so
+downloads can be repeated without network access, for instance to test
+the throughput and resuming of download_pair_data.py. Each response is
+stored in a file named by the hash of the request path and query.
+
+With an upstream server requests without a recording are forwarded to
+that server and the response is recorded. Without an upstream server
+these requests get a 404 response.
+
+Point sapphire to the local server by setting the PUBLICDB_BASE
+environment variable::
+
+    PUBLICDB_BASE=http://localhost:8123 python download_pair_data.py
+
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+RECORDINGS_PATH = '/Users/arne/Datastore/recorded_api/'
+UPSTREAM = 'https://data.hisparc.nl'
+PORT = 8123
+
+
+def get_recording_path(request_path, recordings=RECORDINGS_PATH):
+    """Path of the recorded response for a request path with query"""
+
+    return os.path.join(recordings, hashlib.sha1(request_path.encode('utf-8')).hexdigest())
+
+
+def record(url, recording):
+    """Store the response for a url, only complete responses are kept"""
+
+    tmp_path = recording + '.tmp'
+    with urlopen(url, timeout=1800) as response, open(tmp_path, 'wb') as output:
+        shutil.copyfileobj(response, output)
+    os.replace(tmp_path, recording)
+
+
+class RecordedAPIHandler(BaseHTTPRequestHandler):
+
+    """Respond to requests with recorded responses
+
+    The class attributes are set by :func:`create_server`.
+
+    """
+
+    recordings = RECORDINGS_PATH
+    upstream = None
+    delay = 0
+
+    def do_GET(self):
+        recording = get_recording_path(self.path, self.recordings)
+        if not os.path.exists(recording):
+            if self.upstream is None:
+                self.send_error(404, 'No recorded response')
+                return
+            record(self.upstream + self.path, recording)
+
+        # Simulate the time needed by the server to start the response
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(os.path.getsize(recording)))
+        self.end_headers()
+        with open(recording, 'rb') as response:
+            shutil.copyfileobj(response, self.wfile)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(recordings=RECORDINGS_PATH, upstream=None, delay=0, port=PORT):
+    """Create a server for the recorded responses
+
+    :param recordings: directory containing the recorded responses.
+    :param upstream: base url of the server to record missing responses
+                     from, by default missing responses are not found.
+    :param delay: seconds to wait before each response.
+    :param port: port to listen on, use 0 for any free port.
+    :return: the server, call serve_forever to start it.
+
+    """
+    os.makedirs(recordings, exist_ok=True)
+    handler = type('Handler', (RecordedAPIHandler,), {'recordings': recordings, 'upstream': upstream, 'delay': delay})
+    return ThreadingHTTPServer(('localhost', port), handler)
+
+
+def start_server(*args, **kwargs):
+    """Run a server in a background thread
+
+    Takes the same arguments as :func:`create_server`.
+
+    :return: the server and the base url to use as PUBLICDB_BASE. Call
+             shutdown and server_close on the server to stop it.
+
+    """
+    server = create_server(*args, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://localhost:%d' % server.server_address[1]
+
+
+if __name__ == "__main__":
+    # Record missing responses from the public data server
+    create_server(upstream=UPSTREAM).serve_forever()
@@ -6,6 +6,7 @@ import tables
 from sapphire.transformations.clock import datetime_to_gps
 
 from .eventtime_ranges import get_timestamp_ranges, get_total_exposure
+from .intervals import clip
 
 
 def modify_range(ts_range, start_ts):
@@ -15,7 +16,7 @@ def modify_range(ts_range, start_ts):
     a range the start of that range is set to start_ts.
 
     """
-    return [(ts1 if ts1 > start_ts else start_ts, ts2) for ts1, ts2 in ts_range if ts2 > start_ts]
+    return clip(ts_range, start=start_ts)
 
 
 def get_coin_count(s1, s2, start_ts):
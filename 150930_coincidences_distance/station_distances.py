@@ -5,10 +5,15 @@ all possible combinations of 2 different stations, it
 calculates the distances of the combinations, and makes
 a histogram to show these distances.
 
+Close pairs are found with a KD-tree, close triples are combinations of
+close pairs which share a station. The station coordinates of the
+network are cached per timestamp.
+
 """
-from itertools import combinations
+from functools import lru_cache
 
-from numpy import array, sqrt, testing
+from numpy import array, empty, lexsort, sqrt, testing
+from scipy.spatial import cKDTree
 
 from sapphire import HiSPARCNetwork, HiSPARCStations
 
@@ -28,12 +33,30 @@ def horizontal_distance_between_stations(s1, s2):
     return distance(*xy)
 
 
-def close_pairs_in_network(min=MIN_DISTANCE, max=MAX_DISTANCE):
+@lru_cache()
+def network_coordinates(timestamp=None):
+    """Get the station numbers and coordinates for the network
+
+    The result is cached, the network is only loaded once per timestamp.
+
+    :param timestamp: timestamp for which to get the station positions,
+                      defaults to the current positions.
+
+    """
     cluster = HiSPARCNetwork(force_stale=True)
-    return close_pairs_in_cluster(cluster, min, max)
+    return cluster_coordinates(cluster, timestamp)
+
 
+def cluster_coordinates(cluster, timestamp=None):
+    """Get the numbers and coordinates of stations with valid GPS positions
 
-def close_pairs_in_cluster(cluster, min=MIN_DISTANCE, max=MAX_DISTANCE):
+    :param cluster: cluster object.
+    :param timestamp: timestamp for which to get the station positions.
+    :return: list of (station number, coordinates) tuples.
+
+    """
+    if timestamp is not None:
+        cluster.set_timestamp(timestamp)
     station_numbers = []
     coordinates = []
     for station in cluster.stations:
@@ -43,45 +66,78 @@ def close_pairs_in_cluster(cluster, min=MIN_DISTANCE, max=MAX_DISTANCE):
             # Valid GPS
             station_numbers.append(station.number)
             coordinates.append(array(station.calc_center_of_mass_coordinates()))
-    return get_close_pairs(list(zip(station_numbers, coordinates)), min, max)
+    return list(zip(station_numbers, coordinates))
+
+
+def close_pairs_in_network(min=MIN_DISTANCE, max=MAX_DISTANCE, timestamp=None):
+    return get_close_pairs(network_coordinates(timestamp), min, max)
+
+
+def close_pairs_in_cluster(cluster, min=MIN_DISTANCE, max=MAX_DISTANCE, timestamp=None):
+    return get_close_pairs(cluster_coordinates(cluster, timestamp), min, max)
+
+
+def close_pair_indexes(xyz, min=MIN_DISTANCE, max=MAX_DISTANCE):
+    """Find the pairs of points with a distance between min and max
+
+    :param xyz: array of coordinates, with shape (n, 3).
+    :return: array of index pairs (i, j), with i < j, sorted.
+
+    """
+    if len(xyz) < 2:
+        return empty((0, 2), dtype=int)
+    pairs = cKDTree(xyz).query_pairs(max, output_type='ndarray')
+    distances = sqrt(((xyz[pairs[:, 0]] - xyz[pairs[:, 1]]) ** 2).sum(axis=1))
+    pairs = pairs[(distances > min) & (distances < max)]
+    return pairs[lexsort((pairs[:, 1], pairs[:, 0]))]
 
 
 def get_close_pairs(coordinates, min=MIN_DISTANCE, max=MAX_DISTANCE):
-    pairs = [(sc1[0], sc2[0]) for sc1, sc2 in combinations(coordinates, 2) if min < distance(sc1[1], sc2[1]) < max]
-    return pairs
+    if not coordinates:
+        return []
+    station_numbers, xyz = zip(*coordinates)
+    pairs = close_pair_indexes(array(xyz), min, max)
+    return [(station_numbers[i], station_numbers[j]) for i, j in pairs]
 
 
-def close_triples_in_network(min=MIN_DISTANCE, max=MAX_DISTANCE):
+def close_triples_in_network(min=MIN_DISTANCE, max=MAX_DISTANCE, timestamp=None):
     """Find triples of stations
 
     The distances between each of the station pairs in the set must be within
     the min and max value.
 
     """
-    cluster = HiSPARCNetwork(force_stale=True)
-    return close_triples_in_cluster(cluster, min, max)
+    return get_close_triples(network_coordinates(timestamp), min, max)
 
 
-def close_triples_in_cluster(cluster, min=MIN_DISTANCE, max=MAX_DISTANCE):
-    station_numbers = []
-    coordinates = []
-    for station in cluster.stations:
-        try:
-            testing.assert_allclose(station.get_lla_coordinates(), (0.0, 0.0, 0.0), atol=1e-7)
-        except AssertionError:
-            # Not invalid GPS
-            station_numbers.append(station.number)
-            coordinates.append(array(station.calc_center_of_mass_coordinates()))
-    return get_close_triples(list(zip(station_numbers, coordinates)), min, max)
+def close_triples_in_cluster(cluster, min=MIN_DISTANCE, max=MAX_DISTANCE, timestamp=None):
+    return get_close_triples(cluster_coordinates(cluster, timestamp), min, max)
+
+
+def close_triple_indexes(xyz, min=MIN_DISTANCE, max=MAX_DISTANCE):
+    """Find the triples of points with all distances between min and max
+
+    Each close pair (i, j) is extended with the points k > j which are
+    close to both i and j.
+
+    :param xyz: array of coordinates, with shape (n, 3).
+    :return: array of index triples (i, j, k), with i < j < k, sorted.
+
+    """
+    pairs = close_pair_indexes(xyz, min, max)
+    neighbours = [set() for _ in range(len(xyz))]
+    for i, j in pairs:
+        neighbours[i].add(j)
+    triples = [(i, j, k) for i, j in pairs for k in sorted(neighbours[i] & neighbours[j])]
+    return array(triples, dtype=int).reshape(-1, 3)
 
 
 def get_close_triples(coordinates, min=MIN_DISTANCE, max=MAX_DISTANCE):
-    triples = [
-        (sc1[0], sc2[0], sc3[0])
-        for sc1, sc2, sc3 in combinations(coordinates, 3)
-        if all(min < distance(sp1, sp2) < max for sp1, sp2 in combinations((sc1[1], sc2[1], sc3[1]), 2))
-    ]
-    return triples
+    if not coordinates:
+        return []
+    station_numbers, xyz = zip(*coordinates)
+    triples = close_triple_indexes(array(xyz), min, max)
+    return [(station_numbers[i], station_numbers[j], station_numbers[k]) for i, j, k in triples]
 
 
 def distance(c1, c2):
@@ -4,31 +4,32 @@ from artist import Plot
 
 from sapphire import HiSPARCStations
 
+from .geometry_timeline import GeometryTimeline
 from .station_distances import close_pairs_in_network
 
 
 def variable_distance_pairs(pairs):
-    variable_pairs = [min_max_distance_pair(pair) for pair in pairs]
+    stations = sorted({station for pair in pairs for station in pair})
+    timeline = GeometryTimeline(HiSPARCStations(stations, force_stale=True))
+    variable_pairs = [min_max_distance_pair(pair, timeline) for pair in pairs]
     return variable_pairs
 
 
-def min_max_distance_pair(pair):
+def min_max_distance_pair(pair, timeline=None):
     """Calculate station distance for all timestamps
 
     For each timestamp (GPS and station layout) calculate the station
     distances.
 
+    :param pair: tuple of two station numbers.
+    :param timeline: GeometryTimeline containing the stations, if not
+                     given one is made for the pair.
+
     """
-    c = HiSPARCStations(pair, force_stale=True)
-    ts = list(c.stations[0].timestamps)
-    ts += list(c.stations[1].timestamps)
-    ts += list(c.stations[0].detectors[0].timestamps)
-    ts += list(c.stations[1].detectors[0].timestamps)
-    distances = []
-    for t in sorted(ts):
-        c.set_timestamp(t)
-        distances.append(c.calc_distance_between_stations(*pair))
-    return (min(distances), max(distances))
+    if timeline is None:
+        timeline = GeometryTimeline(HiSPARCStations(pair, force_stale=True))
+    distances = timeline.distance(*pair, timeline.change_timestamps(pair))
+    return (distances.min(), distances.max())
 
 
 def plot_min_max(variable_pairs):
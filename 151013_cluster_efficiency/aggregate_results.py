@@ -0,0 +1,128 @@
+"""Combine results of many simulation files using a process pool
+
+A function is applied to each result file in a worker process, the
+results are combined in the main process as soon as they arrive. The
+function either returns columns of values, which are copied into a
+single preallocated array per column, or histograms, which are summed
+per key in a :class:`HistogramAccumulator`.
+
+The function must be defined at module level, so that it can be sent to
+the worker processes.
+
+Example::
+
+    columns = collect_columns(read_reconstructions, glob.glob(PATHS), names=COLUMNS)
+    histograms = collect_histograms(core_distance_histograms, glob.glob(PATHS))
+
+"""
+import multiprocessing
+
+from numpy import array, empty
+
+from sapphire.utils import pbar
+
+
+def map_files(function, paths, processes=None):
+    """Apply a function to each file in a pool of worker processes
+
+    :param function: function which takes the path of a file.
+    :param paths: paths of the files.
+    :param processes: number of worker processes, defaults to the number
+                      of cpus.
+    :return: generator of the results, in the order of the paths.
+
+    """
+    with multiprocessing.Pool(processes) as worker_pool:
+        yield from pbar(worker_pool.imap(function, paths), length=len(paths))
+
+
+def collect_columns(function, paths, processes=None, names=()):
+    """Concatenate the columns returned for each file
+
+    The values are copied into an array per column as the results
+    arrive, the arrays grow by doubling their size when needed.
+
+    :param function: function which returns a dictionary of one
+                     dimensional arrays for a file. The columns may have
+                     different lengths, but the names must be the same
+                     for each file.
+    :param names: names of columns which are always returned, as empty
+                  arrays if there are no files.
+    :return: dictionary with an array for each column.
+
+    """
+    columns = dict.fromkeys(names)
+    lengths = dict.fromkeys(names, 0)
+    for result in map_files(function, paths, processes):
+        for name, values in result.items():
+            values = array(values)
+            column = columns.get(name)
+            length = lengths.get(name, 0)
+            stop = length + len(values)
+            if column is None:
+                columns[name] = empty(stop, dtype=values.dtype)
+            elif len(column) < stop:
+                columns[name] = empty(max(stop, 2 * len(column)), dtype=column.dtype)
+                columns[name][:length] = column[:length]
+            columns[name][length:stop] = values
+            lengths[name] = stop
+    return {name: empty(0) if column is None else column[: lengths[name]] for name, column in columns.items()}
+
+
+def collect_histograms(function, paths, processes=None):
+    """Sum the histograms returned for each file
+
+    :param function: function which returns a list of (key, counts)
+                     tuples for a file, with counts the histogram for
+                     that key.
+    :return: :class:`HistogramAccumulator` with the summed histograms.
+
+    """
+    accumulator = HistogramAccumulator()
+    for result in map_files(function, paths, processes):
+        for key, counts in result:
+            accumulator.add(key, counts)
+    return accumulator
+
+
+class HistogramAccumulator:
+
+    """Sums of histograms for each key
+
+    Accumulators filled in different processes are combined with
+    :meth:`merge`.
+
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def keys(self):
+        return self.counts.keys()
+
+    def items(self):
+        return self.counts.items()
+
+    def add(self, key, counts):
+        """Add a histogram to the sum for the key"""
+
+        if key in self.counts:
+            self.counts[key] = self.counts[key] + counts
+        else:
+            self.counts[key] = array(counts)
+
+    def merge(self, other):
+        """Add all histograms of another accumulator"""
+
+        for key, counts in other.items():
+            self.add(key, counts)
+        return self
@@ -2,66 +2,73 @@ import glob
 
 import tables
 
-from numpy import arange, array, degrees, histogram, histogram2d, isnan, linspace, log10, pi, radians, sin, sqrt, where
+from numpy import arange, degrees, histogram, histogram2d, isnan, linspace, log10, pi, radians, sin, sqrt, where
 
 from artist import MultiPlot, Plot
 
-from sapphire.utils import pbar
+from .aggregate_results import collect_columns
 
 # PATHS = '/Users/arne/Datastore/cluster_efficiency/151013*.h5'
 # PATHS = '/Users/arne/Datastore/cluster_efficiency/151014_*.h5'
 PATHS = '/Users/arne/Datastore/cluster_efficiency/15101*.h5'
+COLUMNS = [
+    'zenith',
+    'zenith_in',
+    'azimuth',
+    'azimuth_in',
+    'energy_in',
+    'size_in',
+    'r_in',
+    'zenith_init',
+    'azimuth_init',
+    'energy_init',
+    'size_init',
+    'r_init',
+]
+
+
+def read_reconstructions(path):
+    """Read the reconstructions and their input from a result file"""
+
+    with tables.open_file(path, 'r') as data:
+        recs = data.root.coincidences.reconstructions.read()
+    filtered_recs = recs.compress(
+        recs['s501'] & recs['s502'] & recs['s503'] & recs['s504'] & recs['s505'] & recs['s506']
+    )
+    return {
+        'zenith': degrees(filtered_recs['zenith']),
+        'zenith_in': degrees(filtered_recs['reference_zenith']),
+        'azimuth': degrees(filtered_recs['azimuth']),
+        'azimuth_in': degrees(filtered_recs['reference_azimuth']),
+        'energy_in': log10(filtered_recs['reference_energy']),
+        'size_in': log10(filtered_recs['reference_size']),
+        'r_in': sqrt(filtered_recs['reference_x'] ** 2 + filtered_recs['reference_y'] ** 2),
+        'zenith_init': degrees(recs['reference_zenith']),
+        'azimuth_init': degrees(recs['reference_azimuth']),
+        'energy_init': log10(recs['reference_energy']),
+        'size_init': log10(recs['reference_size']),
+        'r_init': sqrt(recs['reference_x'] ** 2 + recs['reference_y'] ** 2),
+    }
 
 
 def get_combined_results():
-    zenith = []
-    zenith_in = []
-    azimuth = []
-    azimuth_in = []
-    energy_in = []
-    size_in = []
-    r_in = []
-
-    zenith_init = []
-    azimuth_init = []
-    energy_init = []
-    size_init = []
-    r_init = []
-
-    for path in pbar(glob.glob(PATHS)):
-        with tables.open_file(path, 'r') as data:
-            recs = data.root.coincidences.reconstructions
-            filtered_recs = recs.read_where('s501 & s502 & s503 & s504 & s505 & s506')
-            zenith.extend(degrees(filtered_recs['zenith']))
-            zenith_in.extend(degrees(filtered_recs['reference_zenith']))
-            azimuth.extend(degrees(filtered_recs['azimuth']))
-            azimuth_in.extend(degrees(filtered_recs['reference_azimuth']))
-            energy_in.extend(log10(filtered_recs['reference_energy']))
-            size_in.extend(log10(filtered_recs['reference_size']))
-            r_in.extend(sqrt(filtered_recs['reference_x'] ** 2 + filtered_recs['reference_y'] ** 2))
-
-            zenith_init.extend(degrees(recs.col('reference_zenith')))
-            azimuth_init.extend(degrees(recs.col('reference_azimuth')))
-            energy_init.extend(log10(recs.col('reference_energy')))
-            size_init.extend(log10(recs.col('reference_size')))
-            r_init.extend(sqrt(recs.col('reference_x') ** 2 + recs.col('reference_y') ** 2))
-
-    zenith = array(zenith)
-    filter = ~isnan(zenith)
-
-    zenith = zenith.compress(filter)
-    zenith_in = array(zenith_in).compress(filter)
-    azimuth = array(azimuth).compress(filter)
-    azimuth_in = array(azimuth_in).compress(filter)
-    energy_in = array(energy_in).compress(filter)
-    size_in = array(size_in).compress(filter)
-    r_in = array(r_in).compress(filter)
-
-    zenith_init = array(zenith_init)
-    azimuth_init = array(azimuth_init)
-    energy_init = array(energy_init)
-    size_init = array(size_init)
-    r_init = array(r_init)
+    columns = collect_columns(read_reconstructions, glob.glob(PATHS), names=COLUMNS)
+
+    filter = ~isnan(columns['zenith'])
+
+    zenith = columns['zenith'].compress(filter)
+    zenith_in = columns['zenith_in'].compress(filter)
+    azimuth = columns['azimuth'].compress(filter)
+    azimuth_in = columns['azimuth_in'].compress(filter)
+    energy_in = columns['energy_in'].compress(filter)
+    size_in = columns['size_in'].compress(filter)
+    r_in = columns['r_in'].compress(filter)
+
+    zenith_init = columns['zenith_init']
+    azimuth_init = columns['azimuth_init']
+    energy_init = columns['energy_init']
+    size_init = columns['size_init']
+    r_init = columns['r_init']
 
     print(sum(filter), len(filter))
 
@@ -2,69 +2,61 @@ from datetime import date
 
 from numpy import argsort, array, average
 from numpy import max as npmax
-from numpy import where, zeros
+from numpy import where
 from scipy.stats import binned_statistic
 
 from artist import Plot
 
 from sapphire import Network, Station
 from sapphire.transformations.clock import datetime_to_gps
-from sapphire.utils import pbar
+
+from .rate_cube import RateCube, is_active
 
 YEARS = list(range(2004, 2017))
 SPA_STATIONS = [501, 502, 503, 504, 505, 506, 508, 509, 510, 511]
 
 
-def get_eventtime_data(station):
-    """Get eventtime data"""
-    return Station(station, force_stale=True).event_time()
-
-
 def get_station_numbers():
     """Get all station numbers"""
     return Network(force_stale=True).station_numbers()
 
 
-def get_data():
-    """Read all eventtime data into a dictionary"""
-    return {s: get_eventtime_data(s) for s in pbar(get_station_numbers())}
+def get_cube(station_numbers=None):
+    """Get the rate cube, containing the eventtime data of the stations"""
 
+    if station_numbers is None:
+        station_numbers = get_station_numbers()
+    cube = RateCube()
+    cube.ensure(station_numbers)
+    return cube
 
-def get_station_end_timestamp(station, data):
-    """Read all eventtime data into a dictionary"""
+
+def get_station_end_timestamp(station, cube):
+    """Get the end of the eventtime data of inactive stations"""
 
     if Station(station, force_stale=True).info['active']:
         return None
     else:
-        # Start of day after last day with data
-        return data[station]['timestamp'][-1] + 3600
+        # Start of hour after last hour with data
+        return cube.station_range(station)[1] + 3600
 
 
-def get_aligned(data):
-    """Get data and align it in an array
+def get_aligned(cube, station_numbers):
+    """Get the aligned data from the rate cube
 
     Data from a station is on a row, the columns are the hourly bins.
 
+    :param cube: RateCube containing the stations.
+    :param station_numbers: stations to get, in the order of the rows.
     :return: several things are returned:
         - the aligned data filtered for number of events in the hour
         - the aligned data unfiltered
         - first and last timestamp of the array
 
     """
-    first = min(values['timestamp'][0] for values in list(data.values()))
-    last = max(values['timestamp'][-1] for values in list(data.values()))
-
-    aligned_data = zeros((len(list(data.keys())), (last - first) / 3600 + 1))
-    aligned_data_all = zeros((len(list(data.keys())), (last - first) / 3600 + 1))
-
-    for i, sn in enumerate(sorted(data.keys())):
-        start = (data[sn]['timestamp'][0] - first) / 3600
-        end = start + len(data[sn])
-        aligned_data[i, start:end] = where(
-            (data[sn]['counts'] > 500) & (data[sn]['counts'] < 5000), data[sn]['counts'], 0
-        )
-        aligned_data_all[i, start:end] = data[sn]['counts']
-    return aligned_data, aligned_data_all, first, last
+    timestamps, aligned_data_all = cube.get_counts(station_numbers)
+    aligned_data = where(is_active(aligned_data_all), aligned_data_all, 0)
+    return aligned_data, aligned_data_all, timestamps[0], timestamps[-1]
 
 
 def plot_luminosity(timestamp, aligned_data, aligned_data_all, i):
@@ -85,7 +77,7 @@ def plot_luminosity(timestamp, aligned_data, aligned_data_all, i):
     plot.save_as_pdf('luminosity_%s' % ['network', 'spa'][i])
 
 
-def plot_active_stations(timestamps, stations, aligned_data, data, i):
+def plot_active_stations(timestamps, stations, aligned_data, cube, i):
 
     first_ts = []
     last_ts = []
@@ -108,7 +100,7 @@ def plot_active_stations(timestamps, stations, aligned_data, data, i):
                 prev_ts = 0
 
     for station in stations_with_data:
-        end_ts = get_station_end_timestamp(station, data)
+        end_ts = get_station_end_timestamp(station, cube)
         if end_ts is not None:
             last_ts.append(end_ts)
 
@@ -142,13 +134,11 @@ def plot_active_stations(timestamps, stations, aligned_data, data, i):
 
 
 if __name__ == "__main__":
-    if 'data' not in globals():
-        data = get_data()
-        data_spa = {s: data[s] for s in SPA_STATIONS}
+    if 'cube' not in globals():
+        cube = get_cube()
 
-    for i, d in enumerate([data, data_spa]):
-        stations = sorted(d.keys())
-        aligned_data, aligned_data_all, first, last = get_aligned(d)
+    for i, stations in enumerate([cube.stations, SPA_STATIONS]):
+        aligned_data, aligned_data_all, first, last = get_aligned(cube, stations)
         timestamp = list(range(first, last + 1, 3600))
-        plot_active_stations(timestamp, stations, aligned_data, d, i)
+        plot_active_stations(timestamp, stations, aligned_data, cube, i)
         plot_luminosity(timestamp, aligned_data, aligned_data_all, i)
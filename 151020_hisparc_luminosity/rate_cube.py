@@ -0,0 +1,262 @@
+"""Hourly event rates of all stations in a single array
+
+The eventtime histograms of the stations contain the number of events in
+each hour. Aligning these histograms for the entire network requires
+parsing the eventtime data of hundreds of stations. This module stores
+the aligned histograms once, in a memory-mapped uint16 array with a row
+per station and a column per hour since FIRST_HOUR.
+
+The array is updated incrementally, only the hours after the last stored
+hour of a station are added. Queries for the number of active stations,
+the luminosity and the exposure read the stored array.
+
+Run this module to add the latest eventtime data to the stored array.
+
+Example::
+
+    cube = RateCube()
+    cube.ensure([501, 502])
+    timestamps, n_active = cube.n_active([501, 502])
+
+"""
+import os
+
+from datetime import date, datetime
+
+from numpy import arange, array, iinfo, load, minimum, save, uint16, where, zeros
+from numpy.lib.format import open_memmap
+
+from sapphire import Network, Station
+from sapphire.transformations.clock import datetime_to_gps
+from sapphire.utils import pbar
+
+CUBE_PATH = '/Users/arne/Datastore/rate_cube'
+FIRST_HOUR = datetime_to_gps(date(2004, 1, 1))
+HOUR = 3600
+GROW_HOURS = 24 * 365
+MIN_COUNTS = 500
+MAX_COUNTS = 5000
+INDEX_DTYPE = [('station', 'u4'), ('start', 'u4'), ('stop', 'u4')]
+
+
+def is_active(counts):
+    """Check if the number of events in an hour is reasonable"""
+
+    return (counts > MIN_COUNTS) & (counts < MAX_COUNTS)
+
+
+class RateCube:
+
+    """Stored number of events per hour for each station
+
+    The rows of the array are in the order in which stations were added,
+    the index contains the station number and the range of hours with
+    data (start, stop) for each row. Stations without eventtime data get
+    a row with an empty range.
+
+    :param path: directory in which the array is stored.
+
+    """
+
+    def __init__(self, path=CUBE_PATH):
+        self.index_path = os.path.join(path, 'index.npy')
+        self.counts_path = os.path.join(path, 'counts.npy')
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.index_path):
+            self.index = load(self.index_path)
+            self.counts = open_memmap(self.counts_path, mode='r+')
+        else:
+            self.index = zeros(0, dtype=INDEX_DTYPE)
+            self.counts = zeros((0, 0), dtype=uint16)
+        self.rows = {int(station): row for row, station in enumerate(self.index['station'])}
+
+    def __contains__(self, station):
+        return station in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def stations(self):
+        """Sorted station numbers of the stations in the array"""
+
+        return sorted(self.rows)
+
+    def update(self, station_numbers=None):
+        """Add new eventtime data of stations to the array
+
+        :param station_numbers: stations to update, defaults to all
+                                stations in the network.
+
+        """
+        if station_numbers is None:
+            station_numbers = Network(force_stale=True).station_numbers()
+        n_stations = len(set(self.rows) | set(station_numbers))
+        n_hours = (datetime_to_gps(datetime.utcnow()) - FIRST_HOUR) // HOUR + 1
+        self.resize(n_stations, n_hours)
+
+        for station in pbar(station_numbers):
+            try:
+                eventtime = Station(station, force_stale=True).event_time()
+            except RuntimeError:
+                # No eventtime data, store an empty range
+                self.add(station, [], [])
+                continue
+            self.add(station, eventtime['timestamp'], eventtime['counts'])
+        self.counts.flush()
+        self.save_index()
+
+    def ensure(self, station_numbers):
+        """Add the stations which are not yet in the array"""
+
+        missing = [station for station in station_numbers if station not in self.rows]
+        if missing:
+            self.update(missing)
+
+    def add(self, station, timestamps, counts):
+        """Store the counts of the hours after the last stored hour
+
+        :param station: station number.
+        :param timestamps: start timestamps of the hours.
+        :param counts: number of events in each hour.
+
+        """
+        hours = (array(timestamps, dtype='i8') - FIRST_HOUR) // HOUR
+        row = self.rows.get(station)
+        if row is None:
+            row = len(self.rows)
+            self.rows[station] = row
+            self.index.resize(row + 1, refcheck=False)
+            self.index[row] = (station, 0, 0)
+            self.resize(len(self.rows), 0)
+        start, stop = self.index[row][['start', 'stop']].tolist()
+        new = hours >= stop
+        hours = hours[new]
+        if not len(hours):
+            return
+        counts = minimum(array(counts)[new], iinfo(uint16).max)
+
+        if start == stop:
+            self.index['start'][row] = hours[0]
+        self.resize(len(self.rows), hours[-1] + 1)
+
+        self.counts[row, hours] = counts
+        self.index['stop'][row] = hours[-1] + 1
+
+    def resize(self, n_stations, n_hours):
+        """Make sure the array can contain the given number of stations and hours
+
+        The stored array is copied to a larger file if needed, room for
+        additional hours is reserved to reduce the number of copies.
+
+        """
+        old_stations, old_hours = self.counts.shape
+        if n_stations <= old_stations and n_hours <= old_hours:
+            return
+        if n_hours > old_hours:
+            n_hours += GROW_HOURS
+        shape = (int(max(n_stations, old_stations)), int(max(n_hours, old_hours)))
+
+        tmp_path = self.counts_path + '.tmp'
+        counts = open_memmap(tmp_path, mode='w+', dtype=uint16, shape=shape)
+        for row in range(old_stations):
+            counts[row, :old_hours] = self.counts[row]
+        counts.flush()
+        del counts
+        self.counts = None
+        os.replace(tmp_path, self.counts_path)
+        self.counts = open_memmap(self.counts_path, mode='r+')
+
+    def save_index(self):
+        """Write the index of the stored stations to disk"""
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            save(index_file, self.index)
+        os.replace(tmp_path, self.index_path)
+
+    def station_range(self, station):
+        """Get the first and last timestamp with data for a station"""
+
+        start, stop = self.index[self.rows[station]][['start', 'stop']].tolist()
+        return FIRST_HOUR + start * HOUR, FIRST_HOUR + (stop - 1) * HOUR
+
+    def get_counts(self, station_numbers=None, start=None, stop=None):
+        """Get the aligned event counts of stations
+
+        :param station_numbers: stations to get, defaults to all stations.
+        :param start,stop: range of timestamps, defaults to the hours
+                           between the first and last hour with data of
+                           the stations.
+        :return: timestamps of the hours and array with the counts, with
+                 a row for each station.
+
+        """
+        if station_numbers is None:
+            station_numbers = self.stations
+        rows = [self.rows[station] for station in station_numbers]
+        index = self.index[rows]
+        index = index[index['stop'] > index['start']]
+        if start is None:
+            first = index['start'].min() if len(index) else 0
+        else:
+            first = max((start - FIRST_HOUR) // HOUR, 0)
+        if stop is None:
+            last = index['stop'].max() if len(index) else 0
+        else:
+            last = max((stop - FIRST_HOUR) // HOUR, first)
+
+        timestamps = FIRST_HOUR + arange(first, last, dtype='i8') * HOUR
+        counts = zeros((len(rows), len(timestamps)), dtype=uint16)
+        available = min(last, self.counts.shape[1])
+        if available > first:
+            counts[:, : available - first] = self.counts[rows, first:available]
+        return timestamps, counts
+
+    def active(self, *args, **kwargs):
+        """Get hours in which each of the stations was active
+
+        Takes the same arguments as :meth:`get_counts`.
+
+        :return: timestamps of the hours and boolean array.
+
+        """
+        timestamps, counts = self.get_counts(*args, **kwargs)
+        return timestamps, is_active(counts)
+
+    def n_active(self, *args, **kwargs):
+        """Get the number of active stations for each hour
+
+        Takes the same arguments as :meth:`get_counts`.
+
+        """
+        timestamps, active = self.active(*args, **kwargs)
+        return timestamps, active.sum(axis=0)
+
+    def luminosity(self, *args, **kwargs):
+        """Get the total number of events of active stations for each hour
+
+        Takes the same arguments as :meth:`get_counts`.
+
+        """
+        timestamps, counts = self.get_counts(*args, **kwargs)
+        return timestamps, where(is_active(counts), counts, 0).sum(axis=0)
+
+    def exposure(self, station_numbers, min_n=None, start=None, stop=None):
+        """Get the time in which enough of the stations were active
+
+        :param station_numbers: stations to consider.
+        :param min_n: minimum number of active stations, defaults to all.
+        :param start,stop: range of timestamps.
+        :return: total exposure time in seconds.
+
+        """
+        if min_n is None:
+            min_n = len(station_numbers)
+        _, n_active = self.n_active(station_numbers, start, stop)
+        return int((n_active >= min_n).sum()) * HOUR
+
+
+if __name__ == "__main__":
+    RateCube().update()
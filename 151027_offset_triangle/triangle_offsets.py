@@ -1,10 +1,9 @@
 """Check if the offsets remain consistent if calculated via other stations"""
 
 from datetime import datetime
-from functools import partial
 from itertools import combinations, permutations
 
-from numpy import array, histogram, histogram2d, isnan, nanmean
+from numpy import arange, array, broadcast_to, concatenate, full, histogram, histogram2d, isnan, nanmean, split, zeros
 
 from artist import Plot
 
@@ -14,83 +13,128 @@ START = datetime_to_gps(datetime(2011, 6, 1))
 STOP = datetime_to_gps(datetime(2016, 2, 1))
 STEP = int(86400 * 1)
 STATIONS = [501, 502, 503, 504, 505, 506, 508, 509, 510, 511]
+CHUNK_SIZE = 10_000_000  # number of residuals per chunk
 
 
-def get_offsets():
-    """Setup nested dictionary with station timing offsets
+def get_offsets(stations=STATIONS):
+    """Setup nested dictionary with station timing offset histories
 
-    The result looks like this:
+    The offsets for all pairs are retrieved once. The result looks like
+    this:
 
-        {reference1: {station1: func, station2: func}, reference2: {...}, ...}
+        {reference1: {station1: array, station2: array}, reference2: {...}, ...}
 
-    Get the offset (and error) between 501-502 on timestamp 1425168000 using:
-
-        offsets[501][502](1425168000)
-        # (6.1, 0.72)
+    Each array contains the columns timestamp, offset and error. Use
+    :func:`get_aligned_offsets` to evaluate the offsets for timestamps.
 
     """
+    station_objects = {s: Station(s, force_stale=True) for s in stations}
     offsets = {
-        ref: {
-            s: partial(Station(s, force_stale=True).station_timing_offset, reference_station=ref)
-            for s in STATIONS
-            if not s == ref
-        }
-        for ref in STATIONS
+        ref: {s: station_objects[s].station_timing_offsets(ref) for s in stations if not s == ref} for ref in stations
     }
     return offsets
 
 
 def get_aligned_offsets(*args, **kwargs):
-    """Get dictionary of dictionaries with arrays with offsets"""
-    return get_aligned_data(0, *args, **kwargs)
+    """Get array with offsets between all stations"""
+    return get_aligned_data('offset', *args, **kwargs)
 
 
-def get_aligned_errors(offsets, start=START, stop=STOP, step=STEP):
-    """Get dictionary of dictionaries with arrays with errors"""
-    return get_aligned_data(1, *args, **kwargs)
+def get_aligned_errors(*args, **kwargs):
+    """Get array with offset errors between all stations"""
+    return get_aligned_data('error', *args, **kwargs)
 
 
-def get_aligned_data(idx, offsets, start=START, stop=STOP, step=STEP):
-    """Get dictionary of dictionaries with arrays with offsets or errors"""
+def get_aligned_data(field, offsets, start=START, stop=STOP, step=STEP):
+    """Get array with offsets or errors between all stations over time
 
-    timestamps = list(range(start, stop, step))
-    aoffsets = {
-        ref: {s: array([o(ts)[0] for ts in timestamps]) for s, o in stations.items()}
-        for ref, stations in offsets.items()
-    }
+    Like ``Station.station_timing_offset`` the last value before each
+    timestamp is used, looked up for all timestamps at once.
+
+    :param field: either 'offset' or 'error'.
+    :param offsets: nested dictionary with the offset histories, from
+                    :func:`get_offsets`.
+    :param start,stop,step: the range of timestamps.
+    :return: array with shape (n_reference, n_station, n_timestamps), the
+             stations are in the order of the offsets keys. The offset of a
+             station to itself is 0.
+
+    """
+    timestamps = arange(start, stop, step)
+    stations = list(offsets.keys())
+    aoffsets = zeros((len(stations), len(stations), len(timestamps)))
+    for i, ref in enumerate(stations):
+        for j, s in enumerate(stations):
+            if s == ref:
+                continue
+            history = offsets[ref][s]
+            idx = history['timestamp'].searchsorted(timestamps, side='right') - 1
+            aoffsets[i, j] = history[field][idx.clip(0)]
     return aoffsets
 
 
+def closure_paths(n_stations, n, ordered=False):
+    """Get all paths which start and end at a reference station
+
+    :param n_stations: number of stations.
+    :param n: number of intermediate stations.
+    :param ordered: if True all permutations of the intermediate stations
+                    are used, otherwise only the combinations.
+    :return: array with shape (n_paths, n + 2) with the indexes of the
+             stations along each path.
+
+    """
+    paths = []
+    for ref in range(n_stations):
+        others = [s for s in range(n_stations) if s != ref]
+        via = array(list((permutations if ordered else combinations)(others, n)))
+        ref_column = full((len(via), 1), ref)
+        paths.append(concatenate([ref_column, via, ref_column], axis=1))
+    return concatenate(paths)
+
+
+def closure_residuals(aoffsets, paths, chunk_size=CHUNK_SIZE):
+    """Generator for the offset residuals of closed paths
+
+    The offsets of the hops of the paths are gathered from the aligned
+    offsets and added one hop at a time. This is done for chunks of paths,
+    to limit the memory use.
+
+    :param aoffsets: aligned offsets, from :func:`get_aligned_offsets`.
+    :param paths: the paths, from :func:`closure_paths`.
+    :param chunk_size: approximate number of residuals per chunk.
+    :return: generator for arrays with shape (n_paths, n_timestamps) with
+             the residuals of a chunk of paths.
+
+    """
+    paths_per_chunk = max(1, chunk_size // aoffsets.shape[-1])
+    for chunk in split(paths, range(paths_per_chunk, len(paths), paths_per_chunk)):
+        residuals = aoffsets[chunk[:, 0], chunk[:, 1]]
+        for hop in range(1, chunk.shape[1] - 1):
+            residuals += aoffsets[chunk[:, hop], chunk[:, hop + 1]]
+        yield residuals
+
+
 def round_trip(offsets):
     """Examine offset distribution using intermediate stations over time
 
     Start and end station are the same, but hops via some other stations.
     The result should ideally be an offset of 0 ns.
 
-    :param offsets: Dictionary of dictionaries with offset functions.
+    :param offsets: Dictionary of dictionaries with offset histories.
 
     """
     aoffsets = get_aligned_offsets(offsets, START, STOP, STEP)
-    timestamps = list(range(START, STOP, STEP))
-    stations = list(offsets.keys())
+    timestamps = arange(START, STOP, STEP)
+    bins = (timestamps[::4], list(range(-100, 101, 5)))
     for n in [2, 3, 4, 5]:
         plot = Plot()
-        ts = []
-        offs = []
-        for ref in stations:
-            # Intermediate stations
-            for s in combinations(stations, n):
-                if ref in s:
-                    continue
-                offs.extend(
-                    aoffsets[ref][s[0]] + aoffsets[s[-1]][ref] + sum(aoffsets[s[i]][s[i + 1]] for i in range(n - 1))
-                )
-                ts.extend(timestamps)
-        ts = array(ts)
-        offs = array(offs)
-        ts = ts.compress(~isnan(offs))
-        offs = offs.compress(~isnan(offs))
-        counts, xedges, yedges = histogram2d(ts, offs, bins=(timestamps[::4], list(range(-100, 101, 5))))
+        counts = 0
+        for offs in closure_residuals(aoffsets, closure_paths(len(offsets), n)):
+            ts = broadcast_to(timestamps, offs.shape)
+            valid = ~isnan(offs)
+            chunk_counts, xedges, yedges = histogram2d(ts[valid], offs[valid], bins=bins)
+            counts += chunk_counts
         plot.histogram2d(counts, xedges, yedges, bitmap=True, type='color', colormap='viridis')
         plot.set_colorbar()
         plot.set_ylimits(-100, 100)
@@ -106,23 +150,18 @@ def offset_distribution(offsets):
     Start and end station are the same, but hops via some other stations.
     The result should ideally be an offset of 0 ns.
 
-    :param offsets: Dictionary of dictionaries with offset functions.
+    :param offsets: Dictionary of dictionaries with offset histories.
 
     """
     aoffsets = get_aligned_offsets(offsets, START, STOP, STEP)
-
-    stations = list(offsets.keys())
+    bins = list(range(-100, 100, 2))
     for n in [2, 3, 4, 5]:
         plot = Plot()
-        offs = []
-        for ref in stations:
-            for s in permutations(stations, n):
-                if ref in s:
-                    continue
-                offs.extend(
-                    aoffsets[ref][s[0]] + aoffsets[s[-1]][ref] + sum(aoffsets[s[i]][s[i + 1]] for i in range(n - 1))
-                )
-        plot.histogram(*histogram(offs, bins=list(range(-100, 100, 2))))
+        counts = 0
+        for offs in closure_residuals(aoffsets, closure_paths(len(offsets), n, ordered=True)):
+            chunk_counts, bins = histogram(offs[~isnan(offs)], bins=bins)
+            counts += chunk_counts
+        plot.histogram(counts, bins)
         plot.set_xlimits(-100, 100)
         plot.set_ylimits(min=0)
         plot.set_title('n = %d' % n)
@@ -133,27 +172,27 @@ def offset_distribution(offsets):
 def stopover(offsets):
     """Compare direct to via offsets for stations far appart
 
-    :param offsets: Dictionary of dictionaries with offset functions.
+    :param offsets: Dictionary of dictionaries with offset histories.
 
     """
     aoffsets = get_aligned_offsets(offsets, START, STOP, STEP)
     timestamps = list(range(START, STOP, STEP))
 
     stations = list(offsets.keys())
-    for from_station, to_station in combinations(stations, 2):
+    for (from_idx, from_station), (to_idx, to_station) in combinations(enumerate(stations), 2):
         plot = Plot()
         all_offs = []
 
         for i, via_station in enumerate(stations):
             if via_station in [from_station, to_station]:
                 continue
-            offs = aoffsets[from_station][via_station] + aoffsets[via_station][to_station]
+            offs = aoffsets[from_idx][i] + aoffsets[i][to_idx]
 
             all_offs.append(offs)
 
             plot.plot(timestamps, offs, linestyle='very thin, black!%d' % (i * 5 + 30), mark=None)
 
-        offs = aoffsets[from_station][to_station]
+        offs = aoffsets[from_idx][to_idx]
         plot.plot(timestamps, offs, linestyle='red', mark=None)
         # all_offs.append(offs)
 
@@ -1,15 +1,169 @@
+"""Sort the ground particles of huge CORSIKA stores by x
+
+The ground particles are sorted with a bounded amount of memory. First
+chunks of the unsorted table are sorted and stored as runs in a
+temporary file. Then the runs are merged into the target table, keeping
+only a block of each run in memory.
+
+The progress is stored in the temporary file after each run and each
+merged block, so an interrupted sort continues where it stopped. Several
+seeds are sorted at the same time. When a seed is done the
+tmp_sorted_flag file is written next to the sorted file, this is the
+marker used by 150624_energy_simulations/get_seeds.py.
+
+"""
+import multiprocessing
+import os
+
 import tables
 
-from sapphire.corsika.store_corsika_data import copy_and_sort_node
+from numpy import argsort, concatenate, inf, zeros
+
+from sapphire.corsika.store_corsika_data import create_index
 
 PATH = "/Volumes/Tendrando Arms/Corsika_datastore/%s/"
 SOURCE = PATH + 'corsika_unsorted.h5'
 TARGET = PATH + 'corsika.h5'
+RUNS = PATH + 'corsika_runs.h5'
+FLAG = PATH + 'tmp_sorted_flag'
+TABLE = 'groundparticles'
+SORTBY = 'x'
+CHUNK_SIZE = 5_000_000
+BLOCK_SIZE = 250_000
 seeds = ['137072066_411190751', '469096318_149263382', '686616026_423396879', '870131152_235443703']
 
+
+def sort_runs(source_table, runs):
+    """Sort chunks of the source table and store each chunk as a run
+
+    Continues after the last completed run.
+
+    :param source_table: the unsorted table.
+    :param runs: the temporary file for the runs.
+
+    """
+    n_runs = runs.get_node_attr('/', 'n_runs')
+    if 'run_%d' % n_runs in runs.root.runs:
+        # Remove the run that was interrupted
+        runs.remove_node(runs.root.runs, 'run_%d' % n_runs)
+
+    for start in range(n_runs * CHUNK_SIZE, source_table.nrows, CHUNK_SIZE):
+        particles = source_table.read(start, start + CHUNK_SIZE)
+        particles = particles[argsort(particles[SORTBY], kind='stable')]
+        runs.create_table(
+            runs.root.runs,
+            'run_%d' % n_runs,
+            obj=particles,
+            filters=source_table.filters,
+            expectedrows=len(particles),
+        )
+        n_runs += 1
+        runs.set_node_attr('/', 'n_runs', n_runs)
+        runs.flush()
+
+    runs.set_node_attr('/', 'positions', zeros(n_runs, dtype='i8'))
+    runs.set_node_attr('/', 'merged_rows', 0)
+    runs.set_node_attr('/', 'runs_done', True)
+    runs.flush()
+
+
+def merge_runs(runs, table):
+    """Merge the sorted runs into the target table
+
+    A block of each run is read. All buffered rows up to the smallest of
+    the last values in the buffers of unfinished runs can be merged, the
+    buffers are then refilled. After each merged block the number of
+    merged rows of each run is stored, an interrupted merge continues
+    from there.
+
+    :param runs: the temporary file containing the runs.
+    :param table: the target table.
+
+    """
+    positions = runs.get_node_attr('/', 'positions')
+    merged_rows = runs.get_node_attr('/', 'merged_rows')
+    run_tables = [runs.get_node(runs.root.runs, 'run_%d' % i) for i in range(len(positions))]
+    # Remove rows appended after the last stored progress
+    table.truncate(merged_rows)
+
+    buffers = [run.read(position, position + BLOCK_SIZE) for run, position in zip(run_tables, positions)]
+    while any(len(buffer) for buffer in buffers):
+        limit = min(
+            (
+                buffer[SORTBY][-1]
+                for buffer, run, position in zip(buffers, run_tables, positions)
+                if position + len(buffer) < run.nrows
+            ),
+            default=inf,
+        )
+
+        merged = []
+        for i, buffer in enumerate(buffers):
+            n = buffer[SORTBY].searchsorted(limit, 'right')
+            merged.append(buffer[:n])
+            buffers[i] = buffer[n:]
+            positions[i] += n
+        merged = concatenate(merged)
+        table.append(merged[argsort(merged[SORTBY], kind='stable')])
+        table.flush()
+
+        merged_rows += len(merged)
+        runs.set_node_attr('/', 'positions', positions)
+        runs.set_node_attr('/', 'merged_rows', merged_rows)
+        runs.flush()
+
+        for i, (buffer, run, position) in enumerate(zip(buffers, run_tables, positions)):
+            if len(buffer) < BLOCK_SIZE:
+                buffers[i] = concatenate((buffer, run.read(position + len(buffer), position + BLOCK_SIZE)))
+
+
+def sort_seed(seed):
+    """Sort the ground particles of a seed, continuing an earlier attempt
+
+    :param seed: seeds of the simulation, the name of its directory.
+    :return: the seed.
+
+    """
+    if os.path.exists(FLAG % seed):
+        return seed
+
+    with tables.open_file(SOURCE % seed, 'r') as source, tables.open_file(RUNS % seed, 'a') as runs:
+        source_table = source.get_node('/', TABLE)
+        if 'runs' not in runs.root:
+            runs.create_group('/', 'runs')
+            runs.set_node_attr('/', 'n_runs', 0)
+            runs.set_node_attr('/', 'runs_done', False)
+        if not runs.get_node_attr('/', 'runs_done'):
+            sort_runs(source_table, runs)
+
+        with tables.open_file(TARGET % seed, 'a') as target:
+            if TABLE not in target.root:
+                table = target.create_table(
+                    '/',
+                    TABLE,
+                    description=source_table.description,
+                    filters=source_table.filters,
+                    expectedrows=source_table.nrows,
+                )
+                source.copy_node_attrs(source_table, table)
+            merge_runs(runs, target.get_node('/', TABLE))
+            source.copy_node_attrs('/', target.root)
+            create_index(target)
+
+    os.remove(RUNS % seed)
+    open(FLAG % seed, 'w').close()
+    return seed
+
+
+def sort_seeds(seeds, processes=4):
+    """Sort the ground particles of several seeds simultaneously"""
+
+    worker_pool = multiprocessing.Pool(processes)
+    for seed in worker_pool.imap_unordered(sort_seed, seeds):
+        print('Finished', seed)
+    worker_pool.close()
+    worker_pool.join()
+
+
 if __name__ == "__main__":
-    for seed in seeds:
-        temp_path = SOURCE % seed
-        destination = TARGET % seed
-        with tables.open_file(temp_path, 'r') as hdf_temp, tables.open_file(destination, 'w') as hdf_data:
-            copy_and_sort_node(hdf_temp, hdf_data)
+    sort_seeds(seeds)
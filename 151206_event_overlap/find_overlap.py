@@ -16,11 +16,17 @@ from datetime import datetime
 
 import tables
 
-from numpy import array
+from numpy import arange, array, clip, cumsum, int64, take_along_axis, zeros
 
-from sapphire import Station, download_data
+from sapphire import download_data
+
+from .trace_cache import TraceCache
 
 DATA = '/Users/arne/Datastore/event_overlap.h5'
+MAX_DT = 1e4  # ns
+BATCH_SIZE = 1000
+HASH_BASE = 1_000_003
+HASH_MODULUS = 2_147_483_647  # 2**31 - 1, a prime
 
 
 def get_data():
@@ -34,17 +40,73 @@ def get_data():
 def find_overlaps():
     with tables.open_file(DATA, 'r') as data:
         events = data.root.s99.events
-        s = Station(99)
-        for i in range(events.nrows - 1):
-            if events[i + 1]['ext_timestamp'] - events[i]['ext_timestamp'] > 1e4:
-                continue
-            t1 = s.event_trace(events[i]['timestamp'], events[i]['nanoseconds'], True)
-            t2 = s.event_trace(events[i + 1]['timestamp'], events[i + 1]['nanoseconds'], True)
-            overlap = longest_overlap(t1[0], t2[0])
-            if overlap is not None:
-                print(i, len(overlap) * 2.5, 'ns')
-            else:
-                print(i, 'No overlap')
+        ext_timestamps = events.col('ext_timestamp')
+        pairs = close_pairs(ext_timestamps)
+        with TraceCache() as cache:
+            cache.prefetch(99, ext_timestamps[pairs])
+            cache.prefetch(99, ext_timestamps[pairs + 1])
+            for start in range(0, len(pairs), BATCH_SIZE):
+                batch = pairs[start:][:BATCH_SIZE]
+                t1 = array([cache.get(99, ets)[0] for ets in ext_timestamps[batch]])
+                t2 = array([cache.get(99, ets)[0] for ets in ext_timestamps[batch + 1]])
+                for i, length in zip(batch, overlap_lengths(t1, t2)):
+                    if length:
+                        print(i, length * 2.5, 'ns')
+                    else:
+                        print(i, 'No overlap')
+
+
+def close_pairs(ext_timestamps, max_dt=MAX_DT):
+    """Find subsequent events which are close in time
+
+    :param ext_timestamps: sorted extended timestamps of the events.
+    :param max_dt: maximum time between the events, in ns.
+    :return: indexes of the first event of each close pair.
+
+    """
+    return ((ext_timestamps[1:] - ext_timestamps[:-1]) <= max_dt).nonzero()[0]
+
+
+def overlap_lengths(a, b):
+    """Find the length of the longest overlap for many pairs of traces
+
+    Vectorized version of :func:`longest_overlap`, for each pair find the
+    longest sublist at the end of trace a which equals the start of trace
+    b. All candidate overlaps are compared at once using polynomial
+    rolling hashes of the suffixes of a and the prefixes of b. The
+    longest matching candidate is then verified, to exclude the (rare)
+    hash collisions.
+
+    :param a,b: arrays of traces with shape (n_pairs, n_samples).
+    :return: the length of the overlap for each pair, 0 if there is none.
+
+    """
+    a = array(a, dtype=int64, ndmin=2)
+    b = array(b, dtype=int64, ndmin=2)
+    n_pairs, n_samples = a.shape
+    powers = array([pow(HASH_BASE, k, HASH_MODULUS) for k in range(n_samples)], dtype=int64)
+    inverse = pow(HASH_BASE, -1, HASH_MODULUS)
+    inverse_powers = array([pow(inverse, k, HASH_MODULUS) for k in range(n_samples)], dtype=int64)
+
+    # Prefix sums of x[j] * BASE^-j, hash of x[i:k] is BASE^i * (h[k] - h[i])
+    hashes_a = zeros((n_pairs, n_samples + 1), dtype=int64)
+    hashes_a[:, 1:] = cumsum(a % HASH_MODULUS * inverse_powers % HASH_MODULUS, axis=1) % HASH_MODULUS
+    hashes_b = cumsum(b % HASH_MODULUS * inverse_powers % HASH_MODULUS, axis=1) % HASH_MODULUS
+
+    # Column k - 1 compares the suffix of a and prefix of b of length k
+    suffix_a = (hashes_a[:, -1:] - hashes_a[:, -2::-1]) % HASH_MODULUS * powers[::-1] % HASH_MODULUS
+    matches = suffix_a == hashes_b
+
+    samples = arange(n_samples)
+    while True:
+        lengths = n_samples - matches[:, ::-1].argmax(axis=1)
+        lengths[~matches.any(axis=1)] = 0
+        in_overlap = samples < lengths[:, None]
+        suffix = take_along_axis(a, clip(n_samples - lengths[:, None] + samples, 0, n_samples - 1), axis=1)
+        collisions = ((suffix != b) & in_overlap).any(axis=1).nonzero()[0]
+        if not len(collisions):
+            return lengths
+        matches[collisions, lengths[collisions] - 1] = False
 
 
 def longest_overlap(a, b):
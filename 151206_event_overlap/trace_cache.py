@@ -0,0 +1,245 @@
+"""Local cache of raw event traces
+
+Getting the traces of an event from the public database requires a
+request per event. This cache stores the raw traces on disk, keyed by
+station number and extended timestamp, so repeated analyses of the same
+events do not need to download them again.
+
+The traces are stored in a single flat file of int16 values, which is
+memory-mapped to read them. An index with the position of each event in
+that file is stored next to it. When the stored traces exceed the
+maximum size the least recently used events are evicted, but never the
+events which are being stored.
+
+Example::
+
+    with TraceCache() as cache:
+        cache.prefetch(501, events.col('ext_timestamp'))
+        for event in events:
+            traces = cache.get(501, event['ext_timestamp'])
+
+"""
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from numpy import array, int16, load, memmap, save
+
+from sapphire import Station
+
+CACHE_PATH = '/Users/arne/Datastore/trace_cache'
+MAX_SIZE = 2_000_000_000  # bytes
+# Evict until the traces use this fraction of the maximum size, to not
+# compact the file again for each new event
+EVICT_FRACTION = 0.9
+INDEX_DTYPE = [
+    ('station', 'u4'),
+    ('ext_timestamp', 'u8'),
+    ('offset', 'u8'),
+    ('n_detectors', 'u1'),
+    ('n_samples', 'u4'),
+    ('last_used', 'u8'),
+]
+
+
+class TraceCache:
+
+    """Persistent store of raw event traces
+
+    The index is written to disk after storing new traces and when the
+    cache is closed. Use the cache as a context manager to ensure the
+    least recently used order is kept between sessions.
+
+    :param path: directory in which the cache is stored.
+    :param max_size: maximum size of the stored traces, in bytes.
+
+    """
+
+    def __init__(self, path=CACHE_PATH, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.index_path = os.path.join(path, 'index.npy')
+        self.data_path = os.path.join(path, 'traces.bin')
+        self.stations = {}
+        self._data = None
+
+        os.makedirs(path, exist_ok=True)
+        if not os.path.exists(self.data_path):
+            open(self.data_path, 'wb').close()
+        self.size = os.path.getsize(self.data_path)
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            for entry in load(self.index_path):
+                self.entries[(int(entry['station']), int(entry['ext_timestamp']))] = [
+                    int(entry['offset']),
+                    int(entry['n_detectors']),
+                    int(entry['n_samples']),
+                    int(entry['last_used']),
+                ]
+        self.tick = max((entry[3] for entry in self.entries.values()), default=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        station, ext_timestamp = key
+        return (station, int(ext_timestamp)) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        """Write the index to disk"""
+
+        self.save_index()
+        self._data = None
+
+    def get(self, station, ext_timestamp):
+        """Get the raw traces of an event
+
+        The traces are downloaded and stored if they are not yet cached.
+
+        :param station: station number.
+        :param ext_timestamp: extended timestamp of the event.
+        :return: array with the raw traces for each detector, in ADC counts.
+
+        """
+        key = (station, int(ext_timestamp))
+        if key not in self.entries:
+            self.store(station, [ext_timestamp], [self.fetch(station, ext_timestamp)])
+        return self.read(key)
+
+    def prefetch(self, station, ext_timestamps, threads=8):
+        """Download and store the traces of events not yet in the cache
+
+        :param station: station number.
+        :param ext_timestamps: extended timestamps of the events.
+        :param threads: number of simultaneous downloads.
+
+        """
+        missing = sorted({int(ets) for ets in ext_timestamps if (station, int(ets)) not in self.entries})
+        if not missing:
+            return
+        self.get_station(station)
+        with ThreadPool(threads) as pool:
+            traces = pool.imap(lambda ets: self.fetch(station, ets), missing)
+            self.store(station, missing, traces)
+
+    def get_station(self, station):
+        """Get a Station object, reused for all requests for a station"""
+
+        if station not in self.stations:
+            self.stations[station] = Station(station)
+        return self.stations[station]
+
+    def fetch(self, station, ext_timestamp):
+        """Download the raw traces of an event from the public database"""
+
+        timestamp, nanoseconds = divmod(int(ext_timestamp), 1_000_000_000)
+        traces = self.get_station(station).event_trace(timestamp, nanoseconds, raw=True)
+        return array(traces, dtype=int16)
+
+    def store(self, station, ext_timestamps, traces):
+        """Append traces to the cache
+
+        :param station: station number.
+        :param ext_timestamps: extended timestamps of the events.
+        :param traces: traces of the events, each an array with shape
+                       (n_detectors, n_samples).
+
+        """
+        stored = set()
+        data = open(self.data_path, 'ab')
+        try:
+            for ext_timestamp, event_traces in zip(ext_timestamps, traces):
+                event_traces = array(event_traces, dtype=int16)
+                n_detectors, n_samples = event_traces.shape
+                key = (station, int(ext_timestamp))
+                self.tick += 1
+                self.entries[key] = [self.size, n_detectors, n_samples, self.tick]
+                data.write(event_traces.tobytes())
+                self.size += event_traces.nbytes
+                stored.add(key)
+                if self.size > self.max_size and len(stored) < len(self.entries):
+                    data.close()
+                    self.evict(keep=stored)
+                    data = open(self.data_path, 'ab')
+        finally:
+            data.close()
+        self.save_index()
+
+    def read(self, key):
+        """Read the traces of a cached event from the memory-mapped file
+
+        :param key: tuple of station number and extended timestamp.
+        :return: read-only view of the traces in the cache.
+
+        """
+        entry = self.entries[key]
+        offset, n_detectors, n_samples, _ = entry
+        self.tick += 1
+        entry[3] = self.tick
+        start = offset // int16().nbytes
+        stop = start + n_detectors * n_samples
+        if self._data is None or len(self._data) < stop:
+            self._data = memmap(self.data_path, dtype=int16, mode='r')
+        return self._data[start:stop].reshape(n_detectors, n_samples)
+
+    def evict(self, keep=()):
+        """Remove the least recently used events until the cache fits
+
+        Events are removed until the traces use at most EVICT_FRACTION of
+        the maximum size. The remaining traces are copied to a new data
+        file, which replaces the old file, and the index is written
+        immediately to match it.
+
+        :param keep: keys of events which are never removed, i.e. the
+                     events being stored. These are kept even if they
+                     alone exceed the maximum size.
+
+        """
+        target = EVICT_FRACTION * self.max_size
+        kept = {key: self.entries[key] for key in keep}
+        size = sum(entry[1] * entry[2] * int16().nbytes for entry in kept.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1][3], reverse=True):
+            if key in kept:
+                continue
+            nbytes = entry[1] * entry[2] * int16().nbytes
+            if size + nbytes > target:
+                break
+            kept[key] = entry
+            size += nbytes
+
+        data = memmap(self.data_path, dtype=int16, mode='r')
+        tmp_path = self.data_path + '.tmp'
+        offset = 0
+        with open(tmp_path, 'wb') as new_data:
+            for entry in sorted(kept.values()):
+                start = entry[0] // int16().nbytes
+                stop = start + entry[1] * entry[2]
+                traces = data[start:stop]
+                new_data.write(traces.tobytes())
+                entry[0] = offset
+                offset += traces.nbytes
+        del data
+        os.replace(tmp_path, self.data_path)
+
+        self.entries = kept
+        self.size = offset
+        self._data = None
+        # The stored index must match the layout of the new file
+        self.save_index()
+
+    def save_index(self):
+        """Write the index of the cached events to disk"""
+
+        index = array(
+            [(station, ets, *entry) for (station, ets), entry in self.entries.items()],
+            dtype=INDEX_DTYPE,
+        )
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            save(index_file, index)
+        os.replace(tmp_path, self.index_path)
@@ -1,6 +1,39 @@
-from numpy import append, arange, cumsum, exp, histogram, inf, interp, searchsorted, where
-from scipy.integrate import quad
-from scipy.misc import factorial
+"""Densities responsible for a detected number of particles
+
+The probability for a density given a detected number of particles
+follows from the Poisson probability for detecting that number of
+particles and the distribution of densities in KASCADE data.
+
+The posterior probabilities for all integer numbers of detected
+particles up to K_MAX are calculated at once on the LAMBDA grid, using
+the logarithm of the Poisson probability to avoid overflows for large
+numbers. The posteriors and the statistics derived from them are stored
+in TABLE_PATH, so the mean, median and most probable density for many
+detected numbers of particles are looked up in the stored table.
+
+"""
+import os
+
+from functools import lru_cache
+
+from numpy import (
+    append,
+    arange,
+    array,
+    array_equal,
+    asarray,
+    cumsum,
+    errstate,
+    exp,
+    histogram,
+    interp,
+    load,
+    log,
+    savez,
+    searchsorted,
+    where,
+)
+from scipy.special import gammaln, logsumexp, xlogy
 
 from artist import Plot
 
@@ -11,6 +44,8 @@ MAX = 300
 STEP = 0.01
 SMALL_STEP = STEP  # / 10.
 LAMBDA = arange(MIN, MAX, SMALL_STEP)
+K_MAX = 300
+TABLE_PATH = '/Users/arne/Datastore/kascade/poisson_posterior.npz'
 
 KD = KascadeDensity()
 KD_probability, KD_bins = histogram(KD.src_k, bins=arange(MIN, MAX, STEP), density=True)
@@ -18,6 +53,18 @@ KD_probability, KD_bins = histogram(KD.src_k, bins=arange(MIN, MAX, STEP), densi
 KD_probability = append(KD_probability, [0.0, 0.0])
 
 
+def log_poisson(lamb, k):
+    """Logarithm of the Poisson probability
+
+    log(P(k|lamb)), calculated without factorials to prevent overflows.
+
+    :param lamb: the actual expected number of particles
+    :param k: the detected number of particles
+
+    """
+    return xlogy(k, lamb) - lamb - gammaln(k + 1)
+
+
 def poisson(lamb, k):
     """Poisson probability for detecting k particles given density lamb
 
@@ -27,7 +74,7 @@ def poisson(lamb, k):
     :param k: the detected number of particles
 
     """
-    return lamb**k * exp(-lamb) / factorial(k)
+    return exp(log_poisson(lamb, k))
 
 
 def p_lambda(lamb):
@@ -55,13 +102,37 @@ def integrand(lamb, k):
     return poisson(lamb, k) * p_lambda(lamb)
 
 
+def log_integrand(lamb, k):
+    """Logarithm of the probabilities to be integrated over
+
+    :param lamb: the actual expected number of particles, with shape (n,)
+    :param k: the detected numbers of particles, with shape (m, 1) to
+              get the values for all combinations.
+
+    """
+    with errstate(divide='ignore'):
+        return log_poisson(lamb, k) + log(p_lambda(lamb))
+
+
+def log_normalization(k):
+    """Logarithm of the normalization factor
+
+    The integral is a sum over the LAMBDA grid.
+
+    :param k: the detected number(s) of particles
+
+    """
+    k = asarray(k)
+    return logsumexp(log_integrand(LAMBDA, k[..., None]), axis=-1) + log(SMALL_STEP)
+
+
 def normalization(k):
     """Normalization factor
 
-    :param k: the detected number of particles
+    :param k: the detected number(s) of particles
 
     """
-    return quad(integrand, 0, inf, args=(k))[0]
+    return exp(log_normalization(k))
 
 
 def density_probability(lamb, k):
@@ -73,55 +144,99 @@ def density_probability(lamb, k):
     :param k: the detected number of particles
 
     """
-    return poisson(lamb, k) * p_lambda(lamb) / normalization(k)
+    return exp(log_integrand(lamb, k) - log_normalization(k))
+
+
+def calculate_posterior_table(k_max=K_MAX):
+    """Calculate the posteriors and their statistics for k up to k_max
+
+    :param k_max: the largest detected number of particles.
+    :return: dictionary with the posterior for each k on the LAMBDA grid,
+             and the mean, most probable, median and lower and upper
+             percentile densities for each k.
+
+    """
+    k = arange(k_max + 1)
+    log_integrands = log_integrand(LAMBDA, k[:, None])
+    posterior = exp(log_integrands - logsumexp(log_integrands, axis=1, keepdims=True)) / SMALL_STEP
+    cumulative_prob = cumsum(posterior, axis=1) * SMALL_STEP
+    return {
+        'lamb': LAMBDA,
+        'posterior': posterior,
+        'mean': (posterior * LAMBDA).sum(axis=1) * SMALL_STEP,
+        'most_probable': LAMBDA[posterior.argmax(axis=1)],
+        'median': LAMBDA[[searchsorted(cp, 0.5) for cp in cumulative_prob]],
+        'percentile_low': array([interp(0.25, cp, LAMBDA) for cp in cumulative_prob]),
+        'percentile_high': array([interp(0.75, cp, LAMBDA) for cp in cumulative_prob]),
+    }
+
+
+@lru_cache()
+def get_posterior_table(k_max=K_MAX, path=TABLE_PATH):
+    """Get the stored posterior table, calculate and store it if needed
+
+    The table is recalculated if the stored table was made for a
+    different LAMBDA grid or smaller k_max.
+
+    """
+    if os.path.exists(path):
+        table = dict(load(path))
+        if len(table['posterior']) > k_max and array_equal(table['lamb'], LAMBDA):
+            return table
+    table = calculate_posterior_table(k_max)
+    savez(path, **table)
+    return table
+
+
+def posterior(k):
+    """Posterior probabilities on the LAMBDA grid for detected number(s) k"""
+
+    return get_posterior_table()['posterior'][k]
 
 
 def mean_density_for_n(k):
     """Calculate expected mean density given a detected number of particles
 
-    :param k: the detected number of particles
+    :param k: the detected number(s) of particles, integers up to K_MAX.
 
     """
-    return sum(LAMBDA * density_probability(LAMBDA, k)) * SMALL_STEP
+    return get_posterior_table()['mean'][k]
 
 
 def most_probable_density_for_n(k):
     """Calculate most probable density given a detected number of particles
 
-    :param k: the detected number of particles
+    :param k: the detected number(s) of particles, integers up to K_MAX.
 
     """
-    return LAMBDA[density_probability(LAMBDA, k).argmax()]
+    return get_posterior_table()['most_probable'][k]
 
 
 def median_density_for_n(k):
     """Calculate median density given a detected number of particles
 
-    :param k: the detected number of particles
+    :param k: the detected number(s) of particles, integers up to K_MAX.
 
     """
-    cumulative_prob = cumsum(density_probability(LAMBDA, k) * SMALL_STEP)
-    return LAMBDA[searchsorted(cumulative_prob, 0.5)]
+    return get_posterior_table()['median'][k]
 
 
 def percentile_low_density_for_n(k):
     """Calculate lower percentile density given a detected number of particles
 
-    :param k: the detected number of particles
+    :param k: the detected number(s) of particles, integers up to K_MAX.
 
     """
-    cumulative_prob = cumsum(density_probability(LAMBDA, k) * SMALL_STEP)
-    return interp(0.25, cumulative_prob, LAMBDA)
+    return get_posterior_table()['percentile_low'][k]
 
 
 def percentile_high_density_for_n(k):
     """Calculate upper percentile density given a detected number of particles
 
-    :param k: the detected number of particles
+    :param k: the detected number(s) of particles, integers up to K_MAX.
 
     """
-    cumulative_prob = cumsum(density_probability(LAMBDA, k) * SMALL_STEP)
-    return interp(0.75, cumulative_prob, LAMBDA)
+    return get_posterior_table()['percentile_high'][k]
 
 
 def plot_contributions():
@@ -131,7 +246,7 @@ def plot_contributions():
 
     for j, k in enumerate(list(range(1, 8)) + [15] + [20]):
         ks = [k]  # arange(k - 0.5, k + 0.5, 0.2)
-        p = sum(density_probability(lamb, ki) for ki in ks) / len(ks)
+        p = density_probability(lamb, array(ks)[:, None]).mean(axis=0)
         plot.plot(lamb, p, linestyle=colors[j % len(colors)], mark=None)
     plot.set_ylimits(min=0.01)
     plot.set_xlimits(0, 20)
@@ -142,11 +257,11 @@ def plot_contributions():
 
 def plot_ranges():
     k = arange(26)
-    p_low = [percentile_low_density_for_n(ki) for ki in k]
-    p_median = [median_density_for_n(ki) for ki in k]
-    p_mean = [mean_density_for_n(ki) for ki in k]
-    #     p_mpv = [most_probable_density_for_n(ki) for ki in k]
-    p_high = [percentile_high_density_for_n(ki) for ki in k]
+    p_low = percentile_low_density_for_n(k)
+    p_median = median_density_for_n(k)
+    p_mean = mean_density_for_n(k)
+    #     p_mpv = most_probable_density_for_n(k)
+    p_high = percentile_high_density_for_n(k)
     plot = Plot(height=r'\defaultwidth')
     plot.plot([0, 1.5 * max(k)], [0, 1.5 * max(k)], mark=None, linestyle='dashed')
     plot.scatter(k, p_median)
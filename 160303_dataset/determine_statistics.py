@@ -1,11 +1,26 @@
-import csv
 import os
 
 from datetime import date
 
 import tables
 
-from numpy import arange, array, column_stack, empty, genfromtxt, histogram2d, nan, searchsorted, split, sum
+from numpy import (
+    arange,
+    array,
+    array_equal,
+    bincount,
+    column_stack,
+    errstate,
+    full,
+    histogram2d,
+    isnan,
+    nan,
+    searchsorted,
+    split,
+    trunc,
+    unique,
+    zeros,
+)
 
 from artist import MultiPlot, Plot
 
@@ -17,7 +32,8 @@ from .download_dataset import END, START, STATIONS
 DATASTORE = "/Users/arne/Datastore/dataset"
 DATA_PATH = os.path.join(DATASTORE, 'dataset_sciencepark_stations_110601_160201.h5')
 COIN_PATH = os.path.join(DATASTORE, 'dataset_sciencepark_n2_110601_160201.h5')
-TSV_PATH = os.path.join(DATASTORE, 'stats/s%d_%s.tsv')
+STATS_PATH = os.path.join(DATASTORE, 'stats.h5')
+CHUNK_SIZE = 1_000_000
 
 # STATIONS = STATIONS[-2:]
 START_TS = datetime_to_gps(date(*START, day=1))
@@ -34,41 +50,43 @@ FIELDS = ['event_rate', 'mpv', 'integrals', 't_trigger', ('t1', 't2', 't3', 't4'
 FIELD_NAMES = [''.join(field) for field in FIELDS]
 
 
-def frac_bad(values):
-    """Get fraction of bad values in an array"""
+def field_values(events, field):
+    """Get the values of a field with a column for each detector
 
-    if len(values):
-        return 100.0 * sum(values < 0, axis=0) / len(values)
+    :param events: array of events.
+    :param field: name of a column, or tuple of column names to combine.
+    :return: 2D array with a row for each event.
+
+    """
+    if isinstance(field, tuple):
+        return column_stack([events[f] for f in field])
     else:
-        try:
-            result = empty(values.shape[1])
-            result.fill(nan)
-            return result
-        except:
-            return nan
+        return events[field].reshape(len(events), -1)
 
 
-def reconstruct_mpv(slice):
-    """Get first events in slice with a positive value in number of particles
+def update_mpv(mpvs, events, bin_idx):
+    """Set the MPV from the first events with a positive number of particles
 
     A positive (non-zero) n# is required to determine the MPV from the
-    intergrals and n#. If the slice contains no applicable events
-    the returned value will be nan.
+    intergrals and n#. Only bins for which no MPV was set yet, by earlier
+    events, are updated. Bins without applicable events remain nan.
 
-    Works best for slices of a day because the MPV for the ESD is determined
+    Works best for bins of a day because the MPV for the ESD is determined
     daily.
 
+    :param mpvs: array with the MPV per detector for each bin.
+    :param events: array of events.
+    :param bin_idx: index of the bin for each event.
+
     """
-    mpvs = []
     for detector_id in range(4):
-        try:
-            event = next(e for e in slice if e['n%d' % (detector_id + 1)] > 0.1)
-        except:
-            mpvs.append(nan)
-        else:
-            mpv = event['integrals'][detector_id] / event['n%d' % (detector_id + 1)]
-            mpvs.append(int(mpv))
-    return mpvs
+        n = events['n%d' % (detector_id + 1)]
+        positive = (n > 0.1).nonzero()[0]
+        bins, first = unique(bin_idx[positive], return_index=True)
+        rows = positive[first]
+        unset = isnan(mpvs[detector_id, bins])
+        rows = rows[unset]
+        mpvs[detector_id, bins[unset]] = trunc(events['integrals'][rows, detector_id] / n[rows])
 
 
 def binned_stat(x, values, func, bins):
@@ -78,34 +96,52 @@ def binned_stat(x, values, func, bins):
     return array([func(group) for group in split(values, idx_ranges)]).T
 
 
-def binned_stat_idx(events, idx_ranges):
+def binned_stat_idx(events, idx_ranges, chunk_size=CHUNK_SIZE):
+    """Determine the statistics for each bin in a single pass over the events
 
-    stats = {}
-    for field_name in FIELD_NAMES:
-        if field_name == 'event_rate':
-            stats[field_name] = get_event_rate(idx_ranges)
-        else:
-            stats[field_name] = []
+    The events are read in chunks of many bins. For each chunk the
+    number of bad (negative) values is summed per bin, and the first
+    events with a positive number of particles in each bin are used to
+    determine the MPV.
+
+    :param events: events table, sorted by timestamp.
+    :param idx_ranges: event row indexes of the bin edges.
+    :param chunk_size: number of events to read at once.
+    :return: dictionary with the statistics for each field. The fraction
+             of bad values (in percent) for most fields, the MPV value
+             for the mpv field.
 
-    for start, stop in pbar(list(zip(idx_ranges[:-1], idx_ranges[1:]))):
-        slice = events.read(start, stop)
+    """
+    n_bins = len(idx_ranges) - 1
+    n_bad = {}
+    mpvs = full((4, n_bins), nan)
+
+    for start in pbar(range(idx_ranges[0], idx_ranges[-1], chunk_size)):
+        stop = min(start + chunk_size, idx_ranges[-1])
+        chunk = events.read(start, stop)
+        bin_idx = searchsorted(idx_ranges, arange(start, stop), side='right') - 1
         for field, field_name in zip(FIELDS, FIELD_NAMES):
             if field_name == 'event_rate':
-                # Event time determined above
+                # Event time determined from the idx_ranges
                 continue
             elif field_name == 'mpv':
                 # Simply the MPV value, not fraction of bad MPV
-                mpvs = reconstruct_mpv(slice)
-                stats[field_name].append(mpvs)
-            elif isinstance(field, tuple):
-                data = column_stack(slice[f] for f in field)
-                stats[field_name].append(frac_bad(data))
+                update_mpv(mpvs, chunk, bin_idx)
             else:
-                data = slice[field]
-                stats[field_name].append(frac_bad(data))
-
-    for field_name in FIELD_NAMES:
-        stats[field_name] = array(stats[field_name]).T
+                bad = field_values(chunk, field) < 0
+                counts = array([bincount(bin_idx, weights=column, minlength=n_bins) for column in bad.T])
+                n_bad[field_name] = n_bad.get(field_name, 0) + counts
+
+    n_events = idx_ranges[1:] - idx_ranges[:-1]
+    stats = {'event_rate': get_event_rate(idx_ranges), 'mpv': mpvs}
+    for field, field_name in zip(FIELDS, FIELD_NAMES):
+        if field_name in stats:
+            continue
+        counts = n_bad.get(field_name, zeros((1, n_bins)))
+        with errstate(invalid='ignore'):
+            stats[field_name] = 100.0 * counts / n_events
+        if not isinstance(field, tuple) and len(counts) == 1:
+            stats[field_name] = stats[field_name][0]
 
     return stats
 
@@ -126,20 +162,11 @@ def determine_station_stats(data, station):
     idx_ranges = get_idx_ranges(events)
     stats = binned_stat_idx(events, idx_ranges)
 
-    save_idx_ranges(idx_ranges, station)
-    save_station_stats(stats, station)
+    save_station_stats(stats, idx_ranges, station)
 
     return stats
 
 
-def save_idx_ranges(idx_ranges, station):
-    path = TSV_PATH % (station, 'idx_ranges')
-    with open(path, 'wb') as tsvfile:
-        tsv = csv.writer(tsvfile, delimiter='\t')
-        timestamped_stats = column_stack((BINS[:-1], idx_ranges[:-1]))
-        tsv.writerows(timestamped_stats)
-
-
 def determine_all_stats(data):
     """
 
@@ -152,39 +179,47 @@ def determine_all_stats(data):
     return stats
 
 
-def save_stat(stat, station, field_name):
-    path = TSV_PATH % (station, field_name)
-    with open(path, 'wb') as tsvfile:
-        tsv = csv.writer(tsvfile, delimiter='\t')
-        timestamped_stats = column_stack((BINS[:-1], stat.T))
-        tsv.writerows(timestamped_stats)
+def save_station_stats(stats, idx_ranges, station):
+    """Store the statistics of a station in the statistics HDF5 file
 
+    The bins and the event row indexes of the bin edges are stored with
+    the statistics, replacing previously stored statistics.
 
-def save_station_stats(stats, station):
-    for field_name in FIELD_NAMES:
-        save_stat(stats[field_name], station, field_name)
+    """
+    group = '/s%d' % station
+    with tables.open_file(STATS_PATH, 'a') as data:
+        if group in data:
+            data.remove_node(group, recursive=True)
+        data.create_array(group, 'bins', BINS, createparents=True)
+        data.create_array(group, 'idx_ranges', idx_ranges)
+        for field_name in FIELD_NAMES:
+            data.create_array(group, field_name, stats[field_name])
 
 
 def save_stats(stats):
     for station in STATIONS:
-        for field_name in FIELD_NAMES:
-            save_stat(stats[station][field_name], station, field_name)
+        with tables.open_file(DATA_PATH) as data:
+            idx_ranges = get_idx_ranges(data.get_node('/s%d' % station, 'events'))
+        save_station_stats(stats[station], idx_ranges, station)
 
 
-def get_stat(station, field_name):
-    path = TSV_PATH % (station, field_name)
-    stat = genfromtxt(path, delimiter='\t')
-    # Check if the BINS have changed
-    assert all(stat[:, 0] == BINS[:-1])
+def read_station_stats(station):
+    """Read the statistics of a station from the statistics HDF5 file"""
 
-    return stat[:, 1:].T
+    with tables.open_file(STATS_PATH, 'r') as data:
+        group = data.get_node('/s%d' % station)
+        # Check if the BINS have changed
+        assert array_equal(group.bins.read(), BINS)
+        stats = {field_name: group._f_get_child(field_name).read() for field_name in FIELD_NAMES}
+
+    return stats
 
 
 def get_station_stats(station):
     print('Reading stats for %d' % station)
     try:
-        stats = {field_name: get_stat(station, field_name) for field_name in FIELD_NAMES}
-    except (TypeError, OSError, AssertionError):
+        stats = read_station_stats(station)
+    except (OSError, tables.NoSuchNodeError, AssertionError):
         print('Determining stats for %d' % station)
         with tables.open_file(DATA_PATH) as data:
             stats = determine_station_stats(data, station)
@@ -193,7 +228,7 @@ def get_station_stats(station):
 
 
 def get_all_stats():
-    """First try reading from TSV, if not available determine from data"""
+    """First try reading from HDF5, if not available determine from data"""
 
     stats = {station: get_station_stats(station) for station in STATIONS}
     return stats
@@ -259,7 +294,7 @@ def plot_comparison(stats, field_name):
     plot = MultiPlot(len(STATIONS), len(STATIONS), width=r'.06\textwidth', height=r'.06\textwidth')
     bins = arange(0, 1.2, 0.03)
     for i, ref_station in enumerate(STATIONS):
-        ref_stat = stats[ref_station][field_name][0]
+        ref_stat = stats[ref_station][field_name]
         ref_filter = ref_stat > 0
         for j, station in enumerate(STATIONS):
             if i == j:
@@ -267,7 +302,7 @@ def plot_comparison(stats, field_name):
                 plot.set_label(r'%d' % station, location='center')
                 continue
             splot = plot.get_subplot_at(i, j)
-            stat = stats[station][field_name][0]
+            stat = stats[station][field_name]
 
             tmp_stat = stat.compress(ref_filter & (stat > 0))
             tmp_ref_stat = ref_stat.compress(ref_filter & (stat > 0))
@@ -305,8 +340,8 @@ def plot_comparison_501_510(stats, field_name):
     plot = Plot()
     bins = arange(0, 1, 0.02)
 
-    ref_stat = stats[501][field_name][0]
-    stat = stats[510][field_name][0]
+    ref_stat = stats[501][field_name]
+    stat = stats[510][field_name]
 
     tmp_stat = stat.compress((ref_stat > 0) & (stat > 0))
     tmp_ref_stat = ref_stat.compress((ref_stat > 0) & (stat > 0))
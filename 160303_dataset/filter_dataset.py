@@ -1,8 +1,13 @@
+import os
+
 import tables
 
-from numpy import ones_like, sum
+from numpy import arange, ones_like, searchsorted, sum
+
+from .determine_statistics import CHUNK_SIZE, DATA_PATH, DATASTORE, get_all_stats, get_idx_ranges
+from .download_dataset import STATIONS
 
-from .determine_statistics import get_all_stats
+FILTERED_PATH = os.path.join(DATASTORE, 'dataset_sciencepark_stations_filtered_110601_160201.h5')
 
 
 class DayFilter:
@@ -37,7 +42,7 @@ class DayFilter:
         indicate problems, such as light leaks.
 
         """
-        return ((0.3 < self.stats['event_rate']) & (self.stats['event_rate'] < 1.0))[0]
+        return (0.3 < self.stats['event_rate']) & (self.stats['event_rate'] < 1.0)
 
     def filter_trigger_time(self):
         """Filter event rate statistics
@@ -46,7 +51,7 @@ class DayFilter:
         Put cut on 1.0%
 
         """
-        return (self.stats['t_trigger'] < 1.0)[0]
+        return self.stats['t_trigger'] < 1.0
 
     def filter_particle_density(self):
         """Filter event rate statistics
@@ -82,7 +87,7 @@ class EventFilter:
 
     """Remove station events not satisfying requirements
 
-    :param statistics: dictionary of data statistics from determine_statistics.
+    :param events: array of events, e.g. a chunk read from the events table.
 
     """
 
@@ -90,7 +95,14 @@ class EventFilter:
         self.events = events
 
     def data_filter(self):
-        keep_filter = self.filter_offline_trigger()
+        """Get a filter to be used to keep good events
+
+        :return: events to keep.
+
+        """
+        keep_filter = ones_like(self.events['timestamp'], dtype=bool)
+        keep_filter &= self.filter_offline_trigger()
+        return keep_filter
 
     def filter_offline_trigger(self):
         """Look for individual events to filter"""
@@ -101,23 +113,93 @@ class EventFilter:
         low = 0.3
         high = 0.6
 
-        n_high = sum(self.events['n%d' % (id + 1)] > high for id in range(4))
-        n_low = sum(self.events['n%d' % (id + 1)] > low for id in range(4))
+        n_high = sum([self.events['n%d' % (id + 1)] > high for id in range(4)], axis=0)
+        n_low = sum([self.events['n%d' % (id + 1)] > low for id in range(4)], axis=0)
         return (n_high > 2) | (n_low > 3)
 
 
-def copy_selection(statistics):
-    """Copy the selected events to a new tables
+def copy_selection(statistics, complevel=0, chunk_size=CHUNK_SIZE):
+    """Copy the selected events to a new file
+
+    :param statistics: dictionary of data statistics for each station.
+    :param complevel: compression level for the new file, 0 for no
+                      compression.
+    :param chunk_size: number of events to filter at once.
 
-    WIP
+    """
+    filters = tables.Filters(complevel=complevel, complib='blosc') if complevel else None
+    with tables.open_file(DATA_PATH, 'r') as source:
+        with tables.open_file(FILTERED_PATH, 'w', filters=filters) as target:
+            for station in STATIONS:
+                copy_station_selection(source, target, station, statistics[station], chunk_size)
+
+
+def copy_station_selection(source, target, station, statistics, chunk_size=CHUNK_SIZE):
+    """Copy the selected events of a station to the target file
+
+    The events are read, filtered and appended in chunks, so the station
+    data never needs to fit in memory. Events on days rejected by
+    :class:`DayFilter` or outside the days covered by the statistics are
+    skipped, the remaining events are filtered by :class:`EventFilter`.
+    If the station has blobs, the traces of the selected events are
+    copied as well and their indexes updated.
+
+    :param source,target: the open source and target files.
+    :param station: station number.
+    :param statistics: dictionary of data statistics for the station.
+    :param chunk_size: number of events to filter at once.
+
+    """
+    group = '/s%d' % station
+    events = source.get_node(group, 'events')
+    keep_days = DayFilter(statistics).data_filter()
+    idx_ranges = get_idx_ranges(events)
+
+    filtered_events = target.create_table(
+        group, 'events', events.description, expectedrows=events.nrows, createparents=True
+    )
+    if 'blobs' in source.get_node(group) and 'traces' in events.colnames:
+        blobs = source.get_node(group, 'blobs')
+        filtered_blobs = target.create_vlarray(group, 'blobs', blobs.atom)
+    else:
+        blobs = None
+
+    for start in range(0, events.nrows, chunk_size):
+        stop = min(start + chunk_size, events.nrows)
+        chunk = events.read(start, stop)
+        day_idx = searchsorted(idx_ranges, arange(start, stop), side='right') - 1
+        on_day = (day_idx >= 0) & (day_idx < len(keep_days))
+        keep = on_day.copy()
+        keep[on_day] = keep_days[day_idx[on_day]]
+        keep &= EventFilter(chunk).data_filter()
+        selection = chunk[keep]
+        if blobs is not None:
+            copy_blobs(selection, blobs, filtered_blobs)
+        filtered_events.append(selection)
+    filtered_events.flush()
+
+
+def copy_blobs(events, blobs, target_blobs):
+    """Copy the blobs of events and point the events to the copies
+
+    :param events: array of events, the traces column is updated.
+    :param blobs: source blobs VLArray.
+    :param target_blobs: target blobs VLArray.
 
     """
-    with tables.open_file(DATA_PATH) as source:
-        with tables.open_file(FILTERED_PATH, 'w') as target:
-            source
-            target
+    traces = events['traces']
+    present = traces >= 0
+    blob_idx = traces[present]
+    if not len(blob_idx):
+        return
+    first = blob_idx.min()
+    rows = blobs.read(first, blob_idx.max() + 1)
+    traces[present] = arange(target_blobs.nrows, target_blobs.nrows + len(blob_idx))
+    for idx in blob_idx:
+        target_blobs.append(rows[idx - first])
+    target_blobs.flush()
 
 
 if __name__ == "__main__":
     statistics = get_all_stats()
-    keep_slices = filter_event_rate(statistics)
+    copy_selection(statistics)
@@ -0,0 +1 @@
+../140122_corsika_front/groundparticles_index.py
\ No newline at end of file
@@ -20,6 +20,8 @@ from artist import MultiPlot
 from sapphire import CorsikaQuery
 from sapphire.corsika.particles import name
 
+from .groundparticles_index import GroundParticlesIndex
+
 # Using showers of various energies, and selected the median shower by size:
 # 1115962_287886190   14.5
 # 402530248_77483417  15
@@ -107,7 +109,7 @@ def plot_shower_profile(seeds):
 
 def plot_shower_profile_for_bin(seeds):
 
-    with tables.open_file(PATH % seeds) as data:
+    with tables.open_file(PATH % seeds) as data, GroundParticlesIndex(PATH % seeds) as index:
         gp = data.root.groundparticles
 
         min_r = 40
@@ -115,9 +117,10 @@ def plot_shower_profile_for_bin(seeds):
 
         min_t = gp.col('t').min()
 
-        gamma = gp.read_where('(particle_id == 1) & (r > min_r) & (r < max_r)')
-        electrons = gp.read_where('(particle_id >= 3) & (particle_id <= 4) & (r > min_r) & (r < max_r)')
-        muons = gp.read_where('(particle_id >= 5) & (particle_id <= 6) & (r > min_r) & (r < max_r)')
+        particles = index.annulus(min_r, max_r)
+        gamma = particles[particles['particle_id'] == 1]
+        electrons = particles[(particles['particle_id'] >= 3) & (particles['particle_id'] <= 4)]
+        muons = particles[(particles['particle_id'] >= 5) & (particles['particle_id'] <= 6)]
 
         gamma_t = gamma['t'] - min_t
         electrons_t = electrons['t'] - min_t
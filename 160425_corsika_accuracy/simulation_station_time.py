@@ -30,6 +30,8 @@ from sapphire.clusters import SingleDiamondStation
 from sapphire.corsika.particles import name
 from sapphire.simulations.groundparticles import FixedCoreDistanceSimulation
 
+from .groundparticles_index import GroundParticlesIndex
+
 # local seeds
 SEEDS_14 = ['651000510_222963176', '155366293_265066277', '758294490_567681579']
 SEEDS_15 = ['791363922_262129855', '291305112_897286854', '683790878_143722028']
@@ -127,10 +129,8 @@ def plot_arrival_time_distribution_v_distance(data, seeds):
         seeds = next(y[1:] for y in group._v_pathname.split('/') if y.startswith('s'))
 
         if cor_t is None:
-            with tables.open_file(CORSIKA_DATA % seeds) as data:
-                gp = data.root.groundparticles
-                query = '(x < 10) & (x > -10) & (r < 10)'
-                cor_t = gp.read_where(query, field='t').min()
+            with GroundParticlesIndex(CORSIKA_DATA % seeds) as index:
+                cor_t = index.annulus(0, 10)['t'].min()
 
         #         i = get_info(seeds)['first_interaction_altitude']
         #         cor_t = i / 0.299792458
@@ -190,19 +190,12 @@ def causal_front(first_interaction_altitude, x):
 
 def plot_shower_profile(seeds, splot, core_distances, cor_t):
 
-    query = (
-        '((particle_id == 3) | (particle_id == 4) |'
-        ' (particle_id == 5) | (particle_id == 6)) & '
-        '(abs(r - core_distance) < 10)'
-    )
-
-    with tables.open_file(CORSIKA_DATA % seeds) as data:
-        gp = data.root.groundparticles
-
+    with GroundParticlesIndex(CORSIKA_DATA % seeds) as index:
         t = []
 
         for core_distance in core_distances:
-            lepton_t = gp.read_where(query, field='t') - cor_t
+            leptons = index.annulus(core_distance - 10, core_distance + 10, particle_ids=[3, 4, 5, 6])
+            lepton_t = leptons['t'] - cor_t
             quantiles = [25, 50, 75]
             t.append(percentile(lepton_t, q=quantiles))
 